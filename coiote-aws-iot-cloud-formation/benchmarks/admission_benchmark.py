@@ -0,0 +1,113 @@
+"""
+Admission control of Coiote DM task submission (lwm2mOperation/admission.py) under a fleet-wide burst of operations
+against the Coiote DM stand-in, which throttles above a fixed rate of requests with 429:
+
+* baseline  - no admission control, the operations' calls hit the stand-in's limit
+* admission - a token bucket just below the stand-in's limit, with execute operations prioritized over reads
+
+Every operation makes two calls (task and session trigger). Reports status codes of the operations per priority,
+429 responses of the stand-in, and successful operations per second over the run.
+
+Usage: python admission_benchmark.py [--rate OPERATIONS_PER_SECOND] [--duration SECONDS] [--limit-rps RPS]
+       [--execute-fraction FRACTION]
+"""
+import argparse
+import contextlib
+import os
+import random
+import statistics
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from coiote_stand_in import CoioteStandIn, Faults, import_lwm2m_operation
+from lambda_load_benchmark import LambdaContext, percentile
+
+DEVICES = 200
+
+
+def configure(lambda_function, limit_rps: float, enabled: bool):
+    from admission import AdmissionController, LocalAdmissionBackend
+    lambda_function.admission = None
+    if enabled:
+        lambda_function.admission = AdmissionController(
+            LocalAdmissionBackend(), rate=limit_rps * 0.9, burst=limit_rps * 0.5, operation_rates={},
+            high_priority_operations=['execute'], reserve=limit_rps * 0.1, max_wait=2)
+
+
+def synthetic_event(sequence: int, execute_fraction: float) -> dict:
+    thingName = f'device-{sequence % DEVICES}'
+    if random.random() < execute_fraction:
+        return {'thingName': thingName, 'operation': 'execute', 'keys': ['3.0.4']}
+    return {'thingName': thingName, 'operation': 'read', 'keys': ['3303.0.5700']}
+
+
+def run(lambda_function, stand_in: CoioteStandIn, args):
+    statuses = defaultdict(Counter)
+    latencies = defaultdict(list)
+    completed_at = []
+    lock = threading.Lock()
+
+    def invoke(event):
+        start = time.perf_counter()
+        try:
+            status = lambda_function.lambda_handler(event, LambdaContext(timeout_ms=10000))['statusCode']
+        except Exception as e:
+            status = type(e).__name__
+        end = time.perf_counter()
+        with lock:
+            statuses[event['operation']][status] += 1
+            latencies[event['operation']].append((end - start) * 1000)
+            if status == 200:
+                completed_at.append(end)
+
+    stand_in.requests.clear()
+    operations = int(args.rate * args.duration)
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+            ThreadPoolExecutor(max_workers=256) as executor:
+        for sequence in range(operations):
+            delay = start + sequence / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(invoke, synthetic_event(sequence, args.execute_fraction))
+
+    per_second = Counter(int(end - start) for end in completed_at)
+    seconds = [per_second[second] for second in range(1, int(args.duration))]
+    print(f'  Coiote DM requests {dict(stand_in.requests)}')
+    print(f'  successful operations per second: mean {statistics.mean(seconds):.1f}, '
+          f'min {min(seconds)}, max {max(seconds)} (limit {args.limit_rps / 2:g})')
+    for operation in sorted(statuses):
+        operation_latencies = sorted(latencies[operation])
+        print(f'  {operation:>8}: {dict(statuses[operation])}, p50 {percentile(operation_latencies, 0.5):7.1f} ms, '
+              f'p99 {percentile(operation_latencies, 0.99):7.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bursts operations against a throttling local Coiote DM.')
+    parser.add_argument('--rate', type=float, default=100, help='operations per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--limit-rps', type=float, default=60, help="stand-in's limit of requests per second")
+    parser.add_argument('--execute-fraction', type=float, default=0.2)
+    args = parser.parse_args()
+
+    import urllib3
+    urllib3.disable_warnings()
+    with CoioteStandIn() as stand_in:
+        lambda_function = import_lwm2m_operation(stand_in)
+        # device lookups are not subject to admission control, they are made before the burst
+        for i in range(DEVICES):
+            lambda_function.get_device_db_id(f'device-{i}', lambda_function.Deadline(time.monotonic() + 10))
+        stand_in.faults = Faults(latencyMs=5, latencyJitterMs=5, throttleRps=args.limit_rps)
+
+        for enabled in (False, True):
+            configure(lambda_function, args.limit_rps, enabled)
+            print(f'{"admission" if enabled else "baseline"}: {args.rate:g} operations/s for {args.duration:g} s')
+            run(lambda_function, stand_in, args)
+            # lets the stand-in's token bucket refill
+            time.sleep(2)
+
+
+if __name__ == '__main__':
+    main()
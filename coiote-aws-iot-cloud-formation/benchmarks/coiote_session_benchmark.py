@@ -0,0 +1,81 @@
+"""
+Per-operation latency of the three Coiote DM calls made by lwm2mOperation
+(device lookup, task POST, session trigger) against a local mTLS server:
+
+* before - module-level requests functions with certificate files, a new TLS handshake per call
+* after  - coiote_client's pooled keep-alive session with an in-memory SSLContext
+
+Usage: python coiote_session_benchmark.py [operations]
+"""
+import os
+import statistics
+import sys
+import time
+
+from local_tls import JsonHandler, LocalTlsServer, add_lambda_to_path, generate_certificate, write_pem_files
+
+
+class CoioteHandler(JsonHandler):
+    def do_GET(self):
+        self.send_json(200, b'["device-id"]')
+
+    def do_POST(self):
+        self.read_body()
+        self.send_json(201 if '/tasksFromTemplates/' in self.path else 200, b'{}')
+
+
+def run_operation_before(rest_uri, certificate_pem, private_key):
+    import requests
+    certificate, key = write_pem_files(certificate_pem, private_key)
+    try:
+        cert = (certificate, key)
+        device_id = requests.get(rest_uri + '/devices', params={'searchCriteria': 'x'},
+                                 cert=cert, verify=False).json()[0]
+        requests.post(rest_uri + '/tasksFromTemplates/device/' + device_id, json={}, cert=cert,
+                      verify=False, timeout=10)
+        requests.post(rest_uri + '/sessions/' + device_id + '/allow-deregistered', cert=cert,
+                      verify=False, timeout=10)
+    finally:
+        os.unlink(certificate)
+        os.unlink(key)
+
+
+def run_operation_after(coiote_client):
+    device_id = coiote_client.coiote_request('GET', '/devices', params={'searchCriteria': 'x'}).json()[0]
+    coiote_client.coiote_request('POST', '/tasksFromTemplates/device/' + device_id, json={}, timeout=10)
+    coiote_client.coiote_request('POST', '/sessions/' + device_id + '/allow-deregistered', timeout=10)
+
+
+def measure(name, operations, run):
+    latencies = []
+    for _ in range(operations):
+        start = time.perf_counter()
+        run()
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    print(f'{name:>6}: mean {statistics.mean(latencies):7.2f} ms, '
+          f'p50 {latencies[len(latencies) // 2]:7.2f} ms, '
+          f'p95 {latencies[int(len(latencies) * 0.95)]:7.2f} ms')
+
+
+def main():
+    import urllib3
+    urllib3.disable_warnings()
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    certificate_pem, private_key = generate_certificate('benchmark')
+
+    with LocalTlsServer(CoioteHandler, client_certificate_pem=certificate_pem) as server:
+        os.environ['coioteDMrestUri'] = server.url
+        add_lambda_to_path('lwm2mOperation')
+        import coiote_client
+        coiote_client.get_user_auth_cert = lambda: coiote_client.UserAuthCert(
+            certificatePem=certificate_pem, privateKey=private_key, versionId='benchmark')
+
+        print(f'{operations} operations, 3 Coiote DM calls each')
+        measure('before', operations, lambda: run_operation_before(coiote_client.get_rest_uri(), certificate_pem,
+                                                                    private_key))
+        measure('after', operations, lambda: run_operation_after(coiote_client))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""
+Local stand-in for the parts of the Coiote DM REST API used by lwm2mOperation, and for the Secrets Manager
+holding the certificate it authenticates with, so the lambda can be run without Coiote DM and AWS:
+
+* GET  /devices?searchCriteria=properties.endpointName eq '<endpoint>'
+* GET  /devices/find/details?limit=<n>&searchCriteria=creationTime gt '<time>' and id gt '<id>'
+  (both conditions optional), devices sorted by id
+* POST /tasksFromTemplates/device/<device id>
+* POST /sessions/<device id>/allow-deregistered
+
+Clients have to authenticate with the certificate stored in the stub secret (mTLS). Latency, errors and
+throttling can be injected with Faults and changed while the server is running.
+
+Usage: python coiote_stand_in.py [--latency-ms MS] [--error-rate FRACTION] [--throttle-rps RPS]
+runs the server until interrupted and prints its URL and the PEMs of the client certificate.
+"""
+import argparse
+import importlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Iterable, List, Optional
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from local_tls import JsonHandler, LocalTlsServer, add_lambda_to_path, generate_certificate
+
+API_PREFIX = '/api/coiotedm/v3'
+SEARCH_CRITERIA = re.compile(r"properties\.endpointName eq '(.*)'")
+LIST_CRITERION = re.compile(r"(creationTime|id) gt '([^']*)'")
+TASK_PATH = re.compile(API_PREFIX + r'/tasksFromTemplates/device/([^/]+)')
+SESSION_PATH = re.compile(API_PREFIX + r'/sessions/([^/]+)/allow-deregistered')
+
+
+@dataclass
+class Faults:
+    # added to every response, uniformly distributed between latencyMs and latencyMs + latencyJitterMs
+    latencyMs: float = 0
+    latencyJitterMs: float = 0
+    # fraction of requests delayed by another slowLatencyMs, to model tail latency
+    slowRate: float = 0
+    slowLatencyMs: float = 0
+    # fraction of requests answered with errorStatus
+    errorRate: float = 0
+    errorStatus: int = 500
+    # requests per second above which 429 is returned, 0 for no limit
+    throttleRps: float = 0
+
+
+class StubSecretsManager:
+    """Answers get_secret_value like Secrets Manager for the coioteDMcert secret."""
+
+    def __init__(self, certificate_pem: str, private_key: str):
+        self.calls = 0
+        self.rotate(certificate_pem, private_key)
+
+    def rotate(self, certificate_pem: str, private_key: str):
+        self.secret_string = json.dumps({'certificatePem': certificate_pem, 'privateKey': private_key})
+        self.version_id = f'version-{self.calls}-{random.getrandbits(32):08x}'
+
+    def get_secret_value(self, SecretId):
+        self.calls += 1
+        return {'Name': SecretId, 'SecretString': self.secret_string, 'VersionId': self.version_id}
+
+
+class CoioteStandIn:
+    """
+    Runs the stand-in in a background thread while used as a context manager. Devices are known by
+    endpoint name; if none are given, every endpoint name is treated as a registered device.
+    """
+
+    def __init__(self, devices: Optional[Iterable[str]] = None, faults: Optional[Faults] = None):
+        self.certificate_pem, self.private_key = generate_certificate('coiote-dm-user')
+        self.secrets_manager = StubSecretsManager(self.certificate_pem, self.private_key)
+        # endpoint name -> creation time (ISO 8601), None if every endpoint name is a registered device
+        self.devices = None
+        if devices is not None:
+            self.devices = {}
+            for endpoint_name in devices:
+                self.add_device(endpoint_name)
+        self.faults = faults or Faults()
+        self.requests = Counter()
+        self._lock = threading.Lock()
+        self._tokens = self.faults.throttleRps
+        self._tokens_updated_at = time.monotonic()
+        handler_class = type('StandInHandler', (CoioteHandler,), {'stand_in': self})
+        self.server = LocalTlsServer(handler_class, client_certificate_pem=self.certificate_pem)
+
+    @property
+    def url(self) -> str:
+        """Value for coioteDMrestUri."""
+        return self.server.url
+
+    def __enter__(self):
+        self.server.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.__exit__(*exc_info)
+
+    def add_device(self, endpoint_name: str):
+        self.devices[endpoint_name] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+    def list_devices(self, limit: int, created_after: str = '', after_id: str = '') -> List[dict]:
+        devices = sorted(('id-' + endpoint_name, endpoint_name) for endpoint_name, created_at
+                         in (self.devices or {}).items() if created_at > created_after)
+        return [{'id': device_id, 'properties': {'endpointName': endpoint_name}}
+                for device_id, endpoint_name in devices if device_id > after_id][:limit]
+
+    def device_id(self, endpoint_name: str) -> Optional[str]:
+        if self.devices is not None and endpoint_name not in self.devices:
+            return None
+        return 'id-' + endpoint_name
+
+    def is_known_device_id(self, device_id: str) -> bool:
+        return device_id.startswith('id-') and self.device_id(device_id[3:]) is not None
+
+    def throttled(self) -> bool:
+        """Token bucket of throttleRps tokens per second and a burst of one second worth of requests."""
+        rate = self.faults.throttleRps
+        if rate <= 0:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(rate, self._tokens + (now - self._tokens_updated_at) * rate)
+            self._tokens_updated_at = now
+            if self._tokens < 1:
+                return True
+            self._tokens -= 1
+            return False
+
+    def count(self, name: str):
+        with self._lock:
+            self.requests[name] += 1
+
+
+class CoioteHandler(JsonHandler):
+    stand_in: CoioteStandIn
+
+    def inject_faults(self) -> bool:
+        """Sleeps for the injected latency and returns True if the request has been answered with an error."""
+        faults = self.stand_in.faults
+        latency = faults.latencyMs + random.uniform(0, faults.latencyJitterMs)
+        if random.random() < faults.slowRate:
+            latency += faults.slowLatencyMs
+        if latency > 0:
+            time.sleep(latency / 1000)
+        if self.stand_in.throttled():
+            self.stand_in.count('throttled')
+            self.send_response(429)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return True
+        if random.random() < faults.errorRate:
+            self.stand_in.count('failed')
+            self.send_json(faults.errorStatus, b'{"error": "injected failure"}')
+            return True
+        return False
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == API_PREFIX + '/devices/find/details':
+            self.list_devices(parse_qs(url.query))
+            return
+        if url.path != API_PREFIX + '/devices':
+            self.send_json(404, b'{}')
+            return
+        self.stand_in.count('devices')
+        if self.inject_faults():
+            return
+        match = SEARCH_CRITERIA.fullmatch(parse_qs(url.query).get('searchCriteria', [''])[0])
+        if match is None:
+            self.send_json(400, b'{"error": "unsupported searchCriteria"}')
+            return
+        device_id = self.stand_in.device_id(match.group(1))
+        self.send_json(200, json.dumps([device_id] if device_id is not None else []).encode('utf-8'))
+
+    def list_devices(self, query):
+        self.stand_in.count('deviceListPages')
+        if self.inject_faults():
+            return
+        criteria = dict(LIST_CRITERION.findall(query.get('searchCriteria', [''])[0]))
+        devices = self.stand_in.list_devices(int(query.get('limit', ['100'])[0]),
+                                             created_after=criteria.get('creationTime', ''),
+                                             after_id=criteria.get('id', ''))
+        self.send_json(200, json.dumps(devices).encode('utf-8'))
+
+    def do_POST(self):
+        self.read_body()
+        path = unquote(urlsplit(self.path).path)
+        for name, pattern, status in (('tasks', TASK_PATH, 201), ('sessions', SESSION_PATH, 200)):
+            match = pattern.fullmatch(path)
+            if match is None:
+                continue
+            self.stand_in.count(name)
+            if self.inject_faults():
+                return
+            if not self.stand_in.is_known_device_id(match.group(1)):
+                self.send_json(404, b'{"error": "device not found"}')
+                return
+            self.send_json(status, b'{}')
+            return
+        self.send_json(404, b'{}')
+
+
+def import_lwm2m_operation(stand_in: CoioteStandIn):
+    """
+    Imports lwm2mOperation's lambda_function set up to talk to the stand-in. Coiote DM's URL is read
+    when the lambda is imported, so this can be done once per process.
+    """
+    os.environ['coioteDMrestUri'] = stand_in.url
+    add_lambda_to_path('lwm2mOperation')
+    coiote_client = importlib.import_module('coiote_client')
+    coiote_client._secrets_manager_client = stand_in.secrets_manager
+    return importlib.import_module('lambda_function')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs a local stand-in of the Coiote DM REST API.')
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--throttle-rps', type=float, default=0)
+    args = parser.parse_args()
+
+    faults = Faults(latencyMs=args.latency_ms, errorRate=args.error_rate, throttleRps=args.throttle_rps)
+    with CoioteStandIn(faults=faults) as stand_in:
+        print(stand_in.certificate_pem + stand_in.private_key)
+        print(f'Listening on {stand_in.url}, press Ctrl+C to stop')
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print(f'Requests: {dict(stand_in.requests)}')
+
+
+if __name__ == '__main__':
+    main()
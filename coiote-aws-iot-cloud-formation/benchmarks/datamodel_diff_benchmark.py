@@ -0,0 +1,83 @@
+"""
+Diffing operation results against the last reported datamodel, as done by the DatamodelDelta lambda,
+for multi-instance objects of 10 to 5000 instances with 5% of the resources changed:
+
+* diff    - flatten the result, diff it against the cached datamodel and split the delta into shadow updates
+* bytes   - size of the full result republished before, and of the shadow updates published now
+
+Every run also checks that the updates fit in the size limit and add up to exactly the changed resources.
+
+Usage: python datamodel_diff_benchmark.py
+"""
+import json
+import random
+import timeit
+
+from local_tls import add_lambda_to_path
+
+add_lambda_to_path('datamodelDelta')
+from datamodel_delta import MAX_UPDATE_BYTES, UPDATE_OVERHEAD  # noqa: E402
+from datamodel_diff import diff, dumps, flatten, split_into_chunks  # noqa: E402
+
+CHANGED_FRACTION = 0.05
+
+
+def generate_datamodel(instances, rng):
+    """A Temperature object (3303) with a multi-instance resource in each instance."""
+    return {'3303': {
+        str(instance): {
+            '5700': round(rng.uniform(-20, 40), 2),
+            '5701': 'Cel',
+            '5601': round(rng.uniform(-20, 0), 2),
+            '5602': round(rng.uniform(20, 40), 2),
+            '5750': f'sensor {instance}',
+            '5800': {str(i): rng.randrange(1000) for i in range(4)},
+        } for instance in range(instances)}}
+
+
+def change_resources(datamodel, rng):
+    changed = json.loads(json.dumps(datamodel))
+    for instance in changed['3303'].values():
+        if rng.random() < CHANGED_FRACTION * 2:
+            instance['5700'] = round(rng.uniform(-20, 40), 2)
+        if rng.random() < CHANGED_FRACTION:
+            instance['5800'][str(rng.randrange(4))] = rng.randrange(1000)
+    return changed
+
+
+def compute_updates(cached, result):
+    return split_into_chunks(diff(cached, flatten(result)), MAX_UPDATE_BYTES, UPDATE_OVERHEAD)
+
+
+def best_of(function, *args):
+    timer = timeit.Timer(lambda: function(*args))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=3, number=number)) / number * 1000
+
+
+def check(cached, result, updates):
+    published = {}
+    for update in updates:
+        assert len(dumps({'state': {'reported': update}})) <= MAX_UPDATE_BYTES
+        published.update(flatten(update))
+    assert published == diff(cached, flatten(result))
+    assert {**cached, **published} == flatten(result)
+
+
+def main():
+    rng = random.Random(0)
+    for instances in (10, 100, 1000, 5000):
+        previous = generate_datamodel(instances, rng)
+        result = change_resources(previous, rng)
+        cached = flatten(previous)
+        updates = compute_updates(cached, result)
+        check(cached, result, updates)
+
+        full_bytes = len(dumps({'state': {'reported': result}}))
+        delta_bytes = sum(len(dumps({'state': {'reported': update}})) for update in updates)
+        print(f'{instances:>5} instances, {len(cached):>6} resources: diff {best_of(compute_updates, cached, result):8.3f} ms, '
+              f'bytes {full_bytes:>7} before, {delta_bytes:>6} after in {len(updates)} updates')
+
+
+if __name__ == '__main__':
+    main()
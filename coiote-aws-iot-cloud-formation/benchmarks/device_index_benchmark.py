@@ -0,0 +1,100 @@
+"""
+Device id index (lwm2mOperation/device_index.py and sync_device_index.py):
+
+* index - size of an index of a synthetic fleet, time to write and open it, and lookup latency
+          of hits and misses compared with a dict
+* sync  - full and incremental sync against the Coiote DM stand-in: Coiote DM pages fetched and time taken
+* cold  - Coiote DM device lookups made by a fresh container handling one operation per device,
+          without and with the index
+
+Usage: python device_index_benchmark.py [--devices N] [--synced-devices N]
+"""
+import argparse
+import contextlib
+import os
+import random
+import tempfile
+import time
+from datetime import timedelta
+
+from coiote_stand_in import CoioteStandIn, import_lwm2m_operation
+from lambda_load_benchmark import LambdaContext
+
+
+def benchmark_index(devices: int, path: str):
+    from device_index import open_index, write_index
+    entries = {f'urn:imei:{random.getrandbits(48):015d}': f'device-{i}' for i in range(devices)}
+
+    start = time.perf_counter()
+    write_index(path, entries.items(), {'syncedAt': 'benchmark'})
+    write_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    index = open_index(path)
+    open_ms = (time.perf_counter() - start) * 1000
+    print(f'index: {devices} devices, {os.path.getsize(path) / 2 ** 20:.1f} MiB, '
+          f'written in {write_ms:.0f} ms, opened in {open_ms:.3f} ms')
+
+    hits = random.sample(list(entries), min(100000, devices))
+    misses = [f'urn:imei:missing-{i}' for i in range(len(hits))]
+    for name, lookup in (('index', index.get), ('dict', entries.get)):
+        for kind, keys in (('hit', hits), ('miss', misses)):
+            start = time.perf_counter()
+            for key in keys:
+                lookup(key)
+            print(f'  {name:>5} {kind:>4}: {(time.perf_counter() - start) / len(keys) * 1e6:6.2f} us per lookup')
+    index.close()
+
+
+def benchmark_sync(stand_in: CoioteStandIn, synced_devices: int, path: str):
+    import sync_device_index
+    for i in range(synced_devices):
+        stand_in.add_device(f'device-{i}')
+
+    for name, full in (('full', True), ('incremental', False)):
+        # the stand-in's creation times have a resolution of a second
+        time.sleep(1.1)
+        stand_in.requests.clear()
+        start = time.perf_counter()
+        fetched, indexed = sync_device_index.sync(path, full=full, overlap=timedelta(0))
+        print(f'sync {name:>11}: {fetched} devices fetched in {stand_in.requests["deviceListPages"]} pages, '
+              f'{(time.perf_counter() - start) * 1000:.0f} ms, {indexed} devices in the index')
+        # devices registered between the syncs
+        time.sleep(1.1)
+        for i in range(synced_devices, synced_devices + 100):
+            stand_in.add_device(f'device-{i}')
+
+
+def benchmark_cold_lookups(stand_in: CoioteStandIn, lambda_function, path: str, operations: int):
+    from device_index import open_index
+    for name, index in (('without index', None), ('with index', open_index(path))):
+        # a fresh container
+        lambda_function.get_device_id_cache().clear()
+        lambda_function._device_index = index
+        stand_in.requests.clear()
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for i in range(operations):
+                event = {'thingName': f'device-{i}', 'operation': 'read', 'keys': ['3.0.0']}
+                lambda_function.lambda_handler(event, LambdaContext())
+        print(f'cold {name:>13}: {stand_in.requests["devices"]} device lookups in Coiote DM, '
+              f'{(time.perf_counter() - start) * 1000 / operations:.2f} ms per operation')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the device id index and its sync.')
+    parser.add_argument('--devices', type=int, default=1000000, help='devices in the synthetic index')
+    parser.add_argument('--synced-devices', type=int, default=20000, help='devices in the stand-in')
+    args = parser.parse_args()
+
+    import urllib3
+    urllib3.disable_warnings()
+    with tempfile.TemporaryDirectory() as directory, CoioteStandIn(devices=[]) as stand_in:
+        lambda_function = import_lwm2m_operation(stand_in)
+        benchmark_index(args.devices, os.path.join(directory, 'synthetic.bin'))
+        path = os.path.join(directory, 'device_index.bin')
+        benchmark_sync(stand_in, args.synced_devices, path)
+        benchmark_cold_lookups(stand_in, lambda_function, path, min(500, args.synced_devices))
+
+
+if __name__ == '__main__':
+    main()
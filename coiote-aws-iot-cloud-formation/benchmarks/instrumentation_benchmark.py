@@ -0,0 +1,75 @@
+"""
+Overhead of the instrumentation layer, checked against the budget stated in instrumentation.py:
+
+* invocation - a no-op handler decorated with instrumented(), logging every invocation, minus the bare handler
+* phase      - a phase() block inside an invocation, minus an empty block
+
+Logged lines are written to /dev/null. Exits with status 1 if either is over budget.
+
+Usage: python instrumentation_benchmark.py
+"""
+import contextlib
+import os
+import sys
+import timeit
+
+from local_tls import add_lambda_to_path
+
+add_lambda_to_path(os.path.join('instrumentationLayer', 'python'))
+import instrumentation  # noqa: E402
+
+INVOCATION_BUDGET_US = 50
+PHASE_BUDGET_US = 2
+PHASES_PER_INVOCATION = 5
+
+
+def bare_handler(event, context):
+    return {'statusCode': 201, 'body': ''}
+
+
+@instrumentation.instrumented('benchmark')
+def instrumented_handler(event, context):
+    instrumentation.set_dimension('operation', 'read')
+    instrumentation.count('sessionTriggersSent')
+    for name in ('secretFetch', 'sslContext', 'deviceLookup', 'taskPost', 'sessionTrigger'):
+        with instrumentation.phase(name):
+            pass
+    return {'statusCode': 201, 'body': ''}
+
+
+def phases_handler(event, context):
+    for _ in range(PHASES_PER_INVOCATION):
+        with instrumentation.phase('taskPost'):
+            pass
+
+
+def empty_blocks_handler(event, context):
+    for _ in range(PHASES_PER_INVOCATION):
+        with contextlib.nullcontext():
+            pass
+
+
+def microseconds(function):
+    timer = timeit.Timer(lambda: function({}, None))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=5, number=number)) / number * 1e6
+
+
+def main():
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        invocation = microseconds(instrumented_handler) - microseconds(bare_handler)
+        # phases are measured within an invocation that is never logged
+        instrumentation._current = instrumentation.Invocation('benchmark', False)
+        phase = (microseconds(phases_handler) - microseconds(empty_blocks_handler)) / PHASES_PER_INVOCATION
+        instrumentation._current = None
+
+    within_budget = invocation <= INVOCATION_BUDGET_US and phase <= PHASE_BUDGET_US
+    print(f'invocation with {PHASES_PER_INVOCATION} phases, logged: {invocation:6.2f} us '
+          f'(budget {INVOCATION_BUDGET_US} us)')
+    print(f'phase: {phase:6.2f} us (budget {PHASE_BUDGET_US} us)')
+    print('within budget' if within_budget else 'OVER BUDGET')
+    sys.exit(0 if within_budget else 1)
+
+
+if __name__ == '__main__':
+    main()
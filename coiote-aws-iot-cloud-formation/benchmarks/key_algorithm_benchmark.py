@@ -0,0 +1,76 @@
+"""
+Cost of each key algorithm supported by the certificates custom resource:
+
+* keygen    - generating the key of the Coiote DM user authentication certificate
+* handshake - a request over a new mTLS connection to a local server, authenticating with that certificate
+
+Usage: python key_algorithm_benchmark.py [handshakes per algorithm]
+"""
+import http.client
+import os
+import ssl
+import statistics
+import sys
+import time
+
+from local_tls import JsonHandler, LocalTlsServer, add_lambda_to_path, generate_certificate, write_pem_files
+
+add_lambda_to_path('certificates')
+from keys import KEY_ALGORITHMS, generate_private_key  # noqa: E402
+
+KEYGEN_REPEATS = {'RSA-4096': 3}
+
+
+class OkHandler(JsonHandler):
+    def do_GET(self):
+        self.send_json(200, b'{}')
+
+
+def client_context(certificate_pem, private_key):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    certificate_file, private_key_file = write_pem_files(certificate_pem, private_key)
+    try:
+        context.load_cert_chain(certificate_file, private_key_file)
+    finally:
+        os.unlink(certificate_file)
+        os.unlink(private_key_file)
+    return context
+
+
+def measure_keygen(key_algorithm):
+    timings = []
+    for _ in range(KEYGEN_REPEATS.get(key_algorithm, 20)):
+        start = time.perf_counter()
+        generate_private_key(key_algorithm)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.mean(timings)
+
+
+def measure_handshake(key_algorithm, handshakes):
+    certificate_pem, private_key = generate_certificate('benchmark', generate_private_key(key_algorithm))
+    context = client_context(certificate_pem, private_key)
+    with LocalTlsServer(OkHandler, client_certificate_pem=certificate_pem) as server:
+        port = server.httpd.server_address[1]
+        timings = []
+        for _ in range(handshakes):
+            start = time.perf_counter()
+            connection = http.client.HTTPSConnection('127.0.0.1', port, context=context)
+            connection.request('GET', '/')
+            connection.getresponse().read()
+            connection.close()
+            timings.append((time.perf_counter() - start) * 1000)
+    return statistics.mean(timings)
+
+
+def main():
+    handshakes = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    print(f'keygen: mean of up to 20 keys, handshake: mean of {handshakes} new connections')
+    for key_algorithm in KEY_ALGORITHMS:
+        print(f'{key_algorithm:>10}: keygen {measure_keygen(key_algorithm):9.2f} ms, '
+              f'handshake {measure_handshake(key_algorithm, handshakes):7.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
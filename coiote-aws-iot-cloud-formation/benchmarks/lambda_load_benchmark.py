@@ -0,0 +1,140 @@
+"""
+End-to-end load benchmark of lwm2mOperation's lambda_handler against the local Coiote DM stand-in.
+Synthetic operation shadow events (the ones OperationRequestRule passes to the lambda) are replayed at
+a target rate by a pool of workers sharing one warm lambda module, like concurrent invocations would.
+
+Reports the achieved invocations per second, response status codes and p50/p95/p99 latency of:
+
+* lookup  - device id lookups (GET /devices), only on device id cache misses
+* task    - task scheduling (POST /tasksFromTemplates/device/...)
+* session - session triggers (POST /sessions/.../allow-deregistered)
+* handler - the whole lambda_handler call
+* total   - from the time the event was due to the end of the call, including waiting for a free worker
+
+Usage: python lambda_load_benchmark.py [--rate INVOCATIONS_PER_SECOND] [--duration SECONDS] [--workers N]
+       [--devices N] [--latency-ms MS] [--jitter-ms MS] [--slow-rate FRACTION] [--slow-latency-ms MS]
+       [--error-rate FRACTION] [--error-status CODE] [--throttle-rps RPS]
+"""
+import argparse
+import contextlib
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from coiote_stand_in import CoioteStandIn, Faults, import_lwm2m_operation
+
+PHASES = ('lookup', 'task', 'session', 'handler', 'total')
+PATH_PHASES = (('/devices', 'lookup'), ('/tasksFromTemplates/', 'task'), ('/sessions/', 'session'))
+
+
+class LambdaContext:
+    def __init__(self, timeout_ms: int = 60000):
+        self.deadline = time.monotonic() + timeout_ms / 1000
+
+    def get_remaining_time_in_millis(self) -> int:
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+class PhaseTimings:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def record(self, phase: str, seconds: float):
+        with self._lock:
+            self.latencies[phase].append(seconds * 1000)
+
+    def timed_request(self, coiote_request):
+        """Wraps coiote_request, timing each call as the phase its path belongs to."""
+
+        def request(method, path, **kwargs):
+            phase = next((phase for prefix, phase in PATH_PHASES if path.startswith(prefix)), 'other')
+            start = time.perf_counter()
+            try:
+                return coiote_request(method, path, **kwargs)
+            finally:
+                self.record(phase, time.perf_counter() - start)
+
+        return request
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def synthetic_event(sequence: int, devices: int) -> dict:
+    return {
+        'thingName': f'device-{sequence % devices}',
+        'operation': 'read',
+        'keys': ['3.0.0', f'3303.{sequence % 4}.5700'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays synthetic operation events against a local Coiote DM.')
+    parser.add_argument('--rate', type=float, default=100, help='target invocations per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--latency-ms', type=float, default=5)
+    parser.add_argument('--jitter-ms', type=float, default=5)
+    parser.add_argument('--slow-rate', type=float, default=0)
+    parser.add_argument('--slow-latency-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--throttle-rps', type=float, default=0)
+    args = parser.parse_args()
+
+    import urllib3
+    urllib3.disable_warnings()
+    faults = Faults(latencyMs=args.latency_ms, latencyJitterMs=args.jitter_ms, slowRate=args.slow_rate,
+                    slowLatencyMs=args.slow_latency_ms, errorRate=args.error_rate, errorStatus=args.error_status,
+                    throttleRps=args.throttle_rps)
+    with CoioteStandIn(faults=faults) as stand_in:
+        lambda_function = import_lwm2m_operation(stand_in)
+        timings = PhaseTimings()
+        lambda_function.coiote_request = timings.timed_request(lambda_function.coiote_request)
+        statuses = Counter()
+        statuses_lock = threading.Lock()
+
+        def invoke(event, due):
+            start = time.perf_counter()
+            try:
+                status = lambda_function.lambda_handler(event, LambdaContext())['statusCode']
+            except Exception as e:
+                status = type(e).__name__
+            end = time.perf_counter()
+            with statuses_lock:
+                statuses[status] += 1
+            timings.record('handler', end - start)
+            timings.record('total', end - due)
+
+        invocations = int(args.rate * args.duration)
+        print(f'{invocations} invocations at {args.rate:g}/s over {args.workers} workers, {args.devices} devices, '
+              f'{faults}')
+        start = time.perf_counter()
+        # the lambda logs every invocation
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+                ThreadPoolExecutor(max_workers=args.workers) as executor:
+            for sequence in range(invocations):
+                due = start + sequence / args.rate
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(invoke, synthetic_event(sequence, args.devices), due)
+        elapsed = time.perf_counter() - start
+
+    print(f'{invocations / elapsed:.1f} invocations/s, status codes: {dict(statuses)}, '
+          f'Coiote DM requests: {dict(stand_in.requests)}')
+    for phase in PHASES + ('other',):
+        latencies = sorted(timings.latencies.get(phase, []))
+        if not latencies:
+            continue
+        print(f'{phase:>8}: {len(latencies):6} calls, p50 {percentile(latencies, 0.5):8.2f} ms, '
+              f'p95 {percentile(latencies, 0.95):8.2f} ms, p99 {percentile(latencies, 0.99):8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
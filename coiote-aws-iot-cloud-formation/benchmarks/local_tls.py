@@ -0,0 +1,119 @@
+"""
+Helpers for running benchmarks against a local HTTPS server instead of Coiote DM.
+Requires the cryptography package (see certificates/requirements.txt).
+"""
+import datetime
+import os
+import ssl
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tempfile import NamedTemporaryFile
+from typing import Tuple, Type
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+LAMBDAS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def add_lambda_to_path(lambda_dir: str):
+    """Makes the lambda's modules importable, along with the layer the lambdas are deployed with."""
+    sys.path.insert(0, os.path.join(LAMBDAS_DIR, lambda_dir))
+    layer_dir = os.path.join(LAMBDAS_DIR, 'instrumentationLayer', 'python')
+    if layer_dir not in sys.path:
+        sys.path.append(layer_dir)
+
+
+def generate_certificate(common_name: str, private_key=None) -> Tuple[str, str]:
+    """Returns a self-signed (certificatePem, privateKey) pair, P-256 unless a key is given."""
+    if private_key is None:
+        private_key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.datetime.utcnow()
+    cert = x509.CertificateBuilder() \
+        .subject_name(name) \
+        .issuer_name(name) \
+        .public_key(private_key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now - datetime.timedelta(days=1)) \
+        .not_valid_after(now + datetime.timedelta(days=1)) \
+        .sign(private_key, hashes.SHA256())
+    return (
+        cert.public_bytes(serialization.Encoding.PEM).decode('utf-8'),
+        private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        ).decode('utf-8')
+    )
+
+
+def write_pem_files(certificate_pem: str, private_key: str) -> Tuple[str, str]:
+    """Writes the pair to temporary files, the caller is responsible for removing them."""
+    certificate_file = NamedTemporaryFile(delete=False, suffix='.pem')
+    private_key_file = NamedTemporaryFile(delete=False, suffix='.key')
+    with certificate_file, private_key_file:
+        certificate_file.write(certificate_pem.encode('utf-8'))
+        private_key_file.write(private_key.encode('utf-8'))
+    return certificate_file.name, private_key_file.name
+
+
+class LocalTlsServer:
+    """
+    Threaded HTTP/1.1 (keep-alive) server over TLS, running in a background thread.
+    If client_certificate_pem is given, clients have to authenticate with that certificate.
+    """
+
+    def __init__(self, handler_class: Type[BaseHTTPRequestHandler], client_certificate_pem: str = None,
+                 server_private_key=None):
+        handler_class.protocol_version = 'HTTP/1.1'
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+        self.httpd.daemon_threads = True
+
+        certificate_file, private_key_file = write_pem_files(
+            *generate_certificate('localhost', server_private_key))
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        try:
+            context.load_cert_chain(certificate_file, private_key_file)
+        finally:
+            os.unlink(certificate_file)
+            os.unlink(private_key_file)
+        if client_certificate_pem is not None:
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.load_verify_locations(cadata=client_certificate_pem)
+        self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f'https://127.0.0.1:{self.httpd.server_address[1]}'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class JsonHandler(BaseHTTPRequestHandler):
+    # headers and body are written separately, with Nagle's algorithm every
+    # keep-alive response would be delayed until the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def send_json(self, code: int, body: bytes):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,56 @@
+"""
+CPU cost of building the Coiote DM request body for every operation supported by lwm2mOperation,
+i.e. operations.build_operation_body, which runs on every invocation before any network call.
+
+Usage: python operations_benchmark.py [keys per operation]
+"""
+import sys
+import time
+
+from local_tls import add_lambda_to_path
+
+add_lambda_to_path('lwm2mOperation')
+import operations  # noqa: E402
+
+
+def sample_events(key_count):
+    keys = [f'3303.{instance}.5700' for instance in range(key_count)]
+    attributes = [{'pmin': 10, 'pmax': 60}] * key_count
+    return {
+        'write': {'keys': keys, 'values': list(range(key_count))},
+        'read': {'keys': keys},
+        'readComposite': {'keys': keys},
+        'observe': {'keys': keys, 'attributes': attributes},
+        'observeComposite': {'keys': keys},
+        'execute': {'keys': ['3.0.4'], 'arguments': "0='1'"},
+        'cancelObserve': {'keys': keys},
+        'cancelObserveComposite': {'keys': keys},
+        'writeAttributes': {'keys': keys, 'attributes': attributes},
+    }
+
+
+def cpu_time_per_call(event, min_duration=0.2):
+    calls = 0
+    start = time.process_time()
+    elapsed = 0.0
+    while elapsed < min_duration:
+        for _ in range(100):
+            operations.build_operation_body(event)
+        calls += 100
+        elapsed = time.process_time() - start
+    return elapsed / calls * 1e6
+
+
+def main():
+    key_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    assert set(sample_events(0)) == set(operations.OPERATION_SPECS), 'benchmark is missing an operation'
+    print(f'{key_count} keys per operation, CPU time per build_operation_body call')
+    for operation, event in sample_events(key_count).items():
+        event['operation'] = operation
+        body, error = operations.build_operation_body(event)
+        assert error is None, error
+        print(f'{operation:>24}: {cpu_time_per_call(event):9.2f} us')
+
+
+if __name__ == '__main__':
+    main()
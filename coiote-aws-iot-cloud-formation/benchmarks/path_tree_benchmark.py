@@ -0,0 +1,78 @@
+"""
+Prefix pruning of LwM2M paths (as done for read, readComposite and observe) at 10, 1k and 100k paths:
+
+* before - the sort and nested del loop previously inlined in lambda_handler, O(n^2)
+* tree   - lwm2m_paths.PathTree, as used for observe
+* after  - lwm2m_paths.prune_paths, a sort and a single scan
+
+Usage: python path_tree_benchmark.py
+"""
+import random
+import timeit
+
+from local_tls import add_lambda_to_path
+
+add_lambda_to_path('lwm2mOperation')
+from lwm2m_paths import PathTree, prune_paths  # noqa: E402
+
+# the quadratic implementation is not run above this many paths, as it would take minutes
+LEGACY_LIMIT = 10000
+
+
+def legacy_prune_paths(keys):
+    keys = [key if key.endswith('.') else key + '.' for key in keys]
+    keys = list(set(keys))
+    keys.sort()
+    i = 0
+    jEnd = len(keys)
+    for key in keys:
+        j = i+1
+        while j < jEnd:
+            if keys[j].startswith(key):
+                del keys[j]
+                j -= 1
+                jEnd -= 1
+            j += 1
+        i += 1
+    return [key[:-1] for key in keys]
+
+
+def tree_prune_paths(keys):
+    tree = PathTree()
+    for key in keys:
+        tree.add(key)
+    return tree.paths()
+
+
+def generate_paths(count, seed=0):
+    rng = random.Random(seed)
+    paths = []
+    for _ in range(count):
+        depth = rng.choice((2, 3, 3, 3, 4))
+        segments = [rng.randrange(3300, 3350), rng.randrange(100), rng.randrange(5700, 5760), rng.randrange(4)]
+        paths.append('.'.join(str(segment) for segment in segments[:depth]))
+    return paths
+
+
+def best_of(function, paths):
+    timer = timeit.Timer(lambda: function(paths))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=3, number=number)) / number * 1000
+
+
+def main():
+    for count in (10, 1000, 100000):
+        paths = generate_paths(count)
+        after = best_of(prune_paths, paths)
+        tree = best_of(tree_prune_paths, paths)
+        assert sorted(tree_prune_paths(paths)) == prune_paths(paths)
+        if count <= LEGACY_LIMIT:
+            assert legacy_prune_paths(paths) == prune_paths(paths)
+            before = f'{best_of(legacy_prune_paths, paths):10.3f} ms'
+        else:
+            before = '   skipped'
+        print(f'{count:>6} paths: before {before}, tree {tree:10.3f} ms, after {after:10.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
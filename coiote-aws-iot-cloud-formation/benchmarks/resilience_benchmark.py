@@ -0,0 +1,83 @@
+"""
+Behaviour of lwm2mOperation's Coiote DM calls under injected faults, with the resilience layer
+(retries, hedged device lookups, circuit breaker) enabled and disabled:
+
+* tail   - 5% of requests take an extra second; hedging should cut the lookup tail
+* errors - 20% of requests are answered with 503; retries should turn most of them into successes
+* outage - every request fails; the circuit breaker should make invocations fail fast with 503
+
+Every invocation is for a different device, so each one looks its device up in Coiote DM.
+
+Usage: python resilience_benchmark.py [--invocations N] [--workers N]
+"""
+import argparse
+import contextlib
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from coiote_stand_in import CoioteStandIn, Faults, import_lwm2m_operation
+from lambda_load_benchmark import LambdaContext, percentile
+
+SCENARIOS = {
+    'tail': Faults(latencyMs=5, latencyJitterMs=5, slowRate=0.05, slowLatencyMs=1000),
+    'errors': Faults(latencyMs=5, latencyJitterMs=5, errorRate=0.2, errorStatus=503),
+    'outage': Faults(latencyMs=50, errorRate=1.0),
+}
+
+
+def configure(lambda_function, resilient: bool):
+    from resilience import CircuitBreaker
+    lambda_function.RETRY_ATTEMPTS.set(3 if resilient else 1)
+    lambda_function.RETRY_BASE_DELAY_MS.set(100)
+    lambda_function.HEDGE_DELAY_MS.set(50 if resilient else 0)
+    lambda_function.coiote_breaker = CircuitBreaker(failure_threshold=5 if resilient else 1 << 30,
+                                                    open_seconds=30)
+
+
+def run(lambda_function, scenario: str, invocations: int, workers: int):
+    statuses = Counter()
+    latencies = []
+
+    def invoke(sequence):
+        event = {'thingName': f'{scenario}-{sequence}', 'operation': 'read', 'keys': ['3.0.0']}
+        start = time.perf_counter()
+        try:
+            status = lambda_function.lambda_handler(event, LambdaContext(timeout_ms=10000))['statusCode']
+        except Exception as e:
+            status = type(e).__name__
+        latencies.append((time.perf_counter() - start) * 1000)
+        statuses[status] += 1
+
+    # the lambda logs every invocation
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        executor.map(invoke, range(invocations))
+    return statuses, sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs lwm2mOperation against a faulty local Coiote DM.')
+    parser.add_argument('--invocations', type=int, default=400)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    import urllib3
+    urllib3.disable_warnings()
+    with CoioteStandIn() as stand_in:
+        lambda_function = import_lwm2m_operation(stand_in)
+        for scenario, faults in SCENARIOS.items():
+            stand_in.faults = faults
+            for resilient in (False, True):
+                configure(lambda_function, resilient)
+                stand_in.requests.clear()
+                statuses, latencies = run(lambda_function, f'{scenario}-{resilient}', args.invocations,
+                                          args.workers)
+                print(f'{scenario:>6} {"resilient" if resilient else "baseline":>9}: '
+                      f'p50 {percentile(latencies, 0.5):7.1f} ms, p99 {percentile(latencies, 0.99):7.1f} ms, '
+                      f'status codes {dict(statuses)}, Coiote DM requests {dict(stand_in.requests)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Decoding SenML read results of a Temperature object (3303) with 100 to 5000 instances (datamodelDelta/senml.py):
+
+* rate   - records decoded per second from SenML JSON and CBOR; for JSON also parsing the whole payload
+           with json.loads first, as consumers of the results did so far
+* memory - peak memory allocated while decoding, measured with tracemalloc
+* bytes  - size of the payload and of the datamodel document written to the shadow, exact and compact
+
+Usage: python senml_benchmark.py
+"""
+import base64
+import json
+import random
+import struct
+import timeit
+import tracemalloc
+
+from local_tls import add_lambda_to_path
+
+add_lambda_to_path('datamodelDelta')
+from datamodel_diff import dumps, unflatten  # noqa: E402
+from senml import Resolver, decode_result, iter_cbor_records, iter_json_records  # noqa: E402
+
+# SenML CBOR labels
+BN, BT, N, V, VS, T = -2, -3, 0, 2, 3, 6
+
+
+def float32(value):
+    return struct.unpack('f', struct.pack('f', value))[0]
+
+
+def generate_records(instances, rng):
+    """Float32 readings, as a device encoding SenML CBOR would send them, with a base name per instance."""
+    records = [{'bt': 1700000000.0}]
+    for instance in range(instances):
+        records += [
+            {'bn': f'/3303/{instance}/', 'n': '5700', 'v': float32(rng.uniform(-20, 40)), 't': float(instance % 60)},
+            {'n': '5701', 'vs': 'Cel'},
+            {'n': '5601', 'v': float32(rng.uniform(-20, 0))},
+            {'n': '5602', 'v': float32(rng.uniform(20, 40))},
+            {'n': '5603', 'v': -40},
+            {'n': '5604', 'v': 125},
+            {'n': '5750', 'vs': f'sensor {instance}'},
+        ]
+    return records
+
+
+def cbor_head(major, argument):
+    if argument < 24:
+        return bytes([major << 5 | argument])
+    for info, size in ((24, 1), (25, 2), (26, 4), (27, 8)):
+        if argument < 1 << (8 * size):
+            return bytes([major << 5 | info]) + argument.to_bytes(size, 'big')
+
+
+def cbor_item(value):
+    if isinstance(value, str):
+        encoded = value.encode('utf-8')
+        return cbor_head(3, len(encoded)) + encoded
+    if isinstance(value, int):
+        return cbor_head(0, value) if value >= 0 else cbor_head(1, -1 - value)
+    if value == float32(value):
+        return b'\xfa' + struct.pack('>f', value)
+    return b'\xfb' + struct.pack('>d', value)
+
+
+def encode_cbor(records):
+    labels = {'bn': BN, 'bt': BT, 'n': N, 'v': V, 'vs': VS, 't': T}
+    encoded = bytearray(cbor_head(4, len(records)))
+    for record in records:
+        encoded += cbor_head(5, len(record))
+        for label, value in record.items():
+            encoded += cbor_item(labels[label]) + cbor_item(value)
+    return bytes(encoded)
+
+
+def parse_whole(payload):
+    resolver = Resolver()
+    return [record for record in map(resolver.resolve, (fields.items() for fields in json.loads(payload)))
+            if record is not None]
+
+
+def peak_memory(function, *args):
+    tracemalloc.start()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    rng = random.Random(0)
+    print(f'{"instances":>9} {"records":>8} {"decoder":>18} {"records/s":>11} {"peak memory":>12}')
+    for instances in (100, 1000, 5000):
+        records = generate_records(instances, rng)
+        json_payload = json.dumps(records)
+        cbor_payload = encode_cbor(records)
+
+        decoders = (
+            ('json.loads + list', lambda: parse_whole(json_payload)),
+            ('JSON streaming', lambda: sum(1 for _ in iter_json_records(json_payload))),
+            ('CBOR streaming', lambda: sum(1 for _ in iter_cbor_records(cbor_payload))),
+            ('CBOR compact', lambda: sum(1 for _ in iter_cbor_records(cbor_payload, compact_floats=True))),
+        )
+        count = sum(1 for _ in iter_json_records(json_payload))
+        assert count == sum(1 for _ in iter_cbor_records(cbor_payload))
+        for name, decode in decoders:
+            seconds = min(timeit.repeat(decode, number=1, repeat=5))
+            print(f'{instances:9} {count:8} {name:>18} {count / seconds:11.0f} '
+                  f'{peak_memory(decode) / 1024:9.0f} KiB')
+
+        exact = dumps(unflatten(decode_result(json_payload).items()))
+        compact = dumps(unflatten(decode_result(base64.b64encode(cbor_payload).decode(), compact=True).items()))
+        print(f'{"":9} payload: JSON {len(json_payload)} B, CBOR {len(cbor_payload)} B; '
+              f'shadow document: exact {len(exact)} B, compact {len(compact)} B')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""
+Cold start cost of each lambda, checked against a budget so that it does not quietly grow again:
+
+* import - importing the handler module, i.e. the Lambda init phase
+* first  - the first invocation, which creates the AWS clients and imports what the handler needs on first use
+* second - the second invocation, for comparison
+
+Every scenario runs in a fresh interpreter. AWS API calls are answered locally (botocore's
+_make_api_call is replaced), lwm2mOperation talks to the Coiote DM stand-in, so only the cost of the
+lambdas' own code and dependencies is measured. Budgets are for a developer machine, the Lambda runtime
+is usually slower; exits with status 1 if any scenario is over budget.
+
+Usage: python startup_benchmark.py
+"""
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+from unittest import mock
+
+LAMBDAS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYER_DIR = os.path.join(LAMBDAS_DIR, 'instrumentationLayer', 'python')
+
+# (import, first invocation) budgets in milliseconds
+BUDGETS = {
+    'lwm2mOperation-deviceState': (60, 20),
+    'lwm2mOperation-read': (60, 400),
+    'createThing': (30, 400),
+    'certificates-delete': (300, 400),
+}
+
+AWS_ENVIRONMENT = {
+    'AWS_DEFAULT_REGION': 'eu-central-1',
+    'AWS_ACCESS_KEY_ID': 'benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'benchmark',
+}
+
+
+class LambdaContext:
+    invoked_function_arn = 'arn:aws:lambda:eu-central-1:000000000000:function:benchmark'
+    log_stream_name = 'benchmark'
+    aws_request_id = 'benchmark'
+
+    def get_remaining_time_in_millis(self) -> int:
+        return 60000
+
+
+def fake_aws(responses):
+    """Answers AWS API calls by operation name, e.g. {'GetSecretValue': {...}}."""
+
+    def make_api_call(client, operation_name, api_params):
+        response = responses[operation_name]
+        return response() if callable(response) else response
+
+    return mock.patch('botocore.client.BaseClient._make_api_call', make_api_call)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+def import_handler(lambda_dir, module_name):
+    sys.path[:0] = [os.path.join(LAMBDAS_DIR, lambda_dir), LAYER_DIR]
+    start = time.perf_counter()
+    module = __import__(module_name)
+    return module, (time.perf_counter() - start) * 1000
+
+
+def run_lwm2m_operation(event):
+    lambda_function, import_ms = import_handler('lwm2mOperation', 'lambda_function')
+
+    # imported only now, so that the stand-in's dependencies do not make the lambda's import look cheaper
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import urllib3
+    from coiote_stand_in import CoioteStandIn
+    urllib3.disable_warnings()
+    with CoioteStandIn() as stand_in:
+        os.environ['coioteDMrestUri'] = stand_in.url
+        secret = stand_in.secrets_manager
+        with fake_aws({'GetSecretValue': lambda: secret.get_secret_value(SecretId='coioteDMcert')}):
+            first_ms = timed(lambda_function.lambda_handler, event, LambdaContext())
+            second_ms = timed(lambda_function.lambda_handler, event, LambdaContext())
+    return import_ms, first_ms, second_ms
+
+
+def run_create_thing():
+    create_thing, import_ms = import_handler('createThing', 'create_thing')
+    event = {'coioteDeviceId': 'benchmark', 'coioteDeviceType': 'benchmark'}
+    with fake_aws({
+        'ListThingTypes': {'thingTypes': [{'thingTypeName': 'benchmark'}]},
+        'CreateThing': {},
+        'UpdateThingShadow': lambda: {'payload': io.BytesIO(b'{}')},
+    }):
+        first_ms = timed(create_thing.lambda_handler, event, LambdaContext())
+        second_ms = timed(create_thing.lambda_handler, event, LambdaContext())
+    return import_ms, first_ms, second_ms
+
+
+def run_certificates_delete():
+    os.environ.update({'coioteDMrestUri': 'https://127.0.0.1:1', 'coioteDMrestUsername': 'benchmark',
+                       'coioteDMrestPassword': 'benchmark'})
+    certificates, import_ms = import_handler('certificates', 'certificates')
+    # the responses to CloudFormation and Coiote DM are not sent
+    certificates.helper._send = lambda *args, **kwargs: None
+    event = {
+        'RequestType': 'Delete',
+        'ResponseURL': 'https://127.0.0.1:1/response',
+        'StackId': 'arn:aws:cloudformation:eu-central-1:000000000000:stack/benchmark/0',
+        'RequestId': 'benchmark',
+        'LogicalResourceId': 'CertificateCustomResource',
+        'PhysicalResourceId': 'benchmark',
+        'ResourceProperties': {},
+    }
+    with fake_aws({
+        'GetSecretValue': {'SecretString': '"certificate-id"'},
+        'UpdateCertificate': {},
+        'DeleteCertificate': {},
+        'DeleteSecret': {},
+    }), mock.patch('requests.delete'):
+        first_ms = timed(certificates.handler, event, LambdaContext())
+        second_ms = timed(certificates.handler, event, LambdaContext())
+    return import_ms, first_ms, second_ms
+
+
+SCENARIOS = {
+    'lwm2mOperation-deviceState': lambda: run_lwm2m_operation(
+        {'thingName': 'benchmark', 'deviceState': {'registered': True}}),
+    'lwm2mOperation-read': lambda: run_lwm2m_operation(
+        {'thingName': 'benchmark', 'operation': 'read', 'keys': ['3.0.0']}),
+    'createThing': run_create_thing,
+    'certificates-delete': run_certificates_delete,
+}
+
+
+def main():
+    if len(sys.argv) > 1:
+        # the lambdas log to stdout, the result is the last line
+        result = SCENARIOS[sys.argv[1]]()
+        print(json.dumps(result))
+        return
+
+    within_budget = True
+    for scenario, (import_budget, first_budget) in BUDGETS.items():
+        output = subprocess.run([sys.executable, __file__, scenario], check=True, capture_output=True, text=True,
+                                env={**os.environ, **AWS_ENVIRONMENT}).stdout
+        import_ms, first_ms, second_ms = json.loads(output.strip().splitlines()[-1])
+        over = import_ms > import_budget or first_ms > first_budget
+        within_budget = within_budget and not over
+        print(f'{scenario:>27}: import {import_ms:7.1f} ms (budget {import_budget}), '
+              f'first {first_ms:7.1f} ms (budget {first_budget}), second {second_ms:6.1f} ms'
+              + ('  OVER BUDGET' if over else ''))
+    sys.exit(0 if within_budget else 1)
+
+
+if __name__ == '__main__':
+    main()
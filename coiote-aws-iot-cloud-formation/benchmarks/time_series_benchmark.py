@@ -0,0 +1,107 @@
+"""
+Buffering observe notifications of 10k resources (1000 things with 10 observed resources each),
+256 samples per resource:
+
+* deque   - a bounded deque of (timestamp, value) tuples per resource, for comparison
+* ring    - time_series.TimeSeriesStore, with NumPy if installed and with the array module only
+
+For each variant: ingest rate, RSS growth once all buffers are full and the time to query the
+min/max/mean/last of the last 60 s of every resource. Every variant runs in its own process, so that
+RSS is not affected by the previous ones.
+
+Usage: python time_series_benchmark.py
+"""
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import deque
+
+from local_tls import add_lambda_to_path
+
+add_lambda_to_path('datamodelDelta')
+import time_series  # noqa: E402
+
+THINGS = 1000
+RESOURCES_PER_THING = 10
+CAPACITY = 256
+SAMPLES_PER_RESOURCE = 2 * CAPACITY
+QUERY_SECONDS = 60
+
+
+def rss_bytes():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class DequeStore:
+    def __init__(self):
+        self.series = {}
+
+    def add(self, key, timestamp, value):
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = deque(maxlen=CAPACITY)
+        series.append((timestamp, value))
+
+    def query(self, key, since):
+        values = [value for timestamp, value in self.series[key] if timestamp >= since]
+        return {'min': min(values), 'max': max(values), 'mean': math.fsum(values) / len(values), 'last': values[-1]}
+
+
+class RingStore:
+    def __init__(self):
+        self.store = time_series.TimeSeriesStore(THINGS * RESOURCES_PER_THING * CAPACITY * time_series.SAMPLE_BYTES,
+                                                 CAPACITY)
+
+    def add(self, key, timestamp, value):
+        self.store.add(key, timestamp, value)
+
+    def query(self, key, since):
+        return self.store.get(key).query(since)
+
+
+def run(variant):
+    if variant == 'ring-array':
+        time_series.numpy = None
+    store = DequeStore() if variant == 'deque' else RingStore()
+    keys = [(f'thing-{thing}', ('3303', str(resource), '5700'))
+            for thing in range(THINGS) for resource in range(RESOURCES_PER_THING)]
+    rng = random.Random(0)
+    values = [rng.uniform(-20, 40) for _ in range(1024)]
+
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    for sample in range(SAMPLES_PER_RESOURCE):
+        timestamp = float(sample)
+        value = values[sample % len(values)]
+        for key in keys:
+            store.add(key, timestamp, value)
+    ingest = time.perf_counter() - start
+    rss = rss_bytes() - rss_before
+
+    start = time.perf_counter()
+    since = SAMPLES_PER_RESOURCE - QUERY_SECONDS
+    for key in keys:
+        store.query(key, since)
+    query = time.perf_counter() - start
+
+    samples = len(keys) * SAMPLES_PER_RESOURCE
+    print(f'{variant:>10}: ingest {samples / ingest / 1000:7.0f}k samples/s, RSS +{rss / 2 ** 20:6.1f} MiB, '
+          f'query of {len(keys)} resources {query * 1000:7.1f} ms')
+
+
+def main():
+    if len(sys.argv) > 1:
+        run(sys.argv[1])
+        return
+    print(f'{THINGS * RESOURCES_PER_THING} resources, {SAMPLES_PER_RESOURCE} samples each')
+    variants = ['deque', 'ring-array'] + (['ring-numpy'] if time_series.numpy is not None else [])
+    for variant in variants:
+        subprocess.run([sys.executable, __file__, variant], check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,21 @@
+import datetime
 import json
 import os
 import logging
-from typing import TypedDict
+import threading
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional, TypedDict
 
-import boto3
-import requests
-from requests.exceptions import HTTPError
-from OpenSSL import crypto
 from crhelper import CfnResource
 
+import instrumentation
+from keys import DEFAULT_KEY_ALGORITHM, generate_private_key
+from task_graph import Step, run_steps
+
+# requests takes a while to import, like boto3 it is imported on first use
+if TYPE_CHECKING:
+    import requests
+
 
 class Certificate(TypedDict):
     certificatePem: str
@@ -24,18 +31,88 @@ class UserAuthCertRequestBody(TypedDict):
     certificatePem: str
 
 
+class ConfigurationError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class CoioteConfig:
+    restUri: str
+    username: str
+    password: str
+
+
 helper = CfnResource()
-iot_client = boto3.client('iot')
-secrets_manager_client = boto3.client('secretsmanager')
 logger = logging.getLogger()
 
-USER = os.environ['coioteDMrestUsername']
-PASSWORD = os.environ['coioteDMrestPassword']
-REST_URI = os.environ['coioteDMrestUri'] + '/api/coiotedm/v3'
-
 CERT_SECRET_NAME = 'coioteDMcert'
 CERT_DATA_SECRET_NAME = 'coioteDMcertData'
 
+# Resolved on first use, so that a configuration problem is reported to CloudFormation
+# as a failed resource instead of failing the import of the lambda
+_coiote_config: Optional[CoioteConfig] = None
+_iot_client = None
+_secrets_manager_client = None
+# steps of the task graph run in threads, and boto3's default session is not safe for concurrent client creation
+_clients_lock = threading.Lock()
+
+
+def get_coiote_config() -> CoioteConfig:
+    global _coiote_config
+    if _coiote_config is None:
+        names = ('coioteDMrestUri', 'coioteDMrestUsername', 'coioteDMrestPassword')
+        missing = [name for name in names if not os.environ.get(name)]
+        if missing:
+            raise ConfigurationError(f'Missing environment variables: {", ".join(missing)}')
+        _coiote_config = CoioteConfig(
+            restUri=os.environ['coioteDMrestUri'].rstrip('/') + '/api/coiotedm/v3',
+            username=os.environ['coioteDMrestUsername'],
+            password=os.environ['coioteDMrestPassword']
+        )
+    return _coiote_config
+
+
+def get_iot_client():
+    global _iot_client
+    with _clients_lock:
+        if _iot_client is None:
+            import boto3
+            _iot_client = boto3.client('iot')
+        return _iot_client
+
+
+def get_secrets_manager_client():
+    global _secrets_manager_client
+    with _clients_lock:
+        if _secrets_manager_client is None:
+            import boto3
+            _secrets_manager_client = boto3.client('secretsmanager')
+        return _secrets_manager_client
+
+
+def coiote_request(method: str, path: str, **kwargs) -> 'requests.Response':
+    """Sends a request to Coiote DM's REST API with the configured credentials, raises HTTPError on errors."""
+    import requests
+    config = get_coiote_config()
+    response = requests.request(method, config.restUri + path, auth=(config.username, config.password), verify=False,
+                                **kwargs)
+    response.raise_for_status()
+    return response
+
+
+def delete_from_coiote(path: str) -> bool:
+    """Returns False if Coiote DM responded with an error; 404 means that there is nothing left to delete."""
+    from requests.exceptions import HTTPError
+    try:
+        coiote_request('DELETE', path)
+    except HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            logger.warning("Certificate not found in CoioteDM, it could have been removed already.")
+            return True
+        logger.error(e)
+        return False
+    return True
+
 
 def log_success(msg: str):
     logger.info(f"SUCCESS: {msg}")
@@ -43,50 +120,111 @@ def log_success(msg: str):
 
 @helper.create
 def create(event, context):
-    external_certificate = iot_client.create_keys_and_certificate(setAsActive=True)
-    log_success("Certificate created in IoT Core.")
     cert_policy = event['ResourceProperties']['PolicyName']
-    iot_client.attach_principal_policy(policyName=cert_policy, principal=external_certificate['certificateArn'])
+    key_algorithm = event['ResourceProperties'].get('KeyAlgorithm', DEFAULT_KEY_ALGORITHM)
+    user = get_coiote_config().username
+
+    # independent steps run concurrently, see task_graph.run_steps;
+    # if any step fails, the completed ones are rolled back
+    run_steps([
+        Step('create_iot_certificate', lambda results: create_iot_certificate(),
+             rollback=delete_iot_certificate),
+        Step('attach_policy',
+             lambda results: attach_certificate_policy(cert_policy, results['create_iot_certificate']),
+             dependencies=('create_iot_certificate',),
+             rollback=lambda certificate: detach_certificate_policy(cert_policy, certificate)),
+        Step('generate_user_auth_cert',
+             lambda results: generate_external_cert(email_address=user, common_name=user,
+                                                    key_algorithm=key_algorithm)),
+        # clear potential old integration
+        Step('delete_old_external_certificate', lambda results: delete_external_certificate_from_coiote()),
+        Step('delete_old_user_auth_cert', lambda results: delete_user_auth_cert_from_coiote()),
+        Step('save_external_certificate_data',
+             lambda results: save_external_certificate_data(results['create_iot_certificate']),
+             dependencies=('create_iot_certificate',),
+             rollback=lambda _: delete_secret(CERT_DATA_SECRET_NAME)),
+        Step('send_external_certificate',
+             lambda results: send_external_certificate(results['create_iot_certificate']),
+             dependencies=('create_iot_certificate', 'delete_old_external_certificate'),
+             rollback=lambda _: delete_external_certificate_from_coiote()),
+        Step('send_user_auth_cert',
+             lambda results: send_user_auth_cert(results['generate_user_auth_cert']),
+             dependencies=('generate_user_auth_cert', 'delete_old_user_auth_cert'),
+             rollback=lambda _: delete_user_auth_cert_from_coiote()),
+        Step('save_certificate_in_secrets_manager',
+             lambda results: save_certificate_in_secrets_manager(results['generate_user_auth_cert']),
+             dependencies=('generate_user_auth_cert',),
+             rollback=lambda _: delete_secret(CERT_SECRET_NAME)),
+    ])
+
+    log_success("All certificates have been successfully created.")
 
-    user_auth_cert = generate_external_cert(email_address=USER, common_name=USER)
 
-    # clear potential old integration
-    delete_external_certificate_from_coiote()
-    delete_user_auth_cert_from_coiote()
+def create_iot_certificate():
+    external_certificate = get_iot_client().create_keys_and_certificate(setAsActive=True)
+    log_success("Certificate created in IoT Core.")
+    return external_certificate
 
-    save_external_certificate_data(external_certificate)
-    send_external_certificate(external_certificate)
-    send_user_auth_cert(user_auth_cert)
-    save_certificate_in_secrets_manager(user_auth_cert)
 
-    log_success("All certificates have been successfully created.")
+def delete_iot_certificate(external_certificate):
+    iot_client = get_iot_client()
+    iot_client.update_certificate(certificateId=external_certificate['certificateId'], newStatus='INACTIVE')
+    iot_client.delete_certificate(certificateId=external_certificate['certificateId'], forceDelete=True)
+
+
+def attach_certificate_policy(policy_name: str, external_certificate):
+    get_iot_client().attach_principal_policy(policyName=policy_name, principal=external_certificate['certificateArn'])
+    return external_certificate
+
+
+def detach_certificate_policy(policy_name: str, external_certificate):
+    get_iot_client().detach_policy(policyName=policy_name, target=external_certificate['certificateArn'])
+
+
+def delete_secret(secret_name: str):
+    get_secrets_manager_client().delete_secret(SecretId=secret_name, ForceDeleteWithoutRecovery=True)
 
 
-def generate_external_cert(email_address: str, common_name: str, serial_number=0) -> Certificate:
+def generate_external_cert(email_address: str, common_name: str, serial_number: int = None,
+                           key_algorithm: str = DEFAULT_KEY_ALGORITHM) -> Certificate:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.x509.oid import NameOID
+
     # can look at generated file using openssl:
     # openssl x509 -inform pem -in selfsigned.crt -noout -text
     # create a key pair
-    k = crypto.PKey()
-    k.generate_key(crypto.TYPE_RSA, 4096)
+    k = generate_private_key(key_algorithm)
     # create a self-signed cert
-    cert = crypto.X509()
-    cert.get_issuer().C = 'PL'
-    cert.get_issuer().ST = 'Lesser Poland'
-    cert.get_issuer().L = 'Cracow'
-    cert.get_issuer().O = 'AVSystem'
-    cert.get_issuer().OU = 'AVSystem'
-    cert.get_issuer().CN = 'AVSystem'
-    cert.get_subject().CN = common_name
-    cert.get_subject().emailAddress = email_address
-    cert.set_serial_number(serial_number)
-    cert.gmtime_adj_notBefore(0)
-    cert.gmtime_adj_notAfter(10 * 365 * 24 * 60 * 60)
-    cert.set_pubkey(k)
-    cert.sign(k, 'sha256')
+    issuer = x509.Name([
+        x509.NameAttribute(NameOID.COUNTRY_NAME, 'PL'),
+        x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, 'Lesser Poland'),
+        x509.NameAttribute(NameOID.LOCALITY_NAME, 'Cracow'),
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, 'AVSystem'),
+        x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, 'AVSystem'),
+        x509.NameAttribute(NameOID.COMMON_NAME, 'AVSystem'),
+    ])
+    subject = x509.Name([
+        x509.NameAttribute(NameOID.COMMON_NAME, common_name),
+        x509.NameAttribute(NameOID.EMAIL_ADDRESS, email_address),
+    ])
+    now = datetime.datetime.utcnow()
+    cert = x509.CertificateBuilder() \
+        .issuer_name(issuer) \
+        .subject_name(subject) \
+        .serial_number(serial_number if serial_number is not None else x509.random_serial_number()) \
+        .not_valid_before(now) \
+        .not_valid_after(now + datetime.timedelta(days=10 * 365)) \
+        .public_key(k.public_key()) \
+        .sign(k, hashes.SHA256())
 
     return {
-        'certificatePem': crypto.dump_certificate(crypto.FILETYPE_PEM, cert).decode("utf-8"),
-        'privateKey': crypto.dump_privatekey(crypto.FILETYPE_PEM, k).decode("utf-8")
+        'certificatePem': cert.public_bytes(serialization.Encoding.PEM).decode("utf-8"),
+        'privateKey': k.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        ).decode("utf-8")
     }
 
 
@@ -95,15 +233,13 @@ def send_external_certificate(internal_certificate):
         'certificatePem': internal_certificate['certificatePem'],
         'privateKey': internal_certificate['keyPair']['PrivateKey']
     }
-    uri = REST_URI + '/awsIntegration/auth/externalCertificate'
-    requests.post(uri, json=request_body, auth=(USER, PASSWORD), verify=False).raise_for_status()
+    coiote_request('POST', '/awsIntegration/auth/externalCertificate', json=request_body)
     log_success("IoT Core certificate saved in CoioteDM.")
 
 
 def save_external_certificate_data(internal_certificate):
-    secrets_manager_client.create_secret(Name=CERT_DATA_SECRET_NAME)
     secret_string = json.dumps(internal_certificate['certificateId'])
-    secrets_manager_client.put_secret_value(SecretId=CERT_DATA_SECRET_NAME, SecretString=secret_string)
+    get_secrets_manager_client().create_secret(Name=CERT_DATA_SECRET_NAME, SecretString=secret_string)
     log_success("IoT Core certificate id saved in AWS Secrets Manager.")
 
 
@@ -111,37 +247,32 @@ def send_user_auth_cert(external_certificate: Certificate):
     request_body: UserAuthCertRequestBody = {
         'certificatePem': external_certificate['certificatePem']
     }
-    uri = REST_URI + '/auth/certificates'
-    requests.post(uri, json=request_body, auth=(USER, PASSWORD), verify=False).raise_for_status()
+    coiote_request('POST', '/auth/certificates', json=request_body)
     log_success("User authentication certificate saved in CoioteDM.")
 
 
 def save_certificate_in_secrets_manager(external_certificate: Certificate):
-    secrets_manager_client.create_secret(Name=CERT_SECRET_NAME)
-    secrets_manager_client.put_secret_value(SecretId=CERT_SECRET_NAME, SecretString=json.dumps(external_certificate))
+    get_secrets_manager_client().create_secret(Name=CERT_SECRET_NAME, SecretString=json.dumps(external_certificate))
     log_success("User authentication certificate saved in AWS Secrets Manager.")
 
 
 @helper.delete
 def delete(event, context):
-    removal_actions = [
-        delete_external_certificate_from_aws(),
-        delete_external_certificate_from_coiote(),
-        delete_user_auth_cert_from_coiote(),
-        delete_certificate_from_secrets_manager(),
-    ]
-    if not all(removal_actions):
+    # removal actions are independent of each other and report failures by returning False
+    removal_actions = run_steps([
+        Step('delete_external_certificate_from_aws', lambda results: delete_external_certificate_from_aws()),
+        Step('delete_external_certificate_from_coiote', lambda results: delete_external_certificate_from_coiote()),
+        Step('delete_user_auth_cert_from_coiote', lambda results: delete_user_auth_cert_from_coiote()),
+        Step('delete_certificate_from_secrets_manager', lambda results: delete_certificate_from_secrets_manager()),
+    ])
+    if not all(removal_actions.values()):
         raise Exception("Delete action went wrong, check CloudWatch logs for more details.")
     else:
         log_success("All certificates have been successfully removed.")
 
 
 def delete_external_certificate_from_coiote() -> bool:
-    uri = REST_URI + '/awsIntegration/auth/externalCertificate'
-    try:
-        requests.delete(uri, auth=(USER, PASSWORD), verify=False).raise_for_status()
-    except HTTPError as e:
-        logger.error(e)
+    if not delete_from_coiote('/awsIntegration/auth/externalCertificate'):
         return False
 
     log_success("IoT Core certificate removed from CoioteDM.")
@@ -149,6 +280,8 @@ def delete_external_certificate_from_coiote() -> bool:
 
 
 def delete_external_certificate_from_aws() -> bool:
+    iot_client = get_iot_client()
+    secrets_manager_client = get_secrets_manager_client()
     try:
         secret_value = secrets_manager_client.get_secret_value(SecretId=CERT_DATA_SECRET_NAME)
         secret_string = json.loads(secret_value['SecretString'])
@@ -161,13 +294,13 @@ def delete_external_certificate_from_aws() -> bool:
         finally:
             secrets_manager_client.delete_secret(SecretId=CERT_DATA_SECRET_NAME, ForceDeleteWithoutRecovery=True)
 
-    except secrets_manager_client.exceptions.ResourceNotFoundException as e:
-        logger.error(
-            "IoT Core certificate id not found in Secrets Manager."
-            "Certificate will be kept in IoT Core if it has not been removed manually."
+    except secrets_manager_client.exceptions.ResourceNotFoundException:
+        # already deleted, e.g. by the rollback of a failed Create, which CloudFormation follows with a Delete
+        logger.warning(
+            "IoT Core certificate id not found in Secrets Manager, assuming it has already been removed. "
+            "Certificate will be kept in IoT Core if it has not been removed."
         )
-        logger.error(e)
-        return False
+        return True
     except Exception as e:
         logger.error(e)
         return False
@@ -177,12 +310,7 @@ def delete_external_certificate_from_aws() -> bool:
 
 
 def delete_user_auth_cert_from_coiote() -> bool:
-    uri = REST_URI + '/auth/certificates/'
-
-    try:
-        requests.delete(uri, auth=(USER, PASSWORD), verify=False).raise_for_status()
-    except HTTPError as e:
-        logger.error(e)
+    if not delete_from_coiote('/auth/certificates/'):
         return False
 
     log_success("User authentication certificate removed from CoioteDM")
@@ -190,6 +318,7 @@ def delete_user_auth_cert_from_coiote() -> bool:
 
 
 def delete_certificate_from_secrets_manager() -> bool:
+    secrets_manager_client = get_secrets_manager_client()
     try:
         secrets_manager_client.delete_secret(SecretId=CERT_SECRET_NAME, ForceDeleteWithoutRecovery=True)
     except secrets_manager_client.exceptions.ResourceNotFoundException:
@@ -202,5 +331,9 @@ def delete_certificate_from_secrets_manager() -> bool:
     return True
 
 
+@instrumentation.instrumented('certificates')
 def handler(event, context):
+    instrumentation.set_dimension('operation', event.get('RequestType'))
     helper(event, context)
+    # crhelper reports failures to CloudFormation instead of raising
+    instrumentation.set_dimension('statusCode', helper.Status or 'ok')
@@ -0,0 +1,29 @@
+# cryptography is imported only when a key is generated, the custom resource's Delete does not need it
+
+
+def generate_ecdsa_key(curve_name: str):
+    from cryptography.hazmat.primitives.asymmetric import ec
+    return ec.generate_private_key(getattr(ec, curve_name)())
+
+
+def generate_rsa_key(key_size: int):
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    return rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+
+
+# Key algorithms accepted in the KeyAlgorithm property of the custom resource.
+# ECDSA keys are generated in milliseconds and make TLS handshakes cheaper than RSA ones.
+KEY_ALGORITHMS = {
+    'ECDSA-P256': lambda: generate_ecdsa_key('SECP256R1'),
+    'ECDSA-P384': lambda: generate_ecdsa_key('SECP384R1'),
+    'RSA-2048': lambda: generate_rsa_key(2048),
+    'RSA-4096': lambda: generate_rsa_key(4096),
+}
+DEFAULT_KEY_ALGORITHM = 'RSA-4096'
+
+
+def generate_private_key(key_algorithm: str = DEFAULT_KEY_ALGORITHM):
+    if key_algorithm not in KEY_ALGORITHMS:
+        raise ValueError(
+            f'Unsupported key algorithm {key_algorithm}, expected one of: {", ".join(KEY_ALGORITHMS)}')
+    return KEY_ALGORITHMS[key_algorithm]()
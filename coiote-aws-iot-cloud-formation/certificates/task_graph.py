@@ -0,0 +1,84 @@
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import instrumentation
+
+logger = logging.getLogger()
+
+
+@dataclass
+class Step:
+    name: str
+    # receives the results of all steps completed so far, keyed by step name
+    action: Callable[[Dict[str, Any]], Any]
+    dependencies: Tuple[str, ...] = ()
+    # receives the step's own result, called if a later step fails
+    rollback: Optional[Callable[[Any], None]] = None
+
+
+def run_steps(steps: List[Step], max_workers: int = 4) -> Dict[str, Any]:
+    """
+    Runs the steps concurrently, each one as soon as all of its dependencies have completed,
+    and returns their results. If a step raises, no new steps are started, the running ones are
+    waited for, completed steps are rolled back in reverse order and the exception is re-raised.
+    """
+    steps_by_name = {step.name: step for step in steps}
+    for step in steps:
+        unknown = set(step.dependencies) - steps_by_name.keys()
+        if unknown:
+            raise ValueError(f'Step {step.name} depends on unknown steps: {", ".join(sorted(unknown))}')
+
+    results: Dict[str, Any] = {}
+    completed: List[str] = []
+    pending = dict(steps_by_name)
+    running = {}
+    error: Optional[BaseException] = None
+
+    def timed(step: Step, dependency_results: Dict[str, Any]):
+        start = time.perf_counter()
+        try:
+            with instrumentation.phase(step.name):
+                return step.action(dependency_results)
+        finally:
+            logger.info(f"Step {step.name} took {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            if error is None:
+                ready = [step for step in pending.values() if all(name in results for name in step.dependencies)]
+                for step in ready:
+                    del pending[step.name]
+                    running[executor.submit(timed, step, dict(results))] = step
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                if future.exception() is not None:
+                    logger.error(f"Step {step.name} failed: {future.exception()}")
+                    error = error or future.exception()
+                else:
+                    results[step.name] = future.result()
+                    completed.append(step.name)
+
+    if error is None and pending:
+        error = ValueError(f'Steps with circular dependencies: {", ".join(sorted(pending))}')
+    if error is not None:
+        rollback(steps_by_name, completed, results)
+        raise error
+    return results
+
+
+def rollback(steps_by_name: Dict[str, Step], completed: List[str], results: Dict[str, Any]):
+    for name in reversed(completed):
+        step = steps_by_name[name]
+        if step.rollback is None:
+            continue
+        try:
+            step.rollback(results[name])
+            logger.info(f"Step {name} rolled back")
+        except Exception as e:
+            logger.error(f"Rollback of step {name} failed: {e}")
@@ -0,0 +1,150 @@
+"""
+Bulk provisioning of things for devices already registered in Coiote DM, e.g. when migrating an existing fleet.
+Does the same as the createThing lambda for every device in a manifest, concurrently and within a rate limit.
+
+Usage: python bulk_create_things.py MANIFEST [--rate CALLS_PER_SECOND] [--workers N] [--checkpoint FILE]
+
+The manifest is either a CSV file with a header or a JSON lines file, each row having coioteDeviceId and
+coioteDeviceType, just like createThing messages. Provisioned things are appended to the checkpoint file
+(MANIFEST.checkpoint by default) and skipped when the command is run again, so an interrupted run can be resumed.
+AWS credentials and region are taken from the environment, as for any boto3 script.
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from botocore.exceptions import ClientError
+
+# create_thing imports the instrumentation layer, which the lambda gets from its runtime
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'instrumentationLayer', 'python'))
+import create_thing  # noqa: E402
+
+THROTTLING_ERRORS = {'ThrottlingException', 'TooManyRequestsException', 'LimitExceededException'}
+MAX_ATTEMPTS = 8
+MAX_BACKOFF = 20.0
+REPORT_INTERVAL = 10.0
+
+
+class AdaptiveRateLimiter:
+    """
+    Spaces calls evenly at the current rate. The rate is halved whenever AWS throttles a call
+    and recovers by 1% of the configured maximum with every successful call.
+    """
+
+    def __init__(self, max_rate: float):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.throttles = 0
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + 1 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    def throttled(self):
+        with self._lock:
+            self.throttles += 1
+            self.rate = max(self.max_rate / 100, self.rate / 2)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+
+def call_with_backoff(limiter: AdaptiveRateLimiter, function, *args):
+    for attempt in range(MAX_ATTEMPTS):
+        limiter.acquire()
+        try:
+            result = function(*args)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in THROTTLING_ERRORS or attempt == MAX_ATTEMPTS - 1:
+                raise
+            limiter.throttled()
+            time.sleep(random.uniform(0, min(MAX_BACKOFF, 0.1 * 2 ** attempt)))
+        else:
+            limiter.succeeded()
+            return result
+
+
+def read_manifest(path):
+    """Returns (thing_name, thing_type_name) pairs, without duplicates."""
+    with open(path, newline='') as manifest:
+        if path.endswith('.csv'):
+            rows = list(csv.DictReader(manifest))
+        else:
+            rows = [json.loads(line) for line in manifest if line.strip()]
+    return list(dict.fromkeys(create_thing.extract_device_data(row) for row in rows))
+
+
+def read_checkpoint(path):
+    try:
+        with open(path) as checkpoint:
+            return {line.rstrip('\n') for line in checkpoint}
+    except FileNotFoundError:
+        return set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Creates things for devices listed in a manifest.')
+    parser.add_argument('manifest')
+    parser.add_argument('--rate', type=float, default=10.0, help='maximum AWS IoT calls per second')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--checkpoint')
+    args = parser.parse_args()
+    checkpoint_path = args.checkpoint or args.manifest + '.checkpoint'
+
+    devices = read_manifest(args.manifest)
+    done = read_checkpoint(checkpoint_path)
+    pending = [(thing_name, thing_type_name) for thing_name, thing_type_name in devices if thing_name not in done]
+    print(f'{len(devices)} devices in the manifest, {len(devices) - len(pending)} already provisioned')
+
+    limiter = AdaptiveRateLimiter(args.rate)
+    for thing_type_name in sorted({thing_type_name for _, thing_type_name in pending}):
+        call_with_backoff(limiter, create_thing.ensure_thing_type_exists, thing_type_name)
+
+    def provision(thing_name, thing_type_name):
+        call_with_backoff(limiter, create_thing.create_lwm2m_thing, thing_name, thing_type_name)
+        call_with_backoff(limiter, create_thing.init_operation_shadow, thing_name)
+
+    provisioned = 0
+    failed = 0
+    start = last_report = time.monotonic()
+    with open(checkpoint_path, 'a') as checkpoint, ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(provision, *device): device[0] for device in pending}
+        for future in as_completed(futures):
+            thing_name = futures[future]
+            if future.exception() is not None:
+                failed += 1
+                print(f'Error: {thing_name}: {future.exception()}')
+            else:
+                provisioned += 1
+                checkpoint.write(thing_name + '\n')
+                checkpoint.flush()
+
+            now = time.monotonic()
+            if now - last_report >= REPORT_INTERVAL:
+                last_report = now
+                print(f'{provisioned + failed}/{len(pending)} processed, '
+                      f'{provisioned / (now - start):.1f} things/s, current rate {limiter.rate:.1f} calls/s')
+
+    elapsed = time.monotonic() - start
+    print(f'Provisioned {provisioned} things in {elapsed:.1f} s ({provisioned / max(elapsed, 1e-9):.1f} things/s), '
+          f'{failed} failed, {limiter.throttles} throttled calls')
+    if failed:
+        print(f'Run the command again to retry the failed devices, progress is kept in {checkpoint_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,70 @@
-import boto3
 import json
+import threading
+
+import instrumentation
 
 URL_ENCODED_COLON = '%3A'
 
-iot_client = boto3.client('iot')
-iot_data_client = boto3.client('iot-data')
+# Created on first use and kept between invocations of a warm Lambda container.
+# The lock is for bulk_create_things, which calls this module from many threads.
+_iot_client = None
+_iot_data_client = None
+_clients_lock = threading.Lock()
+
+
+# Names of thing types known to exist, kept between invocations of a warm Lambda container.
+# Listed once on the first registration, types created later elsewhere are checked one by one.
+known_thing_types = None
+
+
+def get_iot_client():
+    global _iot_client
+    with _clients_lock:
+        if _iot_client is None:
+            import boto3
+            _iot_client = boto3.client('iot')
+        return _iot_client
+
+
+def get_iot_data_client():
+    global _iot_data_client
+    with _clients_lock:
+        if _iot_data_client is None:
+            import boto3
+            _iot_data_client = boto3.client('iot-data')
+        return _iot_data_client
+
+
+def list_thing_type_names():
+    paginator = get_iot_client().get_paginator('list_thing_types')
+    return {thing_type['thingTypeName'] for page in paginator.paginate() for thing_type in page['thingTypes']}
+
+
+def thing_type_exists(thing_type):
+    iot_client = get_iot_client()
+    try:
+        iot_client.describe_thing_type(thingTypeName=thing_type)
+    except iot_client.exceptions.ResourceNotFoundException:
+        return False
+    return True
 
 
 def ensure_thing_type_exists(thing_type):
-    existing_thing_types = iot_client.list_thing_types()['thingTypes']
-    existing_thing_types_names = [thing['thingTypeName'] for thing in existing_thing_types]
-    if thing_type not in existing_thing_types_names:
-        iot_client.create_thing_type(thingTypeName=thing_type)
+    global known_thing_types
+    if known_thing_types is None:
+        known_thing_types = list_thing_type_names()
+    elif thing_type not in known_thing_types and thing_type_exists(thing_type):
+        known_thing_types.add(thing_type)
+
+    if thing_type not in known_thing_types:
+        iot_client = get_iot_client()
+        try:
+            iot_client.create_thing_type(thingTypeName=thing_type)
+        except iot_client.exceptions.ResourceAlreadyExistsException:
+            # created concurrently by another registration
+            pass
+        known_thing_types.add(thing_type)
+
 
 def extract_device_data(event):
     """
@@ -22,15 +75,28 @@ def extract_device_data(event):
     thing_type_name = event['coioteDeviceType'].replace('.', ':')
     return thing_name, thing_type_name
 
-def lambda_handler(event, context):
-    thing_name, thing_type_name = extract_device_data(event)
-    ensure_thing_type_exists(thing_type_name)
+def create_lwm2m_thing(thing_name, thing_type_name):
     attribute_payload = {
         'attributes': {
             'protocol': 'LwM2M'
         },
         'merge': True
     }
-    iot_client.create_thing(thingName=thing_name, thingTypeName=thing_type_name, attributePayload=attribute_payload)
+    get_iot_client().create_thing(thingName=thing_name, thingTypeName=thing_type_name, attributePayload=attribute_payload)
+
+
+def init_operation_shadow(thing_name):
     payload = json.dumps({"state": {}}).encode('utf-8')
-    iot_data_client.update_thing_shadow(thingName=thing_name, shadowName='operation', payload=payload)
+    get_iot_data_client().update_thing_shadow(thingName=thing_name, shadowName='operation', payload=payload)
+
+
+@instrumentation.instrumented('createThing')
+def lambda_handler(event, context):
+    instrumentation.set_dimension('operation', 'createThing')
+    thing_name, thing_type_name = extract_device_data(event)
+    with instrumentation.phase('thingType'):
+        ensure_thing_type_exists(thing_type_name)
+    with instrumentation.phase('thingCreation'):
+        create_lwm2m_thing(thing_name, thing_type_name)
+    with instrumentation.phase('shadowInit'):
+        init_operation_shadow(thing_name)
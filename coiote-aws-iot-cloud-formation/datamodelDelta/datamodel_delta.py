@@ -0,0 +1,237 @@
+import functools
+import heapq
+import json
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from datamodel_diff import Path, diff, dumps, flatten, split_into_chunks
+from senml import SenmlError, decode_result, is_senml
+from time_series import AGGREGATES, TimeSeriesStore
+
+# Maximum size of a single datamodel shadow update. AWS rejects state documents over 8 KB,
+# a bit is left for the metadata of the request.
+MAX_UPDATE_BYTES = int(os.environ.get('coioteDMdeltaMaxBytes', 8000))
+# Number of things whose last reported datamodel is kept between invocations of a warm Lambda container
+DATAMODEL_CACHE_SIZE = int(os.environ.get('coioteDMdatamodelCacheSize', 1000))
+# Seconds after which a cached datamodel is fetched again. Other containers may have updated the shadow
+# in the meantime, and a result equal to the stale cached value would not be written at all
+DATAMODEL_CACHE_TTL = float(os.environ.get('coioteDMdatamodelCacheTtl', 10))
+
+# Observe notifications are buffered and each numeric resource is written to the shadow at most once per interval
+# (in seconds), as the coioteDMobserveAggregate (min, max, mean or last) of the samples received since its last write
+OBSERVE_PUBLISH_INTERVAL = float(os.environ.get('coioteDMobservePublishInterval', 60))
+# Samples kept per observed resource, and memory above which the least recently updated resources are evicted
+OBSERVE_BUFFER_SIZE = int(os.environ.get('coioteDMobserveBufferSize', 256))
+OBSERVE_MEMORY_BYTES = int(os.environ.get('coioteDMobserveMemoryBytes', 64 * 1024 * 1024))
+
+# How values of SenML results are written to the shadow (coioteDMshadowEncoding): 'exact', or 'compact' - single
+# precision floats as their shortest decimal (21.6 instead of 21.600000381469727) and integral floats as integers
+SHADOW_ENCODINGS = ('exact', 'compact')
+
+DATAMODEL_SHADOW = 'datamodel'
+OBSERVE_OPERATIONS = {'observe', 'observeComposite'}
+UPDATE_OVERHEAD = len(dumps({'state': {'reported': {}}})) - 2
+
+_iot_data_client = None
+
+
+class ConfigurationError(Exception):
+    pass
+
+
+@functools.lru_cache(maxsize=None)
+def get_setting(name: str, default: str, allowed: Tuple[str, ...]) -> str:
+    """
+    Environment variable restricted to the allowed values, read on first use, so that an invalid
+    value fails the invocation with a clear error instead of the import of the lambda.
+    """
+    value = os.environ.get(name, default)
+    if value not in allowed:
+        raise ConfigurationError(f'Unsupported {name} {value}, expected one of: {", ".join(allowed)}')
+    return value
+
+
+def get_observe_aggregate() -> str:
+    return get_setting('coioteDMobserveAggregate', 'last', AGGREGATES)
+
+
+def get_shadow_encoding() -> str:
+    return get_setting('coioteDMshadowEncoding', 'exact', SHADOW_ENCODINGS)
+
+
+@dataclass
+class Datamodel:
+    # flattened reported state
+    leaves: Dict[Path, Any]
+    # version of the shadow the leaves are from, None if it does not exist yet
+    version: Optional[int]
+    # time.monotonic() of the fetch
+    fetchedAt: float
+
+
+# Datamodel shadows of recently updated things, least recently used first
+datamodels: 'OrderedDict[str, Datamodel]' = OrderedDict()
+# Recent samples of observed numeric resources, keyed by (thing name, path)
+observed = TimeSeriesStore(OBSERVE_MEMORY_BYTES, OBSERVE_BUFFER_SIZE)
+# (due time, thing name, path) of observed resources with samples not written to the shadow yet, earliest first,
+# and their (thing name, path) keys
+pending_flushes: List[Tuple[float, str, Path]] = []
+scheduled_flushes: Set[Tuple[str, Path]] = set()
+
+
+def get_iot_data_client():
+    global _iot_data_client
+    if _iot_data_client is None:
+        import boto3
+        _iot_data_client = boto3.client('iot-data')
+    return _iot_data_client
+
+
+def fetch_datamodel(thing_name):
+    iot_data_client = get_iot_data_client()
+    fetched_at = time.monotonic()
+    try:
+        response = iot_data_client.get_thing_shadow(thingName=thing_name, shadowName=DATAMODEL_SHADOW)
+    except iot_data_client.exceptions.ResourceNotFoundException:
+        return Datamodel({}, None, fetched_at)
+    document = json.loads(response['payload'].read())
+    reported = document.get('state', {}).get('reported', {})
+    return Datamodel(flatten(reported) if isinstance(reported, dict) else {}, document.get('version'), fetched_at)
+
+
+def get_datamodel(thing_name, refresh=False):
+    datamodel = datamodels.get(thing_name)
+    if datamodel is not None and not refresh and time.monotonic() - datamodel.fetchedAt < DATAMODEL_CACHE_TTL:
+        datamodels.move_to_end(thing_name)
+    else:
+        datamodel = datamodels[thing_name] = fetch_datamodel(thing_name)
+        datamodels.move_to_end(thing_name)
+        while len(datamodels) > DATAMODEL_CACHE_SIZE:
+            datamodels.popitem(last=False)
+    return datamodel
+
+
+def downsample_observed(thing_name, leaves, timestamp):
+    """Buffers numeric resources of an observe notification and returns the leaves due to be written to the shadow."""
+    due = {}
+    for path, value in leaves.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            due[path] = value
+            continue
+        key = (thing_name, path)
+        series = observed.add(key, timestamp, value)
+        if timestamp - series.published_at >= OBSERVE_PUBLISH_INTERVAL:
+            due[path] = series.query(series.published_at)[get_observe_aggregate()]
+            series.published_at = timestamp
+        elif key not in scheduled_flushes:
+            scheduled_flushes.add(key)
+            heapq.heappush(pending_flushes, (series.published_at + OBSERVE_PUBLISH_INTERVAL, thing_name, path))
+    return due
+
+
+def flush_observed(now) -> Dict[str, Dict[Path, Any]]:
+    """
+    Aggregates of observed resources whose samples have waited for the publish interval to pass, by thing name.
+    Otherwise they would be written only with the next notification of the resource, which may never come.
+    Called by every invocation, so samples are left behind only by a container that is not invoked anymore.
+    """
+    flushed: Dict[str, Dict[Path, Any]] = {}
+    while pending_flushes and pending_flushes[0][0] <= now:
+        _, thing_name, path = heapq.heappop(pending_flushes)
+        key = (thing_name, path)
+        scheduled_flushes.discard(key)
+        series = observed.get(key)
+        if series is None or series.last_timestamp <= series.published_at:
+            # evicted, or published with a later notification
+            continue
+        if now - series.published_at < OBSERVE_PUBLISH_INTERVAL:
+            scheduled_flushes.add(key)
+            heapq.heappush(pending_flushes, (series.published_at + OBSERVE_PUBLISH_INTERVAL, thing_name, path))
+            continue
+        flushed.setdefault(thing_name, {})[path] = series.query(series.published_at)[get_observe_aggregate()]
+        series.published_at = now
+    return flushed
+
+
+def publish_delta(thing_name, chunk, version):
+    """
+    Updates the shadow only if it is still at the given version, so that changes made by other containers
+    are noticed (ConflictException), and returns the new version.
+    """
+    document = {'state': {'reported': chunk}}
+    if version is not None:
+        document['version'] = version
+    response = get_iot_data_client().update_thing_shadow(thingName=thing_name, shadowName=DATAMODEL_SHADOW,
+                                                         payload=dumps(document).encode('utf-8'))
+    return json.loads(response['payload'].read()).get('version')
+
+
+def publish_changes(thing_name, leaves) -> Tuple[int, int]:
+    """
+    Publishes the leaves which differ from the datamodel shadow and returns the number of changed resources
+    and of shadow updates. If the shadow has been updated elsewhere in the meantime, it is fetched again
+    and the leaves are diffed against it once more.
+    """
+    iot_data_client = get_iot_data_client()
+    for attempt in range(2):
+        datamodel = get_datamodel(thing_name, refresh=attempt > 0)
+        delta = diff(datamodel.leaves, leaves)
+        if not delta:
+            return 0, 0
+        chunks = split_into_chunks(delta, MAX_UPDATE_BYTES, UPDATE_OVERHEAD)
+        try:
+            for chunk in chunks:
+                datamodel.version = publish_delta(thing_name, chunk, datamodel.version)
+                # only what was actually published is cached, so that a failed chunk is sent again with the next result
+                datamodel.leaves.update(flatten(chunk))
+        except iot_data_client.exceptions.ConflictException:
+            if attempt > 0:
+                raise
+            print(f'Datamodel shadow of {thing_name} has been updated elsewhere, fetching it again')
+            continue
+        return len(delta), len(chunks)
+
+
+def result_leaves(thing_name, result):
+    """Flattened result, which is either the datamodel document or SenML (see senml.decode_result)."""
+    if isinstance(result, dict):
+        return flatten(result)
+    if is_senml(result):
+        try:
+            return decode_result(result, compact=get_shadow_encoding() == 'compact')
+        except (SenmlError, ValueError, UnicodeDecodeError) as e:
+            print(f'Error: result for {thing_name} is not valid SenML: {e}')
+    return {}
+
+
+def lambda_handler(event, context):
+    try:
+        # both settings are checked up front, so that an invalid one fails every invocation and not just some
+        get_observe_aggregate()
+        get_shadow_encoding()
+        handle_result(event)
+    except ConfigurationError as e:
+        print(f'Error: {e}')
+
+
+def handle_result(event):
+    thing_name = event['thingName']
+    leaves = result_leaves(thing_name, event.get('result'))
+    if leaves and event.get('operation') in OBSERVE_OPERATIONS:
+        # the rule passes the time the notification was received, in milliseconds
+        timestamp = event['timestamp'] / 1000 if 'timestamp' in event else time.time()
+        leaves = downsample_observed(thing_name, leaves, timestamp)
+
+    leaves_by_thing = flush_observed(time.time())
+    leaves_by_thing[thing_name] = {**leaves_by_thing.get(thing_name, {}), **leaves}
+    for name, thing_leaves in leaves_by_thing.items():
+        if not thing_leaves:
+            continue
+        changed, updates = publish_changes(name, thing_leaves)
+        if not changed:
+            print(f'No datamodel changes for {name}')
+            continue
+        print(f'Published {changed} changed resources of {name} in {updates} shadow updates')
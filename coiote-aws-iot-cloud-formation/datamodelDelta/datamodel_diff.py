@@ -0,0 +1,90 @@
+import json
+from typing import Any, Dict, Iterable, List, Tuple
+
+# Path of a value in the datamodel document, e.g. ('3303', '0', '5700')
+Path = Tuple[str, ...]
+
+
+def flatten(document: dict) -> Dict[Path, Any]:
+    """
+    Maps the path of every leaf value (anything but a non-empty dict) to the value, in document order.
+    A document which is empty or not a dict at all has no leaves.
+    """
+    leaves = {}
+    stack = [((), document)]
+    while stack:
+        prefix, node = stack.pop()
+        if isinstance(node, dict) and node:
+            # reversed, so that children are popped in document order
+            for key, value in reversed(list(node.items())):
+                stack.append((prefix + (key,), value))
+        elif prefix:
+            leaves[prefix] = node
+    return leaves
+
+
+def unflatten(leaves: Iterable[Tuple[Path, Any]]) -> dict:
+    document = {}
+    for path, value in leaves:
+        node = document
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node[path[-1]] = value
+    return document
+
+
+def diff(previous: Dict[Path, Any], current: Dict[Path, Any]) -> Dict[Path, Any]:
+    """Leaves of current that are not in previous or have a different value there."""
+    missing = object()
+    return {path: value for path, value in current.items() if previous.get(path, missing) != value}
+
+
+# the most compact JSON encoding, used for shadow updates and assumed by the size estimates below
+SEPARATORS = (',', ':')
+
+
+def dumps(document: Any) -> str:
+    return json.dumps(document, separators=SEPARATORS)
+
+
+def common_prefix_length(a: Path, b: Path) -> int:
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+def leaf_size(path: Path, value: Any, previous_path: Path = ()) -> int:
+    """
+    Upper bound of the bytes a leaf adds to a serialized document which already contains previous_path:
+    its value and the keys it does not share with previous_path, each with a colon, a comma and,
+    for objects, their braces.
+    """
+    new_keys = path[common_prefix_length(path[:-1], previous_path):]
+    return len(dumps(value)) + sum(len(dumps(key)) + 2 for key in new_keys) + 2 * (len(new_keys) - 1)
+
+
+def split_into_chunks(leaves: Dict[Path, Any], max_bytes: int, overhead: int = 0) -> List[dict]:
+    """
+    Splits the leaves, in order, into documents whose serialized size plus overhead does not exceed max_bytes.
+    A single leaf bigger than that is put in a chunk of its own.
+    """
+    chunks = []
+    chunk: List[Tuple[Path, Any]] = []
+    chunk_size = overhead + 2
+    previous_path: Path = ()
+    for path, value in leaves.items():
+        size = leaf_size(path, value, previous_path)
+        if chunk and chunk_size + size > max_bytes:
+            chunks.append(unflatten(chunk))
+            chunk = []
+            chunk_size = overhead + 2
+            size = leaf_size(path, value)
+        chunk.append((path, value))
+        chunk_size += size
+        previous_path = path
+    if chunk:
+        chunks.append(unflatten(chunk))
+    return chunks
@@ -0,0 +1,284 @@
+"""
+Decoder of SenML (RFC 8428) JSON and CBOR payloads of LwM2M read, readComposite and observe results into
+(path, time, value) records, e.g. ('3303', '0', '5700'), 1700000000.0, 21.5.
+
+Records are decoded one at a time and resolved against the base name, time and value of the preceding ones,
+so a large payload is never held as a list of parsed records. CBOR is decoded directly from the buffer into the
+resolved record; the JSON decoder parses one record object at a time with the standard library's C decoder.
+That object is dropped as soon as the record is resolved, so memory stays as flat as with CBOR, while tokenizing
+the fields in Python instead was three times slower.
+"""
+import base64
+import json
+import math
+import struct
+from typing import Any, Dict, Iterable, Iterator, NamedTuple, Optional, Tuple, Union
+
+from datamodel_diff import Path
+
+# SenML CBOR labels (RFC 8428, section 6) and their JSON names, of the fields used by LwM2M
+CBOR_LABELS = {-2: 'bn', -3: 'bt', -5: 'bv', 0: 'n', 2: 'v', 3: 'vs', 4: 'vb', 6: 't', 8: 'vd'}
+
+
+class Record(NamedTuple):
+    path: Path
+    # absolute time in seconds, None if neither the record nor a preceding base time has it
+    time: Optional[float]
+    # float, int, str, bool or bytes; object links (vlo) are 'object:instance' strings
+    value: Any
+
+
+class SenmlError(ValueError):
+    pass
+
+
+def to_path(name: str) -> Path:
+    return tuple(name.strip('/').split('/'))
+
+
+class Resolver:
+    """Keeps the base fields, which apply to all following records until they are redefined."""
+
+    def __init__(self):
+        self.base_name = ''
+        self.base_time: Optional[float] = None
+        self.base_value = 0
+
+    def resolve(self, fields: Iterable[Tuple[str, Any]]) -> Optional[Record]:
+        """Returns None for records which only set base fields."""
+        name = ''
+        time = None
+        value = None
+        numeric = False
+        for label, item in fields:
+            if label == 'n':
+                name = item
+            elif label == 'v':
+                value = item
+                numeric = True
+            elif label in ('vs', 'vb', 'vlo'):
+                value = item
+            elif label == 'vd':
+                value = item if isinstance(item, bytes) else base64.urlsafe_b64decode(item + '=' * (-len(item) % 4))
+            elif label == 't':
+                time = item
+            elif label == 'bn':
+                self.base_name = item
+            elif label == 'bt':
+                self.base_time = item
+            elif label == 'bv':
+                self.base_value = item
+        if value is None:
+            return None
+        if numeric and self.base_value:
+            value += self.base_value
+        if self.base_time is not None:
+            time = self.base_time + (time or 0)
+        return Record(to_path(self.base_name + name), time, value)
+
+
+def iter_json_records(payload: Union[str, bytes]) -> Iterator[Record]:
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8')
+    decoder = json.JSONDecoder()
+    resolver = Resolver()
+    position = skip_whitespace(payload, 0)
+    if payload[position:position + 1] != '[':
+        raise SenmlError('SenML JSON payload is not an array')
+    position = skip_whitespace(payload, position + 1)
+    if payload[position:position + 1] == ']':
+        return
+    while True:
+        fields, position = decoder.raw_decode(payload, position)
+        if not isinstance(fields, dict):
+            raise SenmlError('SenML JSON record is not an object')
+        record = resolver.resolve(fields.items())
+        if record is not None:
+            yield record
+        position = skip_whitespace(payload, position)
+        separator = payload[position:position + 1]
+        if separator == ']':
+            return
+        if separator != ',':
+            raise SenmlError(f'unexpected {separator!r} at {position} of SenML JSON payload')
+        position = skip_whitespace(payload, position + 1)
+
+
+def skip_whitespace(text: str, position: int) -> int:
+    while position < len(text) and text[position] in ' \t\n\r':
+        position += 1
+    return position
+
+
+class CborReader:
+    """Just enough of CBOR (RFC 8949) for SenML: no tags other than skipped ones, no nested containers in values."""
+
+    def __init__(self, data: bytes):
+        self.data = memoryview(data)
+        self.position = 0
+
+    def read_head(self) -> Tuple[int, int]:
+        """Returns the major type and the argument, -1 for indefinite lengths."""
+        try:
+            initial = self.data[self.position]
+        except IndexError:
+            raise SenmlError('truncated SenML CBOR payload')
+        self.position += 1
+        major, info = initial >> 5, initial & 0x1f
+        if info < 24:
+            return major, info
+        if info == 31:
+            return major, -1
+        size = {24: 1, 25: 2, 26: 4, 27: 8}.get(info)
+        if size is None:
+            raise SenmlError(f'invalid CBOR additional information {info}')
+        start = self.position
+        self.position += size
+        if self.position > len(self.data):
+            raise SenmlError('truncated SenML CBOR payload')
+        if major == 7 and size > 1:
+            # a float, read_simple unpacks it from the bytes just skipped
+            return major, -size
+        return major, int.from_bytes(self.data[start:self.position], 'big')
+
+    def at_break(self) -> bool:
+        if self.position < len(self.data) and self.data[self.position] == 0xff:
+            self.position += 1
+            return True
+        return False
+
+    def read_item(self, compact_floats: bool = False) -> Any:
+        major, argument = self.read_head()
+        while major == 6:
+            # tagged item, e.g. a date, the tag is irrelevant for SenML
+            major, argument = self.read_head()
+        if major == 0:
+            return argument
+        if major == 1:
+            return -1 - argument
+        if major in (2, 3):
+            if argument < 0:
+                chunks = []
+                while not self.at_break():
+                    chunks.append(self.read_item())
+                value = b''.join(chunk.encode('utf-8') if isinstance(chunk, str) else chunk for chunk in chunks)
+            else:
+                value = bytes(self.data[self.position:self.position + argument])
+                self.position += argument
+            return value if major == 2 else value.decode('utf-8')
+        if major == 7:
+            return self.read_simple(argument, compact_floats)
+        raise SenmlError(f'unexpected CBOR major type {major} in a SenML value')
+
+    def read_simple(self, argument: int, compact_floats: bool) -> Any:
+        if argument >= 0:
+            simple = {20: False, 21: True, 22: None}
+            if argument not in simple:
+                raise SenmlError(f'unsupported CBOR simple value {argument}')
+            return simple[argument]
+        size = -argument
+        raw = self.data[self.position - size:self.position]
+        value = struct.unpack({2: '>e', 4: '>f', 8: '>d'}[size], raw)[0]
+        if compact_floats and size < 8:
+            return shortest_float(value, size)
+        return value
+
+
+def shortest_float(value: float, size: int) -> float:
+    """
+    The shortest decimal which is the same half or single precision float, e.g. 21.6 instead of
+    21.600000381469727, the double closest to the float 21.6.
+    """
+    if not math.isfinite(value):
+        return value
+    fmt = '>e' if size == 2 else '>f'
+    packed = struct.pack(fmt, value)
+    # rounding to the precision's guaranteed decimal digits (3 or 6) already yields any shorter decimal,
+    # as %g drops trailing zeros
+    for digits in range(3 if size == 2 else 6, 10):
+        candidate = float(f'{value:.{digits}g}')
+        if struct.pack(fmt, candidate) == packed:
+            return candidate
+    return value
+
+
+def iter_cbor_records(payload: bytes, compact_floats: bool = False) -> Iterator[Record]:
+    reader = CborReader(payload)
+    resolver = Resolver()
+    major, count = reader.read_head()
+    if major != 4:
+        raise SenmlError('SenML CBOR payload is not an array')
+
+    def fields() -> Iterator[Tuple[str, Any]]:
+        map_major, pairs = reader.read_head()
+        if map_major != 5:
+            raise SenmlError('SenML CBOR record is not a map')
+        while not reader.at_break() if pairs < 0 else pairs > 0:
+            pairs -= 1
+            label = reader.read_item()
+            # labels not known to LwM2M (e.g. units, sums) are skipped, as long as they are simple values
+            yield CBOR_LABELS.get(label, label), reader.read_item(compact_floats)
+
+    remaining = count
+    while not reader.at_break() if count < 0 else remaining > 0:
+        remaining -= 1
+        record = resolver.resolve(fields())
+        if record is not None:
+            yield record
+
+
+def is_cbor(payload: bytes) -> bool:
+    """SenML CBOR starts with an array head, SenML JSON with '[' or whitespace."""
+    return bool(payload) and payload[0] >> 5 == 4
+
+
+def iter_records(payload: Union[str, bytes, list], compact_floats: bool = False) -> Iterator[Record]:
+    """
+    Accepts SenML JSON (text or bytes), SenML CBOR (bytes) or SenML JSON already parsed into a list
+    of record objects, e.g. by the IoT rule passing the result on.
+    """
+    if isinstance(payload, list):
+        resolver = Resolver()
+        for fields in payload:
+            record = resolver.resolve(fields.items())
+            if record is not None:
+                yield record
+    elif isinstance(payload, bytes) and is_cbor(payload):
+        yield from iter_cbor_records(payload, compact_floats)
+    else:
+        yield from iter_json_records(payload)
+
+
+def decode(payload: Union[str, bytes, list], compact_floats: bool = False) -> Dict[Path, Any]:
+    """Latest value of every path in the payload, in order of first appearance."""
+    values = {}
+    latest = {}
+    for path, time, value in iter_records(payload, compact_floats):
+        if time is None or time >= latest.get(path, -math.inf):
+            values[path] = value
+            if time is not None:
+                latest[path] = time
+    return values
+
+
+def to_json_value(value: Any, compact: bool = False) -> Any:
+    """Values as written to the shadow: opaque values base64 encoded and, if compact, integral floats as integers."""
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    if compact and isinstance(value, float) and value.is_integer() and abs(value) < 2 ** 53:
+        return int(value)
+    return value
+
+
+def decode_result(result: Union[str, list], compact: bool = False) -> Dict[Path, Any]:
+    """
+    Decodes an operation result passed on by an IoT rule: SenML JSON, either parsed or as text,
+    or base64 encoded SenML CBOR. Values are converted with to_json_value.
+    """
+    if isinstance(result, str) and not result.lstrip().startswith('['):
+        result = base64.b64decode(result)
+    return {path: to_json_value(value, compact) for path, value in decode(result, compact_floats=compact).items()}
+
+
+def is_senml(result: Any) -> bool:
+    return isinstance(result, str) or (isinstance(result, list) and all(isinstance(r, dict) for r in result))
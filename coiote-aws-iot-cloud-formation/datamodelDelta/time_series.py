@@ -0,0 +1,142 @@
+import bisect
+import itertools
+import math
+from array import array
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+try:
+    import numpy
+except ImportError:
+    # not packaged with the lambda by default, queries fall back to the array module
+    numpy = None
+
+# timestamp and value, both doubles
+SAMPLE_BYTES = 16
+AGGREGATES = ('min', 'max', 'mean', 'last')
+
+
+class RingBuffer:
+    """
+    The most recent samples of a single observed resource, in two preallocated columns of doubles.
+    Samples are expected in timestamp order, older ones than the last are dropped.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.start = 0
+        self.count = 0
+        # timestamp of the last value written to a shadow, kept by the caller
+        self.published_at = -math.inf
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def last_timestamp(self) -> float:
+        """-inf if there are no samples."""
+        if not self.count:
+            return -math.inf
+        return self.timestamps[(self.start + self.count - 1) % self.capacity]
+
+    def append(self, timestamp: float, value: float) -> bool:
+        if timestamp < self.last_timestamp:
+            return False
+        end = (self.start + self.count) % self.capacity
+        self.timestamps[end] = timestamp
+        self.values[end] = value
+        if self.count < self.capacity:
+            self.count += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+        return True
+
+    def _segments(self) -> List[Tuple[int, int]]:
+        end = self.start + self.count
+        if end <= self.capacity:
+            return [(self.start, end)]
+        return [(self.start, self.capacity), (0, end - self.capacity)]
+
+    def window(self, since: float = -math.inf) -> Tuple[Sequence[float], Sequence[float]]:
+        """Timestamps and values of the samples not older than since, oldest first."""
+        if numpy is not None:
+            timestamps = numpy.frombuffer(self.timestamps)
+            values = numpy.frombuffer(self.values)
+            segments = self._segments()
+            if len(segments) == 1:
+                (lo, hi), = segments
+                timestamps, values = timestamps[lo:hi], values[lo:hi]
+            else:
+                timestamps = numpy.concatenate([timestamps[lo:hi] for lo, hi in segments])
+                values = numpy.concatenate([values[lo:hi] for lo, hi in segments])
+            first = int(numpy.searchsorted(timestamps, since))
+        else:
+            timestamps = array('d')
+            values = array('d')
+            for lo, hi in self._segments():
+                timestamps += self.timestamps[lo:hi]
+                values += self.values[lo:hi]
+            first = bisect.bisect_left(timestamps, since)
+        return timestamps[first:], values[first:]
+
+    def query(self, since: float = -math.inf) -> Optional[Dict[str, float]]:
+        """Min, max, mean and last value of the samples not older than since, None if there are none."""
+        _, values = self.window(since)
+        if not len(values):
+            return None
+        if numpy is not None:
+            return {'min': float(values.min()), 'max': float(values.max()), 'mean': float(values.mean()),
+                    'last': float(values[-1])}
+        return {'min': min(values), 'max': max(values), 'mean': math.fsum(values) / len(values), 'last': values[-1]}
+
+    def downsample(self, bucket_seconds: float, since: float = -math.inf) -> List[Tuple[float, float]]:
+        """Mean value of the samples in each bucket_seconds long bucket, as (bucket start, mean) pairs."""
+        timestamps, values = self.window(since)
+        if not len(values):
+            return []
+        if numpy is not None:
+            buckets = numpy.floor(timestamps / bucket_seconds)
+            starts, first = numpy.unique(buckets, return_index=True)
+            sums = numpy.add.reduceat(values, first)
+            counts = numpy.diff(numpy.append(first, len(values)))
+            return list(zip((starts * bucket_seconds).tolist(), (sums / counts).tolist()))
+        downsampled = []
+        buckets = itertools.groupby(zip(timestamps, values), key=lambda sample: math.floor(sample[0] / bucket_seconds))
+        for bucket, samples in buckets:
+            bucket_values = [value for _, value in samples]
+            downsampled.append((bucket * bucket_seconds, math.fsum(bucket_values) / len(bucket_values)))
+        return downsampled
+
+
+class TimeSeriesStore:
+    """Ring buffers of observed resources, evicting the least recently updated ones above max_bytes of samples."""
+
+    def __init__(self, max_bytes: int, capacity: int):
+        self.capacity = capacity
+        self.max_series = max(1, max_bytes // (capacity * SAMPLE_BYTES))
+        self.evictions = 0
+        self._series: 'OrderedDict[Hashable, RingBuffer]' = OrderedDict()
+
+    def __len__(self):
+        return len(self._series)
+
+    @property
+    def memory_bytes(self) -> int:
+        return len(self._series) * self.capacity * SAMPLE_BYTES
+
+    def get(self, key: Hashable) -> Optional[RingBuffer]:
+        return self._series.get(key)
+
+    def add(self, key: Hashable, timestamp: float, value: float) -> RingBuffer:
+        series = self._series.get(key)
+        if series is None:
+            while len(self._series) >= self.max_series:
+                self._series.popitem(last=False)
+                self.evictions += 1
+            series = self._series[key] = RingBuffer(self.capacity)
+        else:
+            self._series.move_to_end(key)
+        series.append(timestamp, value)
+        return series
@@ -0,0 +1,295 @@
+import random
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+import instrumentation
+from resilience import Deadline, NotSentError
+
+HIGH_PRIORITY = 'high'
+LOW_PRIORITY = 'low'
+
+
+class AdmissionRejectedError(NotSentError):
+    """
+    The request would have to wait for admission longer than allowed. statusCode is 503 while Coiote DM
+    has asked to back off, 429 if the configured rate is exceeded; retryAfter is in seconds.
+    """
+
+    def __init__(self, message: str, statusCode: int, retryAfter: float):
+        super().__init__(message)
+        self.statusCode = statusCode
+        self.retryAfter = retryAfter
+
+
+class AdmissionBackend:
+    """
+    Token bucket state, kept either by a single container or shared by all of them. Tokens are reserved
+    ahead of time: a bucket may go below zero, and the caller then waits until its token would have been refilled.
+    """
+
+    def reserve(self, bucket: str, rate: float, burst: float, reserve: float, max_wait: float,
+                tokens: int) -> Optional[float]:
+        """
+        Takes tokens from the bucket, leaving at least reserve tokens in it, and returns how long the caller
+        has to wait for them. Returns None without taking anything if that would be longer than max_wait.
+        """
+        raise NotImplementedError
+
+    def refund(self, bucket: str, tokens: int):
+        raise NotImplementedError
+
+    def pause(self, until: float):
+        """Stops admitting requests until the given time.time(), e.g. after Coiote DM responded with Retry-After."""
+        raise NotImplementedError
+
+    def paused_until(self) -> float:
+        raise NotImplementedError
+
+
+def parse_operation_rates(value: str) -> Dict[str, float]:
+    """'read=20,observe=5' -> {'read': 20.0, 'observe': 5.0}"""
+    rates = {}
+    for item in filter(None, value.split(',')):
+        operation, _, rate = item.partition('=')
+        rates[operation.strip()] = float(rate)
+    return rates
+
+
+def refill(tokens: float, updated_at: float, now: float, rate: float, burst: float) -> float:
+    return min(burst, tokens + (now - updated_at) * rate)
+
+
+def wait_for_tokens(available: float, rate: float, reserve: float, tokens: int) -> float:
+    return max(0.0, (tokens + reserve - available) / rate)
+
+
+class LocalAdmissionBackend(AdmissionBackend):
+    """Limits the calls of a single container; with N concurrent containers, Coiote DM gets up to N times the rate."""
+
+    def __init__(self):
+        # bucket -> (tokens, time.time() of the last update)
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, bucket: str, rate: float, burst: float, reserve: float, max_wait: float,
+                tokens: int) -> Optional[float]:
+        with self._lock:
+            now = time.time()
+            available, updated_at = self._buckets.get(bucket, (burst, now))
+            available = refill(available, updated_at, now, rate, burst)
+            wait = wait_for_tokens(available, rate, reserve, tokens)
+            if wait > max_wait:
+                self._buckets[bucket] = (available, now)
+                return None
+            self._buckets[bucket] = (available - tokens, now)
+            return wait
+
+    def refund(self, bucket: str, tokens: int):
+        with self._lock:
+            available, updated_at = self._buckets[bucket]
+            self._buckets[bucket] = (available + tokens, updated_at)
+
+    def pause(self, until: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, until)
+
+    def paused_until(self) -> float:
+        return self._paused_until
+
+
+class DynamoDbAdmissionBackend(AdmissionBackend):
+    """
+    Limits the calls of all containers together. Every bucket is an item of the table, whose partition key
+    is the string attribute bucket, updated with optimistic locking on its version attribute, which every write
+    increments; this adds three DynamoDB calls per admission.
+    """
+
+    PAUSE_ITEM = '#pause'
+    MAX_CONFLICTS = 10
+
+    def __init__(self, table_name: str):
+        self.table_name = table_name
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    def get_client(self):
+        # boto3 clients cannot be created concurrently, reserve may be called by several workers at once
+        with self._client_lock:
+            if self._client is None:
+                import boto3
+                self._client = boto3.client('dynamodb')
+            return self._client
+
+    def _get(self, bucket: str) -> Optional[dict]:
+        return self.get_client().get_item(TableName=self.table_name, Key={'bucket': {'S': bucket}},
+                                          ConsistentRead=True).get('Item')
+
+    def _update(self, bucket: str, item: Optional[dict], **values: float) -> bool:
+        """Writes the values if the item has not changed since it has been read, returns False otherwise."""
+        client = self.get_client()
+        # bucket is a reserved word in DynamoDB expressions, so attribute names are passed as placeholders
+        version = 0
+        if item is None:
+            condition = 'attribute_not_exists(#bucket)'
+            condition_names = {'#bucket': 'bucket'}
+            condition_values = {}
+        elif 'version' not in item:
+            # written before items were versioned
+            condition = 'attribute_not_exists(#version) AND updatedAt = :previous'
+            condition_names = {'#version': 'version'}
+            condition_values = {':previous': item['updatedAt']}
+        else:
+            version = int(item['version']['N'])
+            condition = '#version = :previous'
+            condition_names = {'#version': 'version'}
+            condition_values = {':previous': item['version']}
+        try:
+            client.put_item(
+                TableName=self.table_name,
+                Item={'bucket': {'S': bucket}, 'version': {'N': str(version + 1)},
+                      **{name: {'N': repr(value)} for name, value in values.items()}},
+                ConditionExpression=condition,
+                ExpressionAttributeNames=condition_names,
+                **({'ExpressionAttributeValues': condition_values} if condition_values else {})
+            )
+            return True
+        except client.exceptions.ConditionalCheckFailedException:
+            instrumentation.count('admissionConflicts')
+            return False
+
+    def reserve(self, bucket: str, rate: float, burst: float, reserve: float, max_wait: float,
+                tokens: int) -> Optional[float]:
+        for _ in range(self.MAX_CONFLICTS):
+            item = self._get(bucket)
+            now = time.time()
+            if item is None:
+                available = burst
+            else:
+                available = refill(float(item['tokens']['N']), float(item['updatedAt']['N']), now, rate, burst)
+            wait = wait_for_tokens(available, rate, reserve, tokens)
+            if wait > max_wait:
+                return None
+            if self._update(bucket, item, tokens=available - tokens, updatedAt=now):
+                return wait
+        # heavily contended, treat it as if the rate has been exceeded
+        return None
+
+    def refund(self, bucket: str, tokens: int):
+        for _ in range(self.MAX_CONFLICTS):
+            item = self._get(bucket)
+            if item is None or self._update(bucket, item, tokens=float(item['tokens']['N']) + tokens,
+                                            updatedAt=float(item['updatedAt']['N'])):
+                return
+
+    def pause(self, until: float):
+        client = self.get_client()
+        try:
+            client.update_item(
+                TableName=self.table_name,
+                Key={'bucket': {'S': self.PAUSE_ITEM}},
+                UpdateExpression='SET pausedUntil = :until',
+                ConditionExpression='attribute_not_exists(pausedUntil) OR pausedUntil < :until',
+                ExpressionAttributeValues={':until': {'N': repr(until)}}
+            )
+        except client.exceptions.ConditionalCheckFailedException:
+            # another container has already paused admissions for longer
+            pass
+
+    def paused_until(self) -> float:
+        item = self._get(self.PAUSE_ITEM)
+        return float(item['pausedUntil']['N']) if item is not None else 0.0
+
+
+class AdmissionController:
+    """
+    Admits Coiote DM calls at rate per second (plus a burst), with optional lower limits for single operations.
+    High priority operations get ahead of low priority ones, which also cannot use the last reserve tokens
+    of the common bucket. An operation waits for admission at most max_wait seconds.
+
+    When Coiote DM responds with 429 or 503, admissions are paused for its Retry-After and the rate is halved;
+    it recovers by 1% of the configured rate with every call which has not been throttled.
+    """
+
+    def __init__(self, backend: AdmissionBackend, rate: float, burst: float, operation_rates: Dict[str, float],
+                 high_priority_operations: Iterable[str], reserve: float, max_wait: float):
+        self.backend = backend
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.operation_rates = operation_rates
+        self.high_priority_operations = frozenset(high_priority_operations)
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+
+    def priority(self, operation: str) -> str:
+        return HIGH_PRIORITY if operation in self.high_priority_operations else LOW_PRIORITY
+
+    def acquire(self, operation: str, deadline: Deadline, calls: int = 1):
+        """
+        Waits until the calls may be sent, raises AdmissionRejectedError if it would be after max_wait.
+        High priority operations reserve their tokens ahead of time and sleep until they are due. Low priority
+        ones only take tokens which are already there and left over by high priority ones, polling until then.
+        """
+        max_wait = min(self.max_wait, deadline.remaining())
+        paused_for = self.backend.paused_until() - time.time()
+        if paused_for > max_wait:
+            instrumentation.count('admissionRejected')
+            raise AdmissionRejectedError('Coiote DM asked to back off, operation not scheduled', 503, paused_for)
+        if paused_for > 0:
+            max_wait -= paused_for
+            with instrumentation.phase('admissionWait'):
+                time.sleep(paused_for)
+
+        high_priority = self.priority(operation) == HIGH_PRIORITY
+        give_up_at = time.monotonic() + max_wait
+        with instrumentation.phase('admissionWait'):
+            while True:
+                wait = self._reserve(operation, calls, high_priority, max_wait if high_priority else 0.0)
+                if wait is not None:
+                    time.sleep(wait)
+                    return
+                remaining = give_up_at - time.monotonic()
+                if high_priority or remaining <= 0:
+                    instrumentation.count('admissionRejected')
+                    raise AdmissionRejectedError(
+                        f'rate of Coiote DM calls exceeded, {operation} operation not scheduled', 429,
+                        max_wait + calls / self.rate)
+                instrumentation.count('admissionWaits')
+                time.sleep(min(remaining, random.uniform(0.5, 1.5) * calls / self.rate))
+
+    def _reserve(self, operation: str, calls: int, high_priority: bool, max_wait: float) -> Optional[float]:
+        # (bucket, rate, burst, reserve); an operation's own bucket holds at most a second worth of calls.
+        # Buckets hold at least the calls admitted at once plus the reserve, otherwise low priority operations,
+        # which do not wait for tokens, would never be admitted, even by idle buckets
+        buckets = []
+        if operation in self.operation_rates:
+            operation_rate = self.operation_rates[operation]
+            buckets.append(('operation:' + operation, operation_rate, max(1.0, operation_rate, calls), 0.0))
+        reserve = 0.0 if high_priority else self.reserve
+        buckets.append(('coiote', self.rate, max(self.burst, calls + reserve), reserve))
+
+        reserved = []
+        wait = 0.0
+        for bucket, rate, burst, reserve in buckets:
+            bucket_wait = self.backend.reserve(bucket, rate, burst, reserve, max_wait, calls)
+            if bucket_wait is None:
+                for reserved_bucket in reserved:
+                    self.backend.refund(reserved_bucket, calls)
+                return None
+            reserved.append(bucket)
+            wait = max(wait, bucket_wait)
+        return wait
+
+    def throttled(self, retry_after: float):
+        instrumentation.count('coioteThrottled')
+        self.backend.pause(time.time() + retry_after)
+        with self._lock:
+            self.rate = max(self.max_rate / 100, self.rate / 2)
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
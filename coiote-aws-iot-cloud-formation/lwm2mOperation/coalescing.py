@@ -0,0 +1,116 @@
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from lwm2m_paths import parse_path, prune_paths
+from operations import ROOT_PATHS, OperationHttpStatus
+
+# Operations merged with adjacent operations of the same kind
+MERGED_READS = ('read', 'readComposite')
+MERGED_WRITES = ('write',)
+
+
+def merge_reads(events: List[dict]) -> dict:
+    """Union of the read paths, with paths covered by other paths pruned."""
+    keys = [key for event in events for key in event['keys']]
+    if any(key in ROOT_PATHS for key in keys):
+        merged_keys = ['all']
+    else:
+        merged_keys = prune_paths(keys)
+    return dict(events[-1], keys=merged_keys)
+
+
+def merge_writes(events: List[dict]) -> dict:
+    """Every path is written once, with the value of the last write to it."""
+    values_by_path = {}
+    for event in events:
+        for key, value in zip(event['keys'], event['values']):
+            path = parse_path(key)
+            # keep the position of the first write but the spelling of the last one
+            values_by_path[path] = (key, value)
+    return dict(events[-1],
+                keys=[key for key, _ in values_by_path.values()],
+                values=[value for _, value in values_by_path.values()])
+
+
+def merge_operations(events: List[dict]) -> List[dict]:
+    """
+    Merges runs of adjacent compatible operations on a single thing, keeping their order otherwise,
+    e.g. [read A, read B, write X, read C] becomes [read A+B, write X, read C]. Events have to be valid,
+    i.e. accepted by build_operation_body.
+    """
+    merged = []
+    run: List[dict] = []
+    for event in events:
+        if run and run[-1]['operation'] != event['operation']:
+            merged.extend(merge_run(run))
+            run = []
+        run.append(event)
+    if run:
+        merged.extend(merge_run(run))
+    return merged
+
+
+def merge_run(run: List[dict]) -> List[dict]:
+    operation = run[0]['operation']
+    if len(run) > 1 and operation in MERGED_READS:
+        return [merge_reads(run)]
+    if len(run) > 1 and operation in MERGED_WRITES:
+        return [merge_writes(run)]
+    return run
+
+
+class CoalescingWindow:
+    """
+    Operations buffered for a thing, and the result of dispatching them merged. Every operation of the window
+    gets that result, so that none is reported as done while the merged dispatch may still fail.
+    """
+
+    def __init__(self):
+        self.events: List[dict] = []
+        self._result: Optional[OperationHttpStatus] = None
+        self._done = threading.Event()
+
+    def set_result(self, result: OperationHttpStatus):
+        self._result = result
+        self._done.set()
+
+    def wait(self, timeout: float) -> Optional[OperationHttpStatus]:
+        """Returns None if the result is not there within timeout seconds."""
+        return self._result if self._done.wait(timeout) else None
+
+
+class CoalescingStore:
+    """
+    Buffers operations per thing for the duration of a coalescing window. The first operation
+    appended to an empty buffer makes its caller the leader, which drains the buffer once
+    the window has passed, dispatches the merged operations and sets the window's result.
+    """
+
+    def append(self, thingName: str, event: dict) -> Tuple[CoalescingWindow, bool]:
+        """Returns the thing's current window and True if the caller became its leader."""
+        raise NotImplementedError
+
+    def drain(self, thingName: str) -> CoalescingWindow:
+        """Closes the window, operations appended later start a new one."""
+        raise NotImplementedError
+
+
+class InMemoryCoalescingStore(CoalescingStore):
+    """
+    Coalesces operations handled concurrently within a single container, i.e. the records of an SQS batch.
+    Invocations through lambda_handler are handled one at a time by a container, so they are never merged.
+    """
+
+    def __init__(self):
+        self._windows: Dict[str, CoalescingWindow] = {}
+        self._lock = threading.Lock()
+
+    def append(self, thingName: str, event: dict) -> Tuple[CoalescingWindow, bool]:
+        with self._lock:
+            window = self._windows.setdefault(thingName, CoalescingWindow())
+            window.events.append(event)
+            return window, len(window.events) == 1
+
+    def drain(self, thingName: str) -> CoalescingWindow:
+        with self._lock:
+            return self._windows.pop(thingName)
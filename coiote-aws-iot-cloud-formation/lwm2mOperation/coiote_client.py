@@ -0,0 +1,238 @@
+import functools
+import json
+import os
+import ssl
+import threading
+import time
+from tempfile import NamedTemporaryFile
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional
+
+import instrumentation
+# ConfigurationError is raised by the lambdas' own checks as well, it is imported from here by them
+from settings import ConfigurationError, Setting
+
+# boto3 and requests take ~100 ms to import, they are imported on first use instead,
+# so that invocations which do not call Coiote DM (e.g. device state updates) do not pay for them
+if TYPE_CHECKING:
+    import requests
+
+API_PATH = '/api/coiotedm/v3'
+COIOTE_HEADERS = {'Authorization': 'Certificate'}
+
+CERT_SECRET_NAME = 'coioteDMcert'
+# How long (in seconds) a warm container trusts its cached certificate
+# before checking Secrets Manager for a rotated version
+CERT_CACHE_TTL = Setting('coioteDMcertCacheTtl', 300.0)
+# Maximum number of keep-alive connections kept open to Coiote DM
+POOL_SIZE = Setting('coioteDMpoolSize', 10, int, minimum=1)
+# Pooled connections unused for longer than this (in seconds) are dropped instead of reused,
+# as Coiote DM or a load balancer in front of it has most likely closed them already
+IDLE_TIMEOUT = Setting('coioteDMidleTimeout', 60.0)
+
+
+class CertificateUnavailableError(Exception):
+    """The certificate could not be fetched from Secrets Manager, so nothing has been sent to Coiote DM."""
+
+
+@dataclass
+class UserAuthCert:
+    certificatePem: str
+    privateKey: str
+    versionId: str
+
+
+@functools.lru_cache(maxsize=None)
+def coiote_adapter_class():
+    from requests.adapters import HTTPAdapter
+
+    class CoioteAdapter(HTTPAdapter):
+        """
+        Transport adapter that authenticates with an SSLContext holding the client certificate,
+        so the certificate is not reloaded from disk on every TLS handshake.
+        """
+
+        def __init__(self, ssl_context: ssl.SSLContext, **kwargs):
+            self.ssl_context = ssl_context
+            super().__init__(**kwargs)
+
+        def init_poolmanager(self, *args, **kwargs):
+            kwargs['ssl_context'] = self.ssl_context
+            return super().init_poolmanager(*args, **kwargs)
+
+    return CoioteAdapter
+
+
+@dataclass
+class CoioteSession:
+    session: 'requests.Session'
+    versionId: str
+    fetchedAt: float
+    lastUsedAt: float
+
+
+# All survive between invocations of a warm Lambda container
+_rest_uri: Optional[str] = None
+_secrets_manager_client = None
+_coiote_session: Optional[CoioteSession] = None
+# fan-out, SQS and hedge threads share the session, so it is checked, rotated and closed under this lock;
+# reentrant, as get_session refreshes the session while holding it
+_session_lock = threading.RLock()
+
+
+def get_rest_uri() -> str:
+    """
+    Coiote DM's API URL, read from coioteDMrestUri on first use, so that a missing or invalid
+    variable fails the invocation with a clear error instead of the import of the lambda.
+    """
+    global _rest_uri
+    if _rest_uri is None:
+        rest_uri = os.environ.get('coioteDMrestUri', '')
+        if not rest_uri:
+            raise ConfigurationError('coioteDMrestUri environment variable is not set')
+        if not rest_uri.startswith('https://'):
+            raise ConfigurationError(f'coioteDMrestUri must be an https:// URL, got {rest_uri}')
+        _rest_uri = rest_uri.rstrip('/') + API_PATH
+    return _rest_uri
+
+
+def get_secrets_manager_client():
+    global _secrets_manager_client
+    if _secrets_manager_client is None:
+        import boto3
+        _secrets_manager_client = boto3.session.Session().client('secretsmanager')
+    return _secrets_manager_client
+
+
+def get_user_auth_cert() -> UserAuthCert:
+    client = get_secrets_manager_client()
+
+    try:
+        get_secret_value_response = client.get_secret_value(
+            SecretId=CERT_SECRET_NAME
+        )
+    except Exception as e:
+        raise CertificateUnavailableError(f'Coiote DM certificate could not be fetched from Secrets Manager: {e}')
+
+    if 'SecretString' not in get_secret_value_response:
+        raise ConfigurationError('Coiote DM certificate are not set up correctly')
+
+    secrets_map = json.JSONDecoder().decode(get_secret_value_response['SecretString'])
+
+    certificate_pem_key = 'certificatePem'
+    private_key_key = 'privateKey'
+
+    expected_keys_set = {certificate_pem_key, private_key_key}
+    fetched_keys_set = set(secrets_map.keys())
+
+    if expected_keys_set.issubset(fetched_keys_set):
+        return UserAuthCert(
+            certificatePem=secrets_map[certificate_pem_key],
+            privateKey=secrets_map[private_key_key],
+            versionId=get_secret_value_response.get('VersionId', '')
+        )
+    else:
+        raise ConfigurationError(
+            f'Secret in Secrets Manager does not have all required keys ({", ".join(expected_keys_set)})')
+
+
+def build_ssl_context(user_auth_cert: UserAuthCert) -> ssl.SSLContext:
+    """
+    ssl can load a certificate chain only from files, so the PEMs are written to /tmp
+    just for the duration of load_cert_chain and kept in memory afterwards.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    # equivalent of verify=False used for Coiote DM so far
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+
+    certificate_pem = NamedTemporaryFile(delete=False)
+    private_key = NamedTemporaryFile(delete=False)
+    try:
+        with certificate_pem, private_key:
+            certificate_pem.write(str.encode(user_auth_cert.certificatePem))
+            private_key.write(str.encode(user_auth_cert.privateKey))
+        context.load_cert_chain(certificate_pem.name, private_key.name)
+    finally:
+        os.unlink(certificate_pem.name)
+        os.unlink(private_key.name)
+    return context
+
+
+def build_session(ssl_context: ssl.SSLContext) -> 'requests.Session':
+    import requests
+    session = requests.Session()
+    session.headers.update(COIOTE_HEADERS)
+    adapter = coiote_adapter_class()(ssl_context, pool_connections=1, pool_maxsize=POOL_SIZE.get())
+    session.mount('https://', adapter)
+    return session
+
+
+def refresh_session(rejected: Optional['requests.Session'] = None) -> bool:
+    """
+    Fetches the certificate from Secrets Manager and rebuilds the session only if
+    the secret's VersionId has changed. Returns True if a new version has been loaded,
+    or if the rejected session has already been replaced by another thread in the meantime.
+    """
+    global _coiote_session
+    with _session_lock:
+        cached = _coiote_session
+        if rejected is not None and cached is not None and cached.session is not rejected:
+            return True
+        with instrumentation.phase('secretFetch'):
+            user_auth_cert = get_user_auth_cert()
+        now = time.monotonic()
+        if cached is not None and cached.versionId == user_auth_cert.versionId:
+            cached.fetchedAt = now
+            return False
+
+        with instrumentation.phase('sslContext'):
+            ssl_context = build_ssl_context(user_auth_cert)
+        _coiote_session = CoioteSession(
+            session=build_session(ssl_context),
+            versionId=user_auth_cert.versionId,
+            fetchedAt=now,
+            lastUsedAt=now
+        )
+        if cached is not None:
+            # closes the idle pooled connections; requests still running on the old session
+            # finish on theirs, which are then closed instead of being returned to the pool
+            cached.session.close()
+        return True
+
+
+def get_session() -> 'requests.Session':
+    with _session_lock:
+        now = time.monotonic()
+        cached = _coiote_session
+        if cached is None or now - cached.fetchedAt >= CERT_CACHE_TTL.get():
+            refresh_session()
+            cached = _coiote_session
+        elif now - cached.lastUsedAt >= IDLE_TIMEOUT.get():
+            # drops pooled connections, the adapter opens new ones on demand
+            cached.session.close()
+        cached.lastUsedAt = now
+        return cached.session
+
+
+def coiote_request(method: str, path: str, **kwargs) -> 'requests.Response':
+    """
+    Sends a certificate-authenticated request to Coiote DM over the pooled session.
+    If Coiote rejects the certificate (TLS error or 401), the certificate is refetched
+    and the request is retried once, but only if the secret has been rotated in the meantime.
+    """
+    import requests
+    url = get_rest_uri() + path
+    # verify is passed per request, as session.verify would be overridden by REQUESTS_CA_BUNDLE
+    kwargs['verify'] = False
+    session = get_session()
+    try:
+        response = session.request(method, url, **kwargs)
+    except requests.exceptions.SSLError:
+        if not refresh_session(rejected=session):
+            raise
+    else:
+        if response.status_code != 401 or not refresh_session(rejected=session):
+            return response
+
+    return get_session().request(method, url, **kwargs)
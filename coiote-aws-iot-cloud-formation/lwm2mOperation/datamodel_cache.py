@@ -0,0 +1,168 @@
+"""
+Read-through cache of the datamodel shadow, in which the results of read operations end up, with the time
+each resource was last reported there (from the shadow's metadata). Lets read operations with maxAge be
+answered without Coiote DM when the requested resources have been reported recently enough.
+
+With datamodelDeltaUpdates, only changed resources are written to the shadow, so an unchanged resource
+looks as old as its last change and is read from the device again; the cache never serves stale values.
+
+Results answered from the cache are reported to the operation shadow like the ones reported by Coiote DM,
+with a clientToken starting with CACHED_RESULT_TOKEN, which the rules handling operation results skip,
+so that the cached values are not written back to the datamodel shadow as freshly reported ones.
+"""
+import bisect
+import json
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from lwm2m_paths import parse_path
+from ttl_cache import TtlLruCache
+
+DATAMODEL_SHADOW = 'datamodel'
+OPERATION_SHADOW = 'operation'
+# prefix of the clientToken of results reported from the cache, also used in the rules of cloudFormation.json
+CACHED_RESULT_TOKEN = 'datamodelCache:'
+# limit of shadow update clientTokens
+MAX_CLIENT_TOKEN_LENGTH = 64
+
+# Path of a resource in the datamodel shadow, e.g. ('3303', '0', '5700')
+Path = Tuple[str, ...]
+
+
+class Leaf(NamedTuple):
+    value: Any
+    # time.time() at which the value was last written to the shadow
+    timestamp: float
+
+
+class CachedDatamodel(NamedTuple):
+    leaves: Dict[Path, Leaf]
+    # paths of the leaves, sorted, so that the leaves under a path are a contiguous range
+    paths: List[Path]
+    # time.time() at which the shadow was fetched
+    fetchedAt: float
+
+    def covered(self, prefix: Path) -> List[Path]:
+        """Paths of the leaves at or under prefix."""
+        covered = []
+        for i in range(bisect.bisect_left(self.paths, prefix), len(self.paths)):
+            path = self.paths[i]
+            if path[:len(prefix)] != prefix:
+                break
+            covered.append(path)
+        return covered
+
+
+def leaf_timestamp(metadata: Any) -> float:
+    """Metadata of an array is an array of per-element metadata, its oldest element counts."""
+    if isinstance(metadata, dict):
+        return float(metadata.get('timestamp', 0))
+    if isinstance(metadata, list):
+        return min((leaf_timestamp(element) for element in metadata), default=0.0)
+    return 0.0
+
+
+def flatten_with_timestamps(reported: dict, metadata: dict) -> Dict[Path, Leaf]:
+    """An empty reported state has no leaves."""
+    leaves = {}
+    stack = [((), reported, metadata)]
+    while stack:
+        prefix, node, node_metadata = stack.pop()
+        if isinstance(node, dict) and node:
+            # reversed, so that children are popped in document order
+            for key, value in reversed(list(node.items())):
+                child_metadata = node_metadata.get(key, {}) if isinstance(node_metadata, dict) else {}
+                stack.append((prefix + (key,), value, child_metadata))
+        elif prefix:
+            leaves[prefix] = Leaf(node, leaf_timestamp(node_metadata))
+    return leaves
+
+
+def to_shadow_path(key: str) -> Path:
+    """'3303.0.5700' or '/3303/0/5700' -> ('3303', '0', '5700')"""
+    return tuple(str(segment) for segment in parse_path(key))
+
+
+def unflatten(leaves: Dict[Path, Any]) -> dict:
+    document = {}
+    for path, value in leaves.items():
+        node = document
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node[path[-1]] = value
+    return document
+
+
+class DatamodelCache:
+    """
+    thingName -> leaves of its datamodel shadow, kept between invocations of a warm Lambda container.
+    A cached shadow can only miss newer reports, so it is fetched again only if it does not have
+    fresh enough values and has not been fetched within the last refresh_interval seconds.
+    """
+
+    def __init__(self, max_size: int, ttl: float, refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self._entries = TtlLruCache(max_size=max_size, ttl=ttl)
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    def get_client(self):
+        # fan-out workers may look shadows up concurrently, and boto3 clients cannot be created that way
+        with self._client_lock:
+            if self._client is None:
+                import boto3
+                self._client = boto3.client('iot-data')
+            return self._client
+
+    def fetch(self, thingName: str) -> CachedDatamodel:
+        client = self.get_client()
+        fetched_at = time.time()
+        try:
+            response = client.get_thing_shadow(thingName=thingName, shadowName=DATAMODEL_SHADOW)
+        except client.exceptions.ResourceNotFoundException:
+            leaves = {}
+        else:
+            document = json.loads(response['payload'].read())
+            reported = document.get('state', {}).get('reported', {})
+            metadata = document.get('metadata', {}).get('reported', {})
+            leaves = flatten_with_timestamps(reported, metadata) if isinstance(reported, dict) else {}
+        entry = CachedDatamodel(leaves, sorted(leaves), fetched_at)
+        self._entries.put(thingName, entry)
+        return entry
+
+    def report_result(self, thingName: str, operation: str, result: dict, clientToken: Optional[str]):
+        """Reports a result answered from the cache to the operation shadow, where clients wait for it."""
+        payload = {
+            'state': {'reported': {'operation': operation, 'result': result}},
+            'clientToken': (CACHED_RESULT_TOKEN + (clientToken or ''))[:MAX_CLIENT_TOKEN_LENGTH]
+        }
+        self.get_client().update_thing_shadow(thingName=thingName, shadowName=OPERATION_SHADOW,
+                                              payload=json.dumps(payload).encode('utf-8'))
+
+    def split_fresh(self, thingName: str, keys: List[str], max_age: float) -> Tuple[Dict[Path, Any], List[str]]:
+        """
+        Splits already pruned keys into the values of those whose resources have all been reported within
+        the last max_age seconds, and the stale ones, which have to be read from the device.
+        """
+        entry: Optional[CachedDatamodel] = self._entries.get(thingName, None)
+        if entry is None:
+            entry = self.fetch(thingName)
+        values, stale = self._split(entry, keys, max_age)
+        if stale and time.time() - entry.fetchedAt >= self.refresh_interval:
+            values, stale = self._split(self.fetch(thingName), keys, max_age)
+        return values, stale
+
+    @staticmethod
+    def _split(entry: CachedDatamodel, keys: List[str], max_age: float) -> Tuple[Dict[Path, Any], List[str]]:
+        reported_since = time.time() - max_age
+        values = {}
+        stale = []
+        for key in keys:
+            covered = entry.covered(to_shadow_path(key))
+            # a path without any reported resources is unknown, not fresh
+            if covered and all(entry.leaves[path].timestamp >= reported_since for path in covered):
+                values.update((path, entry.leaves[path].value) for path in covered)
+            else:
+                stale.append(key)
+        return values, stale
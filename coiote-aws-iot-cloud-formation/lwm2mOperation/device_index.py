@@ -0,0 +1,110 @@
+"""
+Prebuilt endpointName -> Coiote DM device id index, built by sync_device_index.py and read by lambda_function
+before falling back to looking devices up in Coiote DM one at a time.
+
+The index file is memory-mapped and binary-searched in place, so opening it costs the same for any fleet size
+and only the pages touched by lookups are read. Layout (integers are little-endian uint32):
+
+    magic (4 bytes) | version | count | metadata length | metadata (JSON)
+    offsets: count + 1 offsets of the records, relative to the first record
+    records: endpointName, NUL, device id (UTF-8), sorted by endpointName
+"""
+import json
+import mmap
+import os
+import struct
+from typing import Iterable, Iterator, Optional, Tuple
+
+MAGIC = b'CDIX'
+VERSION = 1
+HEADER = struct.Struct('<4sIII')
+OFFSET = struct.Struct('<I')
+
+
+class DeviceIndex:
+    """Raises ValueError or struct.error if the file is not a complete index (e.g. truncated or corrupt)."""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._read_header(path)
+        except BaseException:
+            self._map.close()
+            raise
+
+    def _read_header(self, path: str):
+        magic, version, self.count, metadata_length = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a version {VERSION} device index')
+        metadata_start = HEADER.size
+        self.metadata = json.loads(self._map[metadata_start:metadata_start + metadata_length])
+        self._offsets_start = metadata_start + metadata_length
+        self._records_start = self._offsets_start + (self.count + 1) * OFFSET.size
+        # the last offset is the end of the records, which is the end of the file
+        records_end, = OFFSET.unpack_from(self._map, self._records_start - OFFSET.size)
+        if self._records_start + records_end != len(self._map):
+            raise ValueError(f'{path} is truncated or corrupt')
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _record(self, i: int) -> bytes:
+        start, end = struct.unpack_from('<2I', self._map, self._offsets_start + i * OFFSET.size)
+        return self._map[self._records_start + start:self._records_start + end]
+
+    def get(self, endpoint_name: str) -> Optional[str]:
+        key = endpoint_name.encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            record_key, _, device_id = self._record(middle).partition(b'\0')
+            if record_key < key:
+                low = middle + 1
+            elif record_key > key:
+                high = middle
+            else:
+                return device_id.decode('utf-8')
+        return None
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        for i in range(self.count):
+            endpoint_name, _, device_id = self._record(i).partition(b'\0')
+            yield endpoint_name.decode('utf-8'), device_id.decode('utf-8')
+
+    def close(self):
+        self._map.close()
+
+
+def open_index(path: str) -> Optional[DeviceIndex]:
+    """Returns None if there is no usable index at path, so that devices are looked up in Coiote DM instead."""
+    try:
+        return DeviceIndex(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, struct.error) as e:
+        print(f'Error: device index {path} cannot be used, looking devices up in Coiote DM: {e}')
+        return None
+
+
+def write_index(path: str, entries: Iterable[Tuple[str, str]], metadata: dict):
+    """
+    Writes (endpointName, device id) entries as an index, replacing the file at path atomically,
+    so that readers never see a partially written index. Later entries for an endpoint win.
+    """
+    records = sorted((endpoint_name.encode('utf-8'), device_id.encode('utf-8'))
+                     for endpoint_name, device_id in dict(entries).items())
+    metadata_json = json.dumps(metadata, separators=(',', ':')).encode('utf-8')
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION, len(records), len(metadata_json)))
+        file.write(metadata_json)
+        offset = 0
+        offsets = bytearray(OFFSET.pack(offset))
+        for endpoint_name, device_id in records:
+            offset += len(endpoint_name) + 1 + len(device_id)
+            offsets += OFFSET.pack(offset)
+        file.write(offsets)
+        for endpoint_name, device_id in records:
+            file.write(endpoint_name + b'\0' + device_id)
+    os.replace(temporary_path, path)
@@ -0,0 +1,60 @@
+"""
+Devices known to execute scheduled tasks on their own, for which dispatch_operation skips triggering a session.
+
+The states are remembered by a single warm container and fed by deviceState events (see the deviceStateUpdates
+parameter of cloudFormation.json), each of which reaches only one container; others still trigger the sessions.
+Only registration is reported, as true, and queue mode never is, so a session trigger is skipped only if
+coioteDMassumeQueueMode is 'false' (set by deviceStateUpdates); with the default 'true' it is always sent.
+A deregistration is not reported either, entries expire after coioteDMdeviceStateTtl instead; a task scheduled
+without a trigger for a device deregistered in the meantime waits for its next registration.
+"""
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+from settings import Setting
+from ttl_cache import TtlLruCache
+
+
+@dataclass(frozen=True)
+class DeviceState:
+    registered: Optional[bool] = None
+    queueMode: Optional[bool] = None
+
+
+# thingName -> last known DeviceState; registration changes with the device's lifetime,
+# so entries expire quickly and an unknown state is always treated as possibly deregistered
+DEVICE_STATE_CACHE_SIZE = Setting('coioteDMdeviceStateCacheSize', 10000, int)
+DEVICE_STATE_TTL = Setting('coioteDMdeviceStateTtl', 60.0)
+device_states: Optional[TtlLruCache] = None
+# Whether a device whose queue mode has not been reported in a deviceState event is treated as being in queue mode;
+# 'false' only for fleets without queue-mode devices, whose sessions would otherwise not be triggered.
+# deviceState events never report queue mode, so with 'true' no session trigger is ever skipped
+ASSUME_QUEUE_MODE = os.environ.get('coioteDMassumeQueueMode', 'true') == 'true'
+
+
+def get_device_states() -> TtlLruCache:
+    global device_states
+    if device_states is None:
+        device_states = TtlLruCache(max_size=DEVICE_STATE_CACHE_SIZE.get(), ttl=DEVICE_STATE_TTL.get())
+    return device_states
+
+
+def update_device_state(thingName: str, registered: Optional[bool] = None, queueMode: Optional[bool] = None):
+    """Fields left as None keep their previously known value."""
+    states = get_device_states()
+    previous = states.get(thingName, DeviceState())
+    states.put(thingName, DeviceState(
+        registered=previous.registered if registered is None else registered,
+        queueMode=previous.queueMode if queueMode is None else queueMode
+    ))
+
+
+def session_trigger_needed(thingName: str) -> bool:
+    """
+    A registered device that is not in queue mode executes a scheduled task on its own,
+    so triggering a session is needed only for devices not known to be in that state.
+    """
+    state = get_device_states().get(thingName, DeviceState())
+    queue_mode = ASSUME_QUEUE_MODE if state.queueMode is None else state.queueMode
+    return state.registered is not True or queue_mode
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import threading
+import time
+from typing import Optional
+
+from operations import OperationHttpStatus
+from ttl_cache import MISSING, TtlLruCache
+
+# Result stored for a key whose operation is still being dispatched
+IN_PROGRESS = OperationHttpStatus(statusCode=202, body=json.dumps({'duplicate': True, 'inProgress': True}))
+
+
+def idempotency_key(thingName: str, body: dict, event: dict, include_version: bool = False) -> str:
+    """
+    Hash of the thing, the Coiote DM task built for the operation and the shadow update's clientToken.
+    The task body already has its keys and values normalized (pruned, deduplicated, trailing dots removed),
+    so events differing only in how the same paths are spelled get the same key. The shadow version is
+    included only if include_version is set, in which case only redeliveries of a single shadow update
+    are suppressed, not the same operation republished by a client.
+    """
+    identity = [thingName, body, event.get('clientToken')]
+    if include_version:
+        identity.append(event.get('version'))
+    return hashlib.sha256(json.dumps(identity, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    Remembers the results of operations for the idempotency window. An operation is started with begin,
+    which claims its key, and finished with either complete (its result is returned for duplicates
+    until the window passes) or abandon (duplicates are dispatched again, e.g. after a failure).
+    """
+
+    def begin(self, key: str, window: float) -> Optional[OperationHttpStatus]:
+        """Returns None if the caller has claimed the key, otherwise the result to return for the duplicate."""
+        raise NotImplementedError
+
+    def complete(self, key: str, result: OperationHttpStatus, window: float):
+        raise NotImplementedError
+
+    def abandon(self, key: str):
+        raise NotImplementedError
+
+
+class InMemoryIdempotencyStore(IdempotencyStore):
+    """Suppresses duplicates handled by a single warm container."""
+
+    def __init__(self, max_size: int):
+        self._results = TtlLruCache(max_size=max_size, ttl=0)
+        self._lock = threading.Lock()
+
+    def begin(self, key: str, window: float) -> Optional[OperationHttpStatus]:
+        with self._lock:
+            result = self._results.get(key)
+            if result is not MISSING:
+                return result
+            self._results.put(key, IN_PROGRESS, ttl=window)
+            return None
+
+    def complete(self, key: str, result: OperationHttpStatus, window: float):
+        self._results.put(key, result, ttl=window)
+
+    def abandon(self, key: str):
+        self._results.pop(key)
+
+
+class DynamoDbIdempotencyStore(IdempotencyStore):
+    """
+    Suppresses duplicates across containers. The table's partition key is the string attribute
+    idempotencyKey; expiresAt (epoch seconds) can be enabled as the table's TTL attribute to have
+    expired items removed, they are ignored here either way.
+    """
+
+    def __init__(self, table_name: str):
+        self.table_name = table_name
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    def get_client(self):
+        # boto3 clients cannot be created concurrently, begin may be called by several workers at once
+        with self._client_lock:
+            if self._client is None:
+                import boto3
+                self._client = boto3.client('dynamodb')
+            return self._client
+
+    def begin(self, key: str, window: float) -> Optional[OperationHttpStatus]:
+        client = self.get_client()
+        now = int(time.time())
+        try:
+            client.put_item(
+                TableName=self.table_name,
+                Item={
+                    'idempotencyKey': {'S': key},
+                    'result': {'S': json.dumps(IN_PROGRESS)},
+                    'expiresAt': {'N': str(now + int(window))}
+                },
+                ConditionExpression='attribute_not_exists(idempotencyKey) OR expiresAt < :now',
+                ExpressionAttributeValues={':now': {'N': str(now)}}
+            )
+            return None
+        except client.exceptions.ConditionalCheckFailedException:
+            item = client.get_item(TableName=self.table_name, Key={'idempotencyKey': {'S': key}},
+                                   ConsistentRead=True).get('Item')
+            # the item may have expired or been abandoned in the meantime, the duplicate is in flight anyway
+            return IN_PROGRESS if item is None else json.loads(item['result']['S'])
+
+    def complete(self, key: str, result: OperationHttpStatus, window: float):
+        self.get_client().put_item(
+            TableName=self.table_name,
+            Item={
+                'idempotencyKey': {'S': key},
+                'result': {'S': json.dumps(result)},
+                'expiresAt': {'N': str(int(time.time() + window))}
+            }
+        )
+
+    def abandon(self, key: str):
+        self.get_client().delete_item(TableName=self.table_name, Key={'idempotencyKey': {'S': key}})
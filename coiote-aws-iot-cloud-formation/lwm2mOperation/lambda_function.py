@@ -1,368 +1,649 @@
+import functools
 import json
 import os
-from tempfile import NamedTemporaryFile
-from dataclasses import dataclass
-from typing import TypedDict
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+import instrumentation
+from admission import (AdmissionController, AdmissionRejectedError, DynamoDbAdmissionBackend, LocalAdmissionBackend,
+                       parse_operation_rates)
+from coalescing import InMemoryCoalescingStore, merge_operations
+from coiote_client import CertificateUnavailableError, coiote_request, get_session
+from datamodel_cache import DatamodelCache, unflatten
+from device_index import DeviceIndex, open_index
+from device_state import session_trigger_needed, update_device_state
+from idempotency import DynamoDbIdempotencyStore, InMemoryIdempotencyStore, idempotency_key
+from lwm2m_paths import prune_paths
+from operations import (OPERATIONS, ROOT_PATHS, TEMPLATE_OPERATIONS, OperationHttpStatus, build_operation_body,
+                        operation_error)
+from resilience import (CircuitBreaker, CircuitOpenError, Deadline, DeadlineExceededError, call_with_retries, hedged,
+                        is_retryable_exception, retry_after)
+from settings import ConfigurationError, Setting
+from ttl_cache import MISSING, TtlLruCache
+
+# Settings are read from the environment on first use (see settings.py), and so are the objects built from them
+
+# endpointName -> Coiote DM device id, None for endpoints unknown to Coiote DM
+DEVICE_ID_CACHE_SIZE = Setting('coioteDMdeviceIdCacheSize', 10000, int)
+DEVICE_ID_CACHE_TTL = Setting('coioteDMdeviceIdCacheTtl', 3600.0)
+device_id_cache: Optional[TtlLruCache] = None
+# Unknown endpoints are cached for a shorter time, as they are likely to be registered soon
+UNKNOWN_DEVICE_TTL = Setting('coioteDMunknownDeviceTtl', 30.0)
+# Index built by sync_device_index.py, consulted before looking a device up in Coiote DM;
+# /opt is where the files of Lambda layers end up
+DEVICE_INDEX_PATH = os.environ.get('coioteDMdeviceIndexPath', '/opt/device_index.bin')
+# Endpoints whose device id from the index turned out to be unknown to Coiote DM
+stale_index_entries = set()
+
+# Maximum number of devices handled in parallel by a fan-out operation; keep it at most
+# coioteDMpoolSize, otherwise connections above the pool size are not reused
+FAN_OUT_CONCURRENCY = Setting('coioteDMfanOutConcurrency', 10, int, minimum=1)
+# Time (in milliseconds) reserved for returning the result before the Lambda times out;
+# Coiote DM calls, including their retries, have to complete before that
+DEADLINE_MARGIN_MS = Setting('coioteDMdeadlineMarginMs', 2000, int)
+
+# Operations on a single thing arriving within this many milliseconds of each other are merged
+# into as few Coiote DM tasks as possible; 0 disables coalescing. Only the messages of an SQS batch
+# (Lwm2mOperationBatch) are merged: a container handles lambda_handler invocations one at a time,
+# so there the window would only add latency and is not applied
+COALESCING_WINDOW_MS = Setting('coioteDMcoalescingWindowMs', 0, int)
+coalescing_store = InMemoryCoalescingStore()
+
+# Repeated operations on a single thing (the same Coiote DM task and shadow clientToken) arriving within this many
+# seconds of the first one get its result instead of scheduling the task again; 0 disables the check
+IDEMPOTENCY_WINDOW = Setting('coioteDMidempotencyWindow', 0.0)
+# If true, the shadow version is a part of the idempotency key, so only redeliveries of the same shadow update
+# are suppressed, and not clients republishing the same desired state
+IDEMPOTENCY_BY_VERSION = os.environ.get('coioteDMidempotencyByVersion', 'false') == 'true'
+# DynamoDB table shared by all containers (see DynamoDbIdempotencyStore); if not set,
+# each warm container remembers up to coioteDMidempotencyCacheSize results on its own
+IDEMPOTENCY_TABLE = os.environ.get('coioteDMidempotencyTable', '')
+IDEMPOTENCY_CACHE_SIZE = Setting('coioteDMidempotencyCacheSize', 10000, int)
+idempotency_store = None
+
+# Upper bound (in seconds) of a single Coiote DM request, further limited by the time left until the Lambda deadline
+REQUEST_TIMEOUT = Setting('coioteDMrequestTimeout', 10.0)
+# Attempts made for a Coiote DM call that failed in a retryable way (see resilience.py), 1 disables retries
+RETRY_ATTEMPTS = Setting('coioteDMretryAttempts', 3, int, minimum=1)
+# Base (in milliseconds) of the jittered exponential backoff between attempts
+RETRY_BASE_DELAY_MS = Setting('coioteDMretryBaseDelayMs', 100, int)
+# A device lookup still pending after this many milliseconds is sent once more and the first response is used;
+# 0 disables hedging
+HEDGE_DELAY_MS = Setting('coioteDMhedgeDelayMs', 300, int)
+# After coioteDMbreakerFailures consecutive failed Coiote DM calls, operations fail fast with 503
+# for coioteDMbreakerOpenSeconds, after which a single call is let through to check if Coiote DM has recovered
+BREAKER_FAILURES = Setting('coioteDMbreakerFailures', 5, int, minimum=1)
+BREAKER_OPEN_SECONDS = Setting('coioteDMbreakerOpenSeconds', 30.0)
+coiote_breaker: Optional[CircuitBreaker] = None
+
+# Task and session trigger calls per second admitted by a container, or by all containers together
+# if coioteDMadmissionTable is set (see admission.py); 0 disables admission control
+ADMISSION_RATE = Setting('coioteDMadmissionRate', 0.0)
+# Calls which can be admitted at once after a quiet period
+ADMISSION_BURST = Setting('coioteDMadmissionBurst', 10.0, minimum=1.0)
+# Lower rates for single operations, e.g. 'read=20,observe=5'
+ADMISSION_OPERATION_RATES = os.environ.get('coioteDMadmissionOperationRates', '')
+# Operations admitted ahead of the others (bulk reads and observations) when the rate is reached
+HIGH_PRIORITY_OPERATIONS = os.environ.get('coioteDMhighPriorityOperations', 'execute,write,writeAttributes').split(',')
+# Fraction of the burst which only high priority operations can use
+ADMISSION_RESERVE = Setting('coioteDMadmissionReserve', 0.2)
+# Longest (in milliseconds) a call waits for admission, the operation is rejected with 429 (503 while
+# Coiote DM asks to back off) otherwise
+ADMISSION_MAX_WAIT_MS = Setting('coioteDMadmissionMaxWaitMs', 2000, int)
+# DynamoDB table holding the token buckets shared by all containers (see DynamoDbAdmissionBackend)
+ADMISSION_TABLE = os.environ.get('coioteDMadmissionTable', '')
+# None if admission control is disabled
+admission = MISSING
+
+# Read and readComposite operations with maxAge (in seconds) are answered from the datamodel shadow if all the
+# requested resources have been reported there within maxAge, otherwise only the stale ones are read from the device.
+# Shadows are cached by a warm container for up to coioteDMdatamodelCacheTtl seconds, and fetched again
+# at most every coioteDMdatamodelRefreshMs if they are not fresh enough (see datamodel_cache.py)
+CACHEABLE_OPERATIONS = ('read', 'readComposite')
+DATAMODEL_CACHE_SIZE = Setting('coioteDMdatamodelCacheSize', 1000, int)
+DATAMODEL_CACHE_TTL = Setting('coioteDMdatamodelCacheTtl', 300.0)
+DATAMODEL_REFRESH_MS = Setting('coioteDMdatamodelRefreshMs', 1000, int)
+datamodel_cache: Optional[DatamodelCache] = None
+
+_iot_client = None
+_device_index = MISSING
+_hedge_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_device_id_cache() -> TtlLruCache:
+    global device_id_cache
+    if device_id_cache is None:
+        device_id_cache = TtlLruCache(max_size=DEVICE_ID_CACHE_SIZE.get(), ttl=DEVICE_ID_CACHE_TTL.get())
+    return device_id_cache
+
+
+def get_idempotency_store():
+    global idempotency_store
+    if idempotency_store is None:
+        if IDEMPOTENCY_TABLE:
+            idempotency_store = DynamoDbIdempotencyStore(IDEMPOTENCY_TABLE)
+        else:
+            idempotency_store = InMemoryIdempotencyStore(max_size=IDEMPOTENCY_CACHE_SIZE.get())
+    return idempotency_store
+
+
+def get_coiote_breaker() -> CircuitBreaker:
+    global coiote_breaker
+    if coiote_breaker is None:
+        coiote_breaker = CircuitBreaker(failure_threshold=BREAKER_FAILURES.get(),
+                                        open_seconds=BREAKER_OPEN_SECONDS.get())
+    return coiote_breaker
+
+
+def get_admission() -> Optional[AdmissionController]:
+    global admission
+    if admission is MISSING:
+        if ADMISSION_RATE.get() <= 0:
+            admission = None
+            return admission
+        try:
+            operation_rates = parse_operation_rates(ADMISSION_OPERATION_RATES)
+        except ValueError:
+            raise ConfigurationError(f'coioteDMadmissionOperationRates must look like read=20,observe=5, '
+                                     f'got {ADMISSION_OPERATION_RATES!r}') from None
+        admission = AdmissionController(
+            DynamoDbAdmissionBackend(ADMISSION_TABLE) if ADMISSION_TABLE else LocalAdmissionBackend(),
+            rate=ADMISSION_RATE.get(),
+            burst=ADMISSION_BURST.get(),
+            operation_rates=operation_rates,
+            high_priority_operations=HIGH_PRIORITY_OPERATIONS,
+            reserve=ADMISSION_RESERVE.get() * ADMISSION_BURST.get(),
+            max_wait=ADMISSION_MAX_WAIT_MS.get() / 1000
+        )
+    return admission
+
+
+def get_datamodel_cache() -> DatamodelCache:
+    global datamodel_cache
+    if datamodel_cache is None:
+        datamodel_cache = DatamodelCache(max_size=DATAMODEL_CACHE_SIZE.get(), ttl=DATAMODEL_CACHE_TTL.get(),
+                                         refresh_interval=DATAMODEL_REFRESH_MS.get() / 1000)
+    return datamodel_cache
+
+
+def get_hedge_executor() -> ThreadPoolExecutor:
+    global _hedge_executor
+    if _hedge_executor is None:
+        # every fan-out worker may have a lookup and its hedge in flight
+        _hedge_executor = ThreadPoolExecutor(max_workers=2 * FAN_OUT_CONCURRENCY.get())
+    return _hedge_executor
+
+
+def call_coiote(method: str, path: str, deadline: Deadline, idempotent: bool = False, hedge: bool = False,
+                **kwargs):
+    """
+    coiote_request with retries bounded by the deadline, behind the circuit breaker. Only idempotent
+    requests may be hedged, and only they are retried after failures which leave it unknown whether
+    Coiote DM has processed the request. Throttling responses slow down admission control, if enabled.
+    Transport failures left after retries are raised as CoioteRequestError.
+    """
+    import requests
+    admission = get_admission()
+
+    def send(timeout: float):
+        if admission is None:
+            return coiote_request(method, path, timeout=timeout, **kwargs)
+        response = coiote_request(method, path, timeout=timeout, **kwargs)
+        if response.status_code in (429, 503):
+            admission.throttled(retry_after(response))
+        else:
+            admission.succeeded()
+        return response
 
-import boto3
-import requests
+    if hedge and HEDGE_DELAY_MS.get() > 0:
+        send = hedged(send, HEDGE_DELAY_MS.get() / 1000, get_hedge_executor())
+    try:
+        return call_with_retries(send, deadline, get_coiote_breaker(), attempts=RETRY_ATTEMPTS.get(),
+                                 base_delay=RETRY_BASE_DELAY_MS.get() / 1000, max_timeout=REQUEST_TIMEOUT.get(),
+                                 idempotent=idempotent)
+    except requests.RequestException as e:
+        raise CoioteRequestError(e) from e
+
+
+def get_device_index() -> Optional[DeviceIndex]:
+    global _device_index
+    if _device_index is MISSING:
+        _device_index = open_index(DEVICE_INDEX_PATH)
+    return _device_index
+
+
+class CoioteRequestError(Exception):
+    """A request to Coiote DM failed without a response, even after retries."""
+
+    def __init__(self, cause: Exception):
+        import requests
+        super().__init__(f'Coiote DM could not be reached: {cause}')
+        # a request which could not even connect has not reached Coiote DM
+        self.sent = not is_retryable_exception(cause, idempotent=False)
+        self.timedOut = isinstance(cause, requests.exceptions.Timeout)
+
+    def operation_error(self) -> OperationHttpStatus:
+        """503 if Coiote DM has not received the request, otherwise 504 for timeouts and 502 for other errors."""
+        if not self.sent:
+            return operation_error(503, str(self))
+        return operation_error(504 if self.timedOut else 502, str(self))
+
+
+class DeviceLookupError(Exception):
+    """Coiote DM responded to a device lookup with an error, even after retries."""
+
+    def __init__(self, response):
+        super().__init__(f'device lookup failed, Coiote DM responded with: {response.status_code}: {response.text}')
+        self.response = response
+
+    def operation_error(self) -> OperationHttpStatus:
+        """
+        503 if Coiote DM asked to back off or failed, as the operation can be sent again later,
+        502 for other errors, which a retry would not fix.
+        """
+        if self.response.status_code == 429 or self.response.status_code >= 500:
+            return operation_error(503, str(self), retry_after=retry_after(self.response))
+        return operation_error(502, str(self))
+
+
+def get_device_db_id(endpoint_name, deadline: Deadline) -> Optional[str]:
+    device_id = get_device_id_cache().get(endpoint_name)
+    if device_id is not MISSING:
+        return device_id
+
+    index = get_device_index()
+    if index is not None and endpoint_name not in stale_index_entries:
+        device_id = index.get(endpoint_name)
+        if device_id is not None:
+            instrumentation.count('deviceIndexHits')
+            get_device_id_cache().put(endpoint_name, device_id)
+            return device_id
+
+    condition = f"properties.endpointName eq '{endpoint_name}'"
+    params = {
+        "searchCriteria": condition
+    }
+    with instrumentation.phase('deviceLookup'):
+        response = call_coiote('GET', '/devices', deadline, idempotent=True, hedge=True, params=params)
+    if not response.ok:
+        raise DeviceLookupError(response)
+    device_ids = response.json()
+    if device_ids:
+        device_id = device_ids[0]
+        get_device_id_cache().put(endpoint_name, device_id)
+    else:
+        device_id = None
+        get_device_id_cache().put(endpoint_name, device_id, ttl=UNKNOWN_DEVICE_TTL.get())
+    return device_id
+
+
+def get_iot_client():
+    global _iot_client
+    if _iot_client is None:
+        import boto3
+        _iot_client = boto3.client('iot')
+    return _iot_client
+
+
+def get_thing_group_members(thing_group_name: str) -> List[str]:
+    paginator = get_iot_client().get_paginator('list_things_in_thing_group')
+    pages = paginator.paginate(thingGroupName=thing_group_name, recursive=True)
+    with instrumentation.phase('thingGroupListing'):
+        return [thing_name for page in pages for thing_name in page['things']]
+
+
+def dispatch_operation(thingName: str, body: dict, deadline: Deadline) -> OperationHttpStatus:
+    # in this approach, the task is scheduled at Coiote - and then
+    # we are performing 2nd call to trigger session even if a device is deregistered
+    # as the task has exec condition that it is executed only when the device is registered
+    # below resolved by 2nd exec condition - if a device is in queue mode,
+    # the task is executed once the device comes with some LwM2M message:
+    # we can also add an optional parameter in the shadow to wait for a device (by default set to false)
+    # and in this case not performing 2nd call triggering session
+    # If instead these 2 the method commented above is used, Coiote will respond with
+    # error indicating that the device is deregistered and the task will not be scheduled at all
+    try:
+        device_id = get_device_db_id(thingName, deadline)
+    except DeviceLookupError as e:
+        print(f'Error: {e}')
+        return e.operation_error()
+    except CoioteRequestError as e:
+        print(f'Error: device lookup failed: {e}')
+        # no task has been scheduled yet
+        return operation_error(503, f'device lookup failed: {e}')
+    if device_id is None:
+        print(f'Error: device {thingName} not found in Coiote DM')
+        return operation_error(404, f'device {thingName} not found in Coiote DM')
+    session_trigger = session_trigger_needed(thingName)
+    admission = get_admission()
+    if admission is not None:
+        # both calls are admitted at once, so that a scheduled task is never left without its session trigger
+        admission.acquire(TEMPLATE_OPERATIONS.get(body['templateName'], 'unknown'), deadline,
+                          calls=2 if session_trigger else 1)
+    try:
+        with instrumentation.phase('taskPost'):
+            apiCallResp = call_coiote('POST', '/tasksFromTemplates/device/'+device_id, deadline, json=body)
+    except CoioteRequestError as e:
+        print(f'Error: {e}')
+        return e.operation_error()
+    qjResponseCode = apiCallResp.status_code
+    qjResponseBody = apiCallResp.text
+    if qjResponseCode == 404:
+        # the device has been removed from Coiote DM, look it up again next time
+        get_device_id_cache().pop(thingName)
+        stale_index_entries.add(thingName)
+    if qjResponseCode != 201:
+        print('Error: Coiote DM responded with: ' +
+              str(qjResponseCode) + ': ' + qjResponseBody)
+        return OperationHttpStatus(
+            statusCode=qjResponseCode,
+            body=qjResponseBody
+        )
 
-REST_URI = os.environ['coioteDMrestUri'] + '/api/coiotedm/v3'
-COIOTE_HEADERS = {'Authorization': 'Certificate'}
+    if not session_trigger:
+        instrumentation.count('sessionTriggersSkipped')
+        return OperationHttpStatus(
+            statusCode=qjResponseCode,
+            body=qjResponseBody
+        )
 
+    # from here on the task is scheduled, so the operation succeeds even if its session is not triggered:
+    # the task runs once the device comes with any LwM2M message, and sending it again would duplicate it
+    scheduled = OperationHttpStatus(
+        statusCode=qjResponseCode,
+        body=qjResponseBody
+    )
+    instrumentation.count('sessionTriggersSent')
+    try:
+        with instrumentation.phase('sessionTrigger'):
+            # triggering a session again does no harm, so the trigger is retried like an idempotent request
+            apiCallResp = call_coiote('POST', '/sessions/'+device_id+'/allow-deregistered', deadline,
+                                      idempotent=True)
+    except (CoioteRequestError,) + COIOTE_UNAVAILABLE_ERRORS as e:
+        print(f'Error: task scheduled, but the session of {thingName} could not be triggered: {e}')
+        return scheduled
+    qjResponseCode = apiCallResp.status_code
+    qjResponseBody = apiCallResp.text
+    if qjResponseCode != 200:
+        print('Error: task scheduled, but triggering the session responded with: ' +
+              str(qjResponseCode) + ': ' + qjResponseBody)
+        return scheduled
 
-class OperationHttpStatus(TypedDict):
-    statusCode: int
-    body: str
+    return OperationHttpStatus(
+        statusCode=qjResponseCode,
+        body=qjResponseBody
+    )
 
 
-def operation_error(code: int, error: str) -> OperationHttpStatus:
+def fan_out_operation(thingNames: List[str], body: dict, context) -> OperationHttpStatus:
+    """
+    Dispatches the same operation to many devices concurrently over the shared Coiote DM session.
+    Devices whose turn has not come before the Lambda deadline are not dispatched and reported with 503.
+    """
+    deadline = Deadline.from_context(context, DEADLINE_MARGIN_MS.get())
+
+    def dispatch_before_deadline(thingName: str) -> OperationHttpStatus:
+        if deadline.remaining() <= 0:
+            return operation_error(503, 'deadline exceeded before the operation was dispatched')
+        try:
+            return dispatch_operation(thingName, body, deadline)
+        except COIOTE_UNAVAILABLE_ERRORS as e:
+            return coiote_unavailable_error(e)
+        except Exception as e:
+            print(f'Error: operation for {thingName} failed: {e}')
+            return operation_error(500, str(e))
+
+    # fetch the certificate once instead of in every worker
+    get_session()
+    # running dispatches are waited for, as they are bounded by the deadline themselves; abandoned ones would
+    # be frozen with the sandbox and could resume, and schedule their tasks, during the next invocation
+    with ThreadPoolExecutor(max_workers=min(FAN_OUT_CONCURRENCY.get(), len(thingNames))) as executor:
+        futures = {executor.submit(dispatch_before_deadline, thingName): thingName for thingName in thingNames}
+
+    return aggregate_results({thingName: future.result() for future, thingName in futures.items()})
+
+
+def aggregate_results(results) -> OperationHttpStatus:
+    """results is either a dict (thingName -> result) or a list of results."""
+    statuses = results.values() if isinstance(results, dict) else results
+    failed = sum(1 for result in statuses if result['statusCode'] >= 300)
     return OperationHttpStatus(
-        statusCode=code,
+        statusCode=200 if failed == 0 else 207,
         body=json.dumps({
-            'error': error
+            'failed': failed,
+            'results': results
         })
     )
 
 
-def get_certificate_files():
-    user_auth_cert = get_user_auth_cert()
-    certificate_pem = NamedTemporaryFile(delete=False)
-    private_key = NamedTemporaryFile(delete=False)
-    certificate_pem_file = certificate_pem.name
-    private_key_file = private_key.name
+# raised instead of making Coiote DM calls, turned into operation errors by coiote_unavailable_error.
+# Operation errors 429 and 503 mean that no task has been scheduled, so the operation can be sent again;
+# after 502 and 504 (and other 5xx responses of Coiote DM to the task) it is unknown whether it has been
+COIOTE_UNAVAILABLE_ERRORS = (AdmissionRejectedError, CircuitOpenError, DeadlineExceededError,
+                             CertificateUnavailableError)
+
+
+def coiote_unavailable_error(e: Exception) -> OperationHttpStatus:
+    if isinstance(e, AdmissionRejectedError):
+        return operation_error(e.statusCode, str(e), retry_after=e.retryAfter)
+    return operation_error(503, str(e))
+
+
+def coalesce_operation(event, deadline: Deadline) -> OperationHttpStatus:
+    """
+    The first operation on a thing within the coalescing window waits for the window to pass and dispatches
+    all operations buffered in the meantime, merged. The other ones wait for that and return the same result,
+    so that a failed merged dispatch fails (and gets retried) for every operation it contains.
+    """
+    thingName = event['thingName']
+    window, leader = coalescing_store.append(thingName, event)
+    if not leader:
+        instrumentation.count('operationsCoalesced')
+        with instrumentation.phase('coalescingWait'):
+            result = window.wait(max(0.0, deadline.remaining()))
+        if result is None:
+            return operation_error(504, 'deadline exceeded before the coalesced operation completed')
+        return result
+
+    with instrumentation.phase('coalescingWait'):
+        time.sleep(COALESCING_WINDOW_MS.get() / 1000)
+    window = coalescing_store.drain(thingName)
     try:
-        certificate_pem.write(str.encode(user_auth_cert.certificatePem))
-        private_key.write(str.encode(user_auth_cert.privateKey))
-        certificate_pem.close()
-        private_key.close()
-        yield certificate_pem_file, private_key_file
-    finally:
-        os.unlink(certificate_pem_file)
-        os.unlink(private_key_file)
-
-
-@dataclass
-class UserAuthCert:
-    certificatePem: str
-    privateKey: str
-
-
-def get_user_auth_cert() -> UserAuthCert:
-    secret_name = 'coioteDMcert'
-
-    session = boto3.session.Session()
-    client = session.client('secretsmanager')
-
+        results = []
+        for merged_event in merge_operations(window.events):
+            body, error = build_operation_body(merged_event)
+            results.append(error if error is not None else dispatch_operation(thingName, body, deadline))
+        result = results[0] if len(results) == 1 else aggregate_results(results)
+    except Exception as e:
+        if isinstance(e, COIOTE_UNAVAILABLE_ERRORS):
+            window.set_result(coiote_unavailable_error(e))
+        else:
+            window.set_result(operation_error(500, str(e)))
+        raise
+    window.set_result(result)
+    return result
+
+
+def dispatch_once(event, body: dict, dispatch: Callable[[], OperationHttpStatus]) -> OperationHttpStatus:
+    """
+    Calls dispatch unless the same operation has already been handled within the idempotency window,
+    in which case the original result is returned. Failures worth retrying are not remembered,
+    so that a retried event is dispatched again.
+    """
+    key = idempotency_key(event['thingName'], body, event, include_version=IDEMPOTENCY_BY_VERSION)
+    original_result = get_idempotency_store().begin(key, IDEMPOTENCY_WINDOW.get())
+    if original_result is not None:
+        instrumentation.count('duplicatesSuppressed')
+        return original_result
     try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except Exception:
-        raise Exception('Coiote DM certificate not found in Secrets Manager')
-
-    if 'SecretString' not in get_secret_value_response:
-        raise Exception('Coiote DM certificate are not set up correctly')
-
-    secrets_map = json.JSONDecoder().decode(get_secret_value_response['SecretString'])
-
-    certificate_pem_key = 'certificatePem'
-    private_key_key = 'privateKey'
-
-    expected_keys_set = {certificate_pem_key, private_key_key}
-    fetched_keys_set = set(secrets_map.keys())
-
-    if expected_keys_set.issubset(fetched_keys_set):
-        return UserAuthCert(
-            certificatePem=secrets_map[certificate_pem_key],
-            privateKey=secrets_map[private_key_key],
-        )
-    else:
-        raise Exception(
-            f'Secret in Secrets Manager does not have all required keys ({", ".join(expected_keys_set)})')
-
-
-def get_device_db_id(endpoint_name, certificate, private_key):
-    uri = REST_URI + "/devices"
-    condition = f"properties.endpointName eq '{endpoint_name}'"
-    params = {
-        "searchCriteria": condition
-    }
-    response = requests.get(uri, headers=COIOTE_HEADERS, params=params, cert=(
-        certificate, private_key), verify=False)
-    return response.json()[0]
-
-
-def lambda_handler(event, context):
-    if 'keys' not in event:
-        # Results of print functions are logged in CloudWatch when debugging is enabled
-        # Results of return seem to be not logged there
-        print('Error: keys must be specified')
-        return operation_error(400, 'keys must be specified')
+        result = dispatch()
+    except BaseException:
+        get_idempotency_store().abandon(key)
+        raise
+    if is_retryable(result):
+        get_idempotency_store().abandon(key)
     else:
-        keys = event['keys']
-
-    def pathsOptimization(keys):
-        if any(element in keys for element in ('all', '', '.', '/')):
-            keysCsStr = ''
+        get_idempotency_store().complete(key, result, IDEMPOTENCY_WINDOW.get())
+    return result
+
+
+def read_through_datamodel(event) -> Tuple[Optional[dict], Optional[OperationHttpStatus]]:
+    """
+    Returns (None, response) if the read can be answered from the datamodel shadow. Otherwise returns the event
+    to be scheduled, with keys narrowed down to the stale ones. If the shadow cannot be fetched, everything is read.
+    Cached values are reported to the operation shadow if the rule invoking the lambda discards the response
+    (shadow-triggered reads, the ones with a shadow version), or if only some keys are fresh: shadow updates merge
+    objects, so the result reported by Coiote DM for the stale keys completes them there. If the report fails,
+    everything is read as well.
+    """
+    max_age = event['maxAge']
+    if isinstance(max_age, bool) or not isinstance(max_age, (int, float)) or max_age < 0:
+        print('Error: maxAge must be a non-negative number of seconds')
+        return None, operation_error(400, 'maxAge must be a non-negative number of seconds')
+
+    keys = event['keys']
+    # the empty path covers the whole datamodel
+    pruned_keys = [''] if any(key in ROOT_PATHS for key in keys) else prune_paths(keys)
+    try:
+        with instrumentation.phase('datamodelCache'):
+            values, stale_keys = get_datamodel_cache().split_fresh(event['thingName'], pruned_keys, max_age)
+    except Exception as e:
+        print(f'Error: datamodel shadow of {event["thingName"]} could not be fetched, reading all keys: {e}')
+        return event, None
+
+    instrumentation.count('cachedKeys', len(pruned_keys) - len(stale_keys))
+    if stale_keys and len(stale_keys) == len(pruned_keys):
+        return event, None
+    result = unflatten(values)
+    if stale_keys or 'version' in event:
+        try:
+            get_datamodel_cache().report_result(event['thingName'], event['operation'], result,
+                                                event.get('clientToken'))
+        except Exception as e:
+            print(f'Error: cached result could not be reported to the operation shadow of {event["thingName"]}, '
+                  f'reading all keys: {e}')
+            return event, None
+    if stale_keys:
+        return dict(event, keys=stale_keys), None
+    return None, OperationHttpStatus(statusCode=200, body=json.dumps({'result': result}))
+
+
+def handle_operation(event, context, coalesce: bool = False) -> OperationHttpStatus:
+    """
+    Schedules the operation for a single thingName (the shadow-triggered case) or, if the event
+    contains thingNames (a list) or thingGroupName instead, for all the given devices at once.
+    Single thing operations are coalesced if coalesce is set and the coalescing window is enabled.
+    """
+    body, error = build_operation_body(event)
+    if error is not None:
+        return error
+
+    if 'thingNames' in event or 'thingGroupName' in event:
+        if 'thingNames' in event:
+            thingNames = list(dict.fromkeys(event['thingNames']))
         else:
-            i = 0
-            for key in keys:
-                if not key.endswith('.'):
-                    keys[i] = key+'.'
-                i += 1
-            keys = list(set(keys))
-            keys.sort()
-            i = 0
-            jEnd = len(keys)
-            for key in keys:
-                j = i+1
-                while j < jEnd:
-                    if keys[j].startswith(key):
-                        del keys[j]
-                        j -= 1
-                        jEnd -= 1
-                    j += 1
-                i += 1
-            i = 0
-            for key in keys:
-                keys[i] = key[:-1]
-                i += 1
-            keysCsStr = ','.join(keys)
-        return keysCsStr
-
-    if 'operation' not in event:
-        print('Error: operation must be specified')
-        return operation_error(400, 'operation must be specified')
+            thingNames = get_thing_group_members(event['thingGroupName'])
+        if not thingNames:
+            print('Error: no things to perform the operation on')
+            return operation_error(400, 'no things to perform the operation on')
+        return fan_out_operation(thingNames, body, context)
+
+    if event.get('maxAge') is not None and event['operation'] in CACHEABLE_OPERATIONS:
+        event, cached = read_through_datamodel(event)
+        if event is None:
+            return cached
+        body, error = build_operation_body(event)
+        if error is not None:
+            return error
+
+    deadline = Deadline.from_context(context, DEADLINE_MARGIN_MS.get())
+    if coalesce and COALESCING_WINDOW_MS.get() > 0:
+        dispatch = functools.partial(coalesce_operation, event, deadline)
     else:
-        operation = event['operation']
-        thingName = event['thingName']
-
-        if operation == 'write':
-            i = 0
-            for key in keys:
-                if key.endswith('.'):
-                    keys[i] = key[:-1]
-                i += 1
-
-            if len(keys) != len(set(keys)):
-                print('Error: keys must be unique for write operation')
-                return operation_error(400, 'keys must be unique for write operation')
-
-            if 'values' in event:
-                values = event['values']
-                if len(keys) != len(values):
-                    print('Error: The number of keys must be equal to the number of values')
-                    return operation_error(400, 'The number of keys must be equal to the number of values')
-            else:
-                print('Error: You must specify values when write operation is used')
-                return operation_error(400, 'You must specify values when write operation is used')
-
-            keysCsStr = ','.join(keys)
-            valuesCsStr = ','.join([str(x) for x in values])
-            body = {
-                'templateName': 'AWSwriteCertAuth',
-                'config': {
-                    'parameters': [{'name': 'keys', 'value': keysCsStr}, {'name': 'values', 'value': valuesCsStr}]
-                }
-            }
-        elif operation == 'read':
-            keysCsStr = pathsOptimization(keys)
-            body = {
-                'templateName': 'AWSreadCertAuth',
-                'config': {
-                    'parameters': [{'name': 'keys', 'value': keysCsStr}]
-                }
-            }
-        elif operation == 'readComposite':
-            keysCsStr = pathsOptimization(keys)
-            body = {
-                'templateName': 'AWSreadCompositeCertAuth',
-                'config': {
-                    'parameters': [{'name': 'keys', 'value': keysCsStr}]
-                }
-            }
-        elif operation == 'observe':
-            i = 0
-            for key in keys:
-                if not key.endswith('.'):
-                    keys[i] = key+'.'
-                i += 1
-            if len(keys) != len(set(keys)):
-                print('Error: keys must be unique for observe operation')
-                return operation_error(400, 'keys must be unique for observe operation')
-
-            if 'attributes' in event:
-                attributes = event['attributes']
-                if len(keys) != len(attributes):
-                    print(
-                        'Error: The number of keys must be equal to the number of attributes')
-                    return operation_error(400, 'The number of keys must be equal to the number of attributes')
-            else:
-                print(
-                    'Error: You must specify attributes when observe operation is used')
-                return operation_error(400, 'You must specify attributes when observe operation is used')
-
-            keysAttributesDict = dict(zip(keys, attributes))
-            attributes.clear()
-            keys.sort()
-            i = 0
-            jEnd = len(keys)
-            for key in keys:
-                j = i+1
-                while j < jEnd:
-                    if keys[j].startswith(key):
-                        del keys[j]
-                        j -= 1
-                        jEnd -= 1
-                    j += 1
-                i += 1
-
-            i = 0
-            for key in keys:
-                keys[i] = key[:-1]
-                attributes.append(keysAttributesDict[key])
-                i += 1
-
-            keysCsStr = ','.join(keys)
-            attributesStr = str(attributes).replace(' ', '')
-            body = {
-                'templateName': 'AWSobserveCertAuth',
-                'config': {
-                    'parameters': [{'name': 'keys', 'value': keysCsStr}, {'name': 'attributes', 'value': attributesStr}]
-                }
-            }
-        elif operation == 'observeComposite':
-            keys = list(set(keys))
-            keysCsStr = ','.join(keys)
-            body = {
-                'templateName': 'AWSobserveCompositeCertAuth',
-                'config': {
-                    'parameters': [{'name': 'keys', 'value': keysCsStr}]
-                }
-            }
-        elif operation == 'execute':
-            if len(keys) != 1:
-                print(
-                    'Error: Only one LwM2M path can be passed for execute operation - keys array must contain only one element')
-                return operation_error(400, 'Only one LwM2M path can be passed for execute operation - keys array must contain only one element')
-            if 'arguments' not in event:
-                body = {
-                    'templateName': 'AWSexecuteCertAuth',
-                    'config': {
-                        'parameters': [{'name': 'keys', 'value': keys[0]}]
-                    }
-                }
-            else:
-                arguments = event['arguments']
-                if arguments is not None:
-                    body = {
-                        'templateName': 'AWSexecuteCertAuth',
-                        'config': {
-                            'parameters': [{'name': 'keys', 'value': keys[0]}, {'name': 'arguments', 'value': arguments}]
-                        }
-                    }
-                else:
-                    body = {
-                        'templateName': 'AWSexecuteCertAuth',
-                        'config': {
-                            'parameters': [{'name': 'keys', 'value': keys[0]}]
-                        }
-                    }
-        elif operation == 'cancelObserve':
-            # even if there are other keys in 'keys', set it to be just 'all' if 'keys' contains 'all'
-            if 'all' in keys:
-                keysCsStr = 'all'
-            else:
-                keys = list(set(keys))
-                keysCsStr = ','.join(keys)
-
-            body = {
-                'templateName': 'AWScancelObserveCertAuth',
-                'config': {
-                    'parameters': [{'name': 'keys', 'value': keysCsStr}]
-                }
-            }
-        elif operation == 'cancelObserveComposite':
-            keys = list(set(keys))
-            keysCsStr = ','.join(keys)
-            body = {
-                'templateName': 'AWScancelObserveCompositeCertAuth',
-                'config': {
-                    'parameters': [{'name': 'keys', 'value': keysCsStr}]
-                }
-            }
-        elif operation == 'writeAttributes':
-            i = 0
-            for key in keys:
-                if not key.endswith('.'):
-                    keys[i] = key+'.'
-                i += 1
-            if len(keys) != len(set(keys)):
-                print('Error: keys must be unique for writeAttributes operation')
-                return operation_error(400, 'keys must be unique for writeAttributes operation')
-            if 'attributes' in event:
-                attributes = event['attributes']
-                if len(keys) != len(attributes):
-                    print(
-                        'Error: The number of keys must be equal to the number of attributes')
-                    return operation_error(400, 'The number of keys must be equal to the number of attributes')
-            else:
-                print(
-                    'Error: You must specify attributes when writeAttributes operation is used')
-                return operation_error(400, 'You must specify attributes when writeAttributes operation is used')
-            i = 0
-            for key in keys:
-                keys[i] = key[:-1]
-
-                i += 1
-            keysCsStr = ','.join(keys)
-            attributesStr = str(attributes).replace(
-                ' ', '').replace('None', "''")
-            body = {
-                'templateName': 'AWSwriteAttributesCertAuth',
-                'config': {
-                    'parameters': [{'name': 'keys', 'value': keysCsStr}, {'name': 'attributes', 'value': attributesStr}]
-                }
-            }
-        else:
-            print(f'Error: operation {operation} is not implemented for AWS-CoioteDM integration')
-            return operation_error(406, f'operation {operation} is not implemented for AWS-CoioteDM integration')
-
-        # in this approach, the task is scheduled at Coiote - and then
-        # we are performing 2nd call to trigger session even if a device is deregistered
-        # as the task has exec condition that it is executed only when the device is registered
-        # below resolved by 2nd exec condition - if a device is in queue mode,
-        # the task is executed once the device comes with some LwM2M message:
-        # we can also add an optional parameter in the shadow to wait for a device (by default set to false)
-        # and in this case not performing 2nd call triggering session
-        # If instead these 2 the method commented above is used, Coiote will respond with
-        # error indicating that the device is deregistered and the task will not be scheduled at all
-        for certificate, private_key in get_certificate_files():
-            device_id = get_device_db_id(thingName, certificate, private_key)
-            uri = REST_URI+'/tasksFromTemplates/device/'+device_id
-            apiCallResp = requests.post(uri, json=body, headers=COIOTE_HEADERS, cert=(
-                certificate, private_key), verify=False, timeout=10)
-            qjResponseCode = apiCallResp.status_code
-            qjResponseBody = apiCallResp.text
-            if qjResponseCode != 201:
-                print('Error: Coiote DM responded with: ' +
-                      str(qjResponseCode) + ': ' + qjResponseBody)
-                return OperationHttpStatus(
-                    statusCode=qjResponseCode,
-                    body=qjResponseBody
-                )
-
-            uri = REST_URI+'/sessions/'+device_id+'/allow-deregistered'
-            apiCallResp = requests.post(uri, headers=COIOTE_HEADERS, cert=(
-                certificate, private_key), verify=False, timeout=10)
-            qjResponseCode = apiCallResp.status_code
-            qjResponseBody = apiCallResp.text
-            if qjResponseCode != 200:
-                print('Error: Coiote DM responded with: ' +
-                      str(qjResponseCode) + ': ' + qjResponseBody)
-
-            return OperationHttpStatus(
-                statusCode=qjResponseCode,
-                body=qjResponseBody
-            )
+        dispatch = functools.partial(dispatch_operation, event['thingName'], body, deadline)
+    if IDEMPOTENCY_WINDOW.get() > 0:
+        return dispatch_once(event, body, dispatch)
+    return dispatch()
+
+
+def handle_event(event, context, coalesce: bool = False) -> OperationHttpStatus:
+    """
+    Besides operations, accepts device state updates: {'thingName': ..., 'deviceState': {'registered': ...,
+    'queueMode': ...}}, sent by the rules that see a device register or report an operation result.
+    """
+    if 'deviceState' in event:
+        device_state = event['deviceState']
+        update_device_state(event['thingName'], registered=device_state.get('registered'),
+                            queueMode=device_state.get('queueMode'))
+        return OperationHttpStatus(statusCode=200, body='')
+    return handle_operation(event, context, coalesce)
+
+
+@instrumentation.instrumented('lwm2mOperation')
+def lambda_handler(event, context):
+    if 'deviceState' in event:
+        instrumentation.set_dimension('operation', 'deviceState')
+    elif event.get('operation') in OPERATIONS:
+        # unsupported operations are left as unknown, to keep the number of metric dimensions bounded
+        instrumentation.set_dimension('operation', event['operation'])
+    try:
+        return handle_event(event, context)
+    except ConfigurationError as e:
+        print(f'Error: {e}')
+        return operation_error(500, str(e))
+    except COIOTE_UNAVAILABLE_ERRORS as e:
+        print(f'Error: {e}')
+        return coiote_unavailable_error(e)
+    except CoioteRequestError as e:
+        print(f'Error: {e}')
+        return e.operation_error()
+
+
+def is_retryable(result: OperationHttpStatus) -> bool:
+    """Only operations known not to have scheduled a task are sent again (see COIOTE_UNAVAILABLE_ERRORS)."""
+    return result['statusCode'] in (429, 503)
+
+
+@instrumentation.instrumented('lwm2mOperation')
+def sqs_handler(event, context):
+    """
+    Entry point for batches of events routed through SQS, each message body being an event accepted
+    by lambda_handler. Messages are processed concurrently, and only those that failed before their task
+    was scheduled (exceptions, 429 and 503 results, deadline) are reported back to SQS, to be redelivered;
+    those failing every time end up in the dead-letter queue.
+    """
+    instrumentation.set_dimension('operation', 'batch')
+    records = event['Records']
+    deadline = Deadline.from_context(context, DEADLINE_MARGIN_MS.get())
+
+    def handle_record(record) -> bool:
+        """Returns True if the message should be retried."""
+        try:
+            message = json.loads(record['body'])
+        except ValueError as e:
+            print(f'Error: message {record["messageId"]} is not valid JSON, dropping it: {e}')
+            return False
+        if deadline.remaining() <= 0:
+            return True
+        try:
+            result = handle_event(message, context, coalesce=True)
+        except Exception as e:
+            # failures after a task has been scheduled are turned into results by dispatch_operation
+            print(f'Error: message {record["messageId"]} failed: {e}')
+            return True
+        return is_retryable(result)
+
+    # fetch the certificate once instead of in every worker
+    get_session()
+    # records not started by the deadline are not handled at all; the running ones are waited for, as they
+    # are bounded by the deadline themselves, and abandoned ones could complete after being reported as failed
+    with ThreadPoolExecutor(max_workers=max(1, min(FAN_OUT_CONCURRENCY.get(), len(records)))) as executor:
+        futures = {executor.submit(handle_record, record): record['messageId'] for record in records}
+
+    failures = [messageId for future, messageId in futures.items() if future.result()]
+    instrumentation.count('messages', len(records))
+    instrumentation.count('messagesFailed', len(failures))
+    return {
+        'batchItemFailures': [{'itemIdentifier': messageId} for messageId in failures]
+    }
@@ -0,0 +1,96 @@
+import re
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+Segment = Union[int, str]
+
+_SEPARATORS = re.compile('[./]')
+
+
+def parse_path(path: str) -> Tuple[Segment, ...]:
+    """
+    Splits a LwM2M path into its segments, e.g. '/3/0/1' and '3.0.1' both give (3, 0, 1).
+    Numeric segments are converted to ints, so that '/3/10' sorts after '/3/9'.
+    """
+    return tuple(int(segment) if segment.isdigit() else segment
+                 for segment in _SEPARATORS.split(path) if segment)
+
+
+def _segment_order(segment: Segment):
+    return isinstance(segment, str), segment
+
+
+class _Node:
+    __slots__ = ('children', 'path', 'payload', 'terminal')
+
+    def __init__(self):
+        self.children: Dict[Segment, _Node] = {}
+        self.path: Optional[str] = None
+        self.payload: Any = None
+        self.terminal = False
+
+
+class PathTree:
+    """
+    Prefix tree of LwM2M paths in which a path covers all of its subpaths, e.g. /3/0 covers /3/0/1.
+    Each path may carry a payload (such as observe attributes), which is dropped together with
+    the path when the path turns out to be covered by another one.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._added: Set[Tuple[Segment, ...]] = set()
+
+    def add(self, path: str, payload: Any = None) -> bool:
+        """Returns False if the same path has already been added, in which case it is ignored."""
+        segments = parse_path(path)
+        if segments in self._added:
+            return False
+        self._added.add(segments)
+
+        node = self._root
+        for segment in segments:
+            if node.terminal:
+                # covered by an already added path
+                return True
+            node = node.children.setdefault(segment, _Node())
+        node.terminal = True
+        node.path = path[:-1] if path.endswith('.') else path
+        node.payload = payload
+        node.children = {}
+        return True
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        """Yields (path, payload) of the paths that are not covered by others, ordered by segments."""
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node.terminal:
+                yield node.path, node.payload
+            else:
+                stack.extend(child for _, child in
+                             sorted(node.children.items(), key=lambda item: _segment_order(item[0]), reverse=True))
+
+    def paths(self) -> List[str]:
+        return [path for path, _ in self.items()]
+
+
+def has_duplicates(paths: List[str]) -> bool:
+    return len({parse_path(path) for path in paths}) != len(paths)
+
+
+def prune_paths(paths: List[str]) -> List[str]:
+    """
+    The paths that are not covered by others, each spelled as it was first given and ordered as text.
+    Unlike PathTree, which also carries payloads, this needs no parsing: written with dots and a trailing one,
+    a path covering another is its text prefix, so once sorted it comes right before the paths it covers.
+    """
+    spellings: Dict[str, str] = {}
+    for path in paths:
+        spellings.setdefault(path.replace('/', '.').strip('.') + '.', path[:-1] if path.endswith('.') else path)
+    pruned = []
+    covering = None
+    for key in sorted(spellings):
+        if covering is None or not key.startswith(covering):
+            covering = key
+            pruned.append(spellings[key])
+    return pruned
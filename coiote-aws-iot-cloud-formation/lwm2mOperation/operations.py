@@ -0,0 +1,190 @@
+import json
+import math
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple, TypedDict
+
+from lwm2m_paths import PathTree, has_duplicates, prune_paths
+
+# Aliases of the root path, i.e. the whole data model of a device
+ROOT_PATHS = ('all', '', '.', '/')
+
+
+class OperationHttpStatus(TypedDict):
+    statusCode: int
+    body: str
+
+
+def operation_error(code: int, error: str, retry_after: Optional[float] = None) -> OperationHttpStatus:
+    """retry_after (in seconds) is passed on for 429 and 503 errors, rounded up to whole seconds like Retry-After."""
+    body = {
+        'error': error
+    }
+    if retry_after is not None:
+        body['retryAfter'] = math.ceil(retry_after)
+    return OperationHttpStatus(
+        statusCode=code,
+        body=json.dumps(body)
+    )
+
+
+Parameters = List[Dict[str, str]]
+
+
+@dataclass(frozen=True)
+class OperationSpec:
+    templateName: str
+    # serializes the event (keys and the requiredField, if any) into Coiote DM template parameters
+    serializer: Callable[[List[str], dict], Parameters]
+    # field that has to accompany keys, one element per key
+    requiredField: Optional[str] = None
+    uniqueKeys: bool = False
+    singleKey: bool = False
+
+
+def without_trailing_dots(keys: List[str]) -> List[str]:
+    return [key[:-1] if key.endswith('.') else key for key in keys]
+
+
+def unique(keys: List[str]) -> List[str]:
+    return list(dict.fromkeys(keys))
+
+
+def serialize_pruned_keys(keys: List[str], event: dict) -> Parameters:
+    if any(element in keys for element in ROOT_PATHS):
+        keys_str = ''
+    else:
+        keys_str = ','.join(prune_paths(keys))
+    return [{'name': 'keys', 'value': keys_str}]
+
+
+def serialize_unique_keys(keys: List[str], event: dict) -> Parameters:
+    return [{'name': 'keys', 'value': ','.join(unique(keys))}]
+
+
+def serialize_cancel_observe(keys: List[str], event: dict) -> Parameters:
+    # even if there are other keys in 'keys', set it to be just 'all' if 'keys' contains 'all'
+    if 'all' in keys:
+        return [{'name': 'keys', 'value': 'all'}]
+    return serialize_unique_keys(keys, event)
+
+
+def serialize_write(keys: List[str], event: dict) -> Parameters:
+    return [
+        {'name': 'keys', 'value': ','.join(without_trailing_dots(keys))},
+        {'name': 'values', 'value': ','.join([str(x) for x in event['values']])}
+    ]
+
+
+def serialize_observe(keys: List[str], event: dict) -> Parameters:
+    tree = PathTree()
+    for key, attribute in zip(keys, event['attributes']):
+        tree.add(key, attribute)
+    pruned_keys = []
+    attributes = []
+    for key, attribute in tree.items():
+        pruned_keys.append(key)
+        attributes.append(attribute)
+    return [
+        {'name': 'keys', 'value': ','.join(pruned_keys)},
+        {'name': 'attributes', 'value': str(attributes).replace(' ', '')}
+    ]
+
+
+def serialize_execute(keys: List[str], event: dict) -> Parameters:
+    parameters = [{'name': 'keys', 'value': keys[0]}]
+    if event.get('arguments') is not None:
+        parameters.append({'name': 'arguments', 'value': event['arguments']})
+    return parameters
+
+
+def serialize_write_attributes(keys: List[str], event: dict) -> Parameters:
+    return [
+        {'name': 'keys', 'value': ','.join(without_trailing_dots(keys))},
+        {'name': 'attributes', 'value': str(event['attributes']).replace(' ', '').replace('None', "''")}
+    ]
+
+
+OPERATION_SPECS = {
+    'write': OperationSpec('AWSwriteCertAuth', serialize_write, requiredField='values', uniqueKeys=True),
+    'read': OperationSpec('AWSreadCertAuth', serialize_pruned_keys),
+    'readComposite': OperationSpec('AWSreadCompositeCertAuth', serialize_pruned_keys),
+    'observe': OperationSpec('AWSobserveCertAuth', serialize_observe, requiredField='attributes', uniqueKeys=True),
+    'observeComposite': OperationSpec('AWSobserveCompositeCertAuth', serialize_unique_keys),
+    'execute': OperationSpec('AWSexecuteCertAuth', serialize_execute, singleKey=True),
+    'cancelObserve': OperationSpec('AWScancelObserveCertAuth', serialize_cancel_observe),
+    'cancelObserveComposite': OperationSpec('AWScancelObserveCompositeCertAuth', serialize_unique_keys),
+    'writeAttributes': OperationSpec('AWSwriteAttributesCertAuth', serialize_write_attributes,
+                                     requiredField='attributes', uniqueKeys=True),
+}
+
+# Coiote DM template name -> operation
+TEMPLATE_OPERATIONS = {spec.templateName: operation for operation, spec in OPERATION_SPECS.items()}
+
+BuildResult = Tuple[Optional[dict], Optional[OperationHttpStatus]]
+
+
+def compile_operation(operation: str, spec: OperationSpec) -> Callable[[List[str], dict], BuildResult]:
+    """
+    Turns a spec into a function building the Coiote DM request body, running only the checks
+    the spec asks for. Error messages are prepared here, so that they are not formatted per call.
+    """
+    checks = []
+    if spec.singleKey:
+        single_key_error = 'Only one LwM2M path can be passed for execute operation - ' \
+                           'keys array must contain only one element'
+        checks.append(lambda keys, event: single_key_error if len(keys) != 1 else None)
+    if spec.uniqueKeys:
+        unique_keys_error = f'keys must be unique for {operation} operation'
+        checks.append(lambda keys, event: unique_keys_error if has_duplicates(keys) else None)
+    if spec.requiredField is not None:
+        field = spec.requiredField
+        missing_field_error = f'You must specify {field} when {operation} operation is used'
+        length_error = f'The number of keys must be equal to the number of {field}'
+
+        def check_required_field(keys, event):
+            if field not in event:
+                return missing_field_error
+            if len(keys) != len(event[field]):
+                return length_error
+            return None
+
+        checks.append(check_required_field)
+
+    template_name = spec.templateName
+    serializer = spec.serializer
+
+    def build(keys: List[str], event: dict) -> BuildResult:
+        for check in checks:
+            error = check(keys, event)
+            if error is not None:
+                print(f'Error: {error}')
+                return None, operation_error(400, error)
+        return {
+            'templateName': template_name,
+            'config': {
+                'parameters': serializer(keys, event)
+            }
+        }, None
+
+    return build
+
+
+OPERATIONS = {operation: compile_operation(operation, spec) for operation, spec in OPERATION_SPECS.items()}
+
+
+def build_operation_body(event) -> BuildResult:
+    if 'keys' not in event:
+        # Results of print functions are logged in CloudWatch when debugging is enabled
+        # Results of return seem to be not logged there
+        print('Error: keys must be specified')
+        return None, operation_error(400, 'keys must be specified')
+    if 'operation' not in event:
+        print('Error: operation must be specified')
+        return None, operation_error(400, 'operation must be specified')
+
+    operation = event['operation']
+    build = OPERATIONS.get(operation)
+    if build is None:
+        print(f'Error: operation {operation} is not implemented for AWS-CoioteDM integration')
+        return None, operation_error(406, f'operation {operation} is not implemented for AWS-CoioteDM integration')
+    return build(event['keys'], event)
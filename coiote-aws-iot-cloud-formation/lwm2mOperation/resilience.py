@@ -0,0 +1,205 @@
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Executor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import TYPE_CHECKING, Callable, Optional
+
+import instrumentation
+
+if TYPE_CHECKING:
+    import requests
+
+# sends a request with the given timeout (in seconds)
+Send = Callable[[float], 'requests.Response']
+
+
+class NotSentError(Exception):
+    """Raised instead of sending a request to Coiote DM, so retrying the operation cannot duplicate anything."""
+
+
+class CircuitOpenError(NotSentError):
+    pass
+
+
+class DeadlineExceededError(NotSentError):
+    """Raised before an attempt; the previous ones, if any, have not been processed by Coiote DM."""
+
+
+class Deadline:
+    """Point in time (time.monotonic()) by which the invocation has to be done with Coiote DM."""
+
+    def __init__(self, at: float):
+        self.at = at
+
+    @classmethod
+    def from_context(cls, context, margin_ms: int, default_ms: int = 60000) -> 'Deadline':
+        remaining_ms = context.get_remaining_time_in_millis() if context is not None else default_ms
+        return cls(time.monotonic() + (remaining_ms - margin_ms) / 1000)
+
+    def remaining(self) -> float:
+        return self.at - time.monotonic()
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures, so that calls fail fast instead of waiting
+    for an unhealthy Coiote DM. After open_seconds a single probe call is let through (half-open):
+    its success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int, open_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+        self._probe_thread: Optional[int] = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        return 'open' if time.monotonic() - self.opened_at < self.open_seconds else 'half-open'
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.open_seconds or self._probing:
+                return False
+            self._probing = True
+            self._probe_thread = threading.get_ident()
+            return True
+
+    def release_probe(self):
+        """
+        Lets another probe through if this thread's probe has ended without a success or a failure,
+        e.g. it has not been sent at all; otherwise the circuit would never close.
+        """
+        with self._lock:
+            if self._probing and self._probe_thread == threading.get_ident():
+                self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self._probing:
+                    instrumentation.count('circuitOpened')
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+
+def is_server_failure(response: 'requests.Response') -> bool:
+    return response.status_code >= 500
+
+
+def is_retryable_response(response: 'requests.Response', idempotent: bool) -> bool:
+    """
+    429 and 503 mean that the request has been rejected without being processed, so they can always be retried.
+    Other 5xx responses leave it unknown whether a POST has scheduled anything, they are retried only if idempotent.
+    """
+    if response.status_code in (429, 503):
+        return True
+    return idempotent and response.status_code >= 500
+
+
+def is_retryable_exception(e: Exception, idempotent: bool) -> bool:
+    """A request that could not even connect has not reached Coiote DM; a timed out one may have."""
+    import requests
+    from urllib3.exceptions import NewConnectionError
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(e, requests.exceptions.ConnectionError) and not isinstance(e, requests.exceptions.ReadTimeout):
+        # requests wraps urllib3's MaxRetryError, whose reason is the actual error
+        reason = getattr(e.args[0], 'reason', None) if e.args else None
+        return idempotent or isinstance(reason, NewConnectionError)
+    return idempotent and isinstance(e, requests.exceptions.Timeout)
+
+
+def retry_after(response: 'requests.Response') -> float:
+    try:
+        return float(response.headers.get('Retry-After', 0))
+    except ValueError:
+        # an HTTP date, not worth parsing for the few seconds an invocation can wait
+        return 0.0
+
+
+def call_with_retries(send: Send, deadline: Deadline, breaker: CircuitBreaker, attempts: int,
+                      base_delay: float, max_timeout: float, idempotent: bool) -> 'requests.Response':
+    """
+    Sends the request up to attempts times, with full jitter exponential backoff (at least Retry-After)
+    between attempts. Each attempt's timeout and the backoff are bounded by the deadline; once it has passed,
+    DeadlineExceededError is raised. Raises CircuitOpenError without sending anything while the breaker is open.
+    The last response is returned even if it is an error, the last exception is re-raised.
+    """
+    for attempt in range(attempts):
+        if not breaker.allow():
+            instrumentation.count('circuitRejected')
+            raise CircuitOpenError('Coiote DM is unavailable, calls are suspended for a while')
+        try:
+            timeout = min(max_timeout, deadline.remaining())
+            if timeout <= 0:
+                raise DeadlineExceededError('deadline exceeded before Coiote DM responded')
+
+            last_attempt = attempt == attempts - 1
+            delay = random.uniform(0, base_delay * 2 ** attempt)
+            try:
+                response = send(timeout)
+            except Exception as e:
+                breaker.record_failure()
+                if last_attempt or not is_retryable_exception(e, idempotent) or delay >= deadline.remaining():
+                    raise
+            else:
+                if is_server_failure(response):
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                if last_attempt or not is_retryable_response(response, idempotent):
+                    return response
+                delay = max(delay, retry_after(response))
+                if delay >= deadline.remaining():
+                    return response
+        finally:
+            breaker.release_probe()
+
+        instrumentation.count('coioteRetries')
+        time.sleep(delay)
+
+
+def hedged(send: Send, delay: float, executor: Executor) -> Send:
+    """
+    Sends an idempotent request again if it has not completed within delay seconds and returns
+    whichever response comes first, preferring responses which are not server failures.
+    """
+
+    def send_hedged(timeout: float) -> 'requests.Response':
+        first = executor.submit(send, timeout)
+        try:
+            return first.result(timeout=delay)
+        except FutureTimeoutError:
+            pass
+        if timeout <= delay:
+            return first.result()
+
+        instrumentation.count('coioteHedges')
+        second = executor.submit(send, timeout - delay)
+        pending = {first, second}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                succeeded = future.exception() is None and not is_server_failure(future.result())
+                if succeeded or not pending:
+                    if future is second and succeeded:
+                        instrumentation.count('coioteHedgeWins')
+                    return future.result()
+
+    return send_hedged
@@ -0,0 +1,47 @@
+"""
+Numeric tuning settings, read from environment variables on first use like coiote_client.get_rest_uri,
+so that a malformed value fails the invocations which need it with a clear error instead of the import of the lambda.
+"""
+import math
+import os
+from typing import Callable, Generic, Optional, TypeVar
+
+Number = TypeVar('Number', int, float)
+
+
+class ConfigurationError(Exception):
+    pass
+
+
+class Setting(Generic[Number]):
+    """The number in the environment variable name, or default if it is not set; at least minimum."""
+
+    def __init__(self, name: str, default: Number, kind: Callable[[str], Number] = float, minimum: Number = 0):
+        self.name = name
+        self.default = default
+        self.kind = kind
+        self.minimum = minimum
+        self._value: Optional[Number] = None
+
+    def get(self) -> Number:
+        # parsing is idempotent, so concurrent first uses need no lock
+        if self._value is None:
+            self._value = self._parse()
+        return self._value
+
+    def set(self, value: Number):
+        """Overrides the environment variable, e.g. in benchmarks."""
+        self._value = value
+
+    def _parse(self) -> Number:
+        value = os.environ.get(self.name, '')
+        if not value:
+            return self.default
+        try:
+            number = self.kind(value)
+        except ValueError:
+            raise ConfigurationError(
+                f'{self.name} must be {"an integer" if self.kind is int else "a number"}, got {value!r}') from None
+        if not math.isfinite(number) or number < self.minimum:
+            raise ConfigurationError(f'{self.name} must be a finite number of at least {self.minimum}, got {value}')
+        return number
@@ -0,0 +1,103 @@
+"""
+Builds the endpointName -> device id index read by lwm2mOperation (see device_index.py) by paging through
+all devices in Coiote DM, so that new containers do not have to look every device up on its own.
+
+Usage: python sync_device_index.py [INDEX] [--full] [--page-size N]
+
+INDEX defaults to device_index.bin, ship it in a Lambda layer (it ends up in /opt, where the lambda looks for it
+by default) or point coioteDMdeviceIndexPath at it. If INDEX already exists, only devices created since its last
+sync are fetched and merged into it; --full downloads the whole fleet again, which also drops removed devices.
+Coiote DM is authenticated with the certificate from Secrets Manager, like in the lambda, so coioteDMrestUri
+and AWS credentials have to be set in the environment.
+
+Pages are fetched from /devices/find/details, filtered with "id gt '<last id of the previous page>'",
+which relies on devices being listed in the order of their ids.
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, Optional, Tuple
+
+# coiote_client imports the instrumentation layer, which the lambda gets from its runtime
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'instrumentationLayer', 'python'))
+from coiote_client import coiote_request  # noqa: E402
+from device_index import open_index, write_index  # noqa: E402
+from resilience import CircuitBreaker, Deadline, call_with_retries  # noqa: E402
+
+LIST_PATH = '/devices/find/details'
+# Overlap of incremental syncs, covering clock skew and devices created while the previous sync was running
+INCREMENTAL_OVERLAP = timedelta(minutes=10)
+PAGE_TIMEOUT = 60
+PAGE_ATTEMPTS = 5
+
+
+def list_devices(page_size: int, created_after: Optional[datetime] = None) -> Iterator[Tuple[str, str]]:
+    """Yields (endpointName, device id) of the devices, skipping devices without an endpoint name."""
+    # a single page is retried at most PAGE_ATTEMPTS times anyway, there is no point in failing fast
+    breaker = CircuitBreaker(failure_threshold=PAGE_ATTEMPTS + 1, open_seconds=0)
+    last_id = None
+    while True:
+        criteria = []
+        if created_after is not None:
+            criteria.append(f"creationTime gt '{created_after.strftime('%Y-%m-%dT%H:%M:%SZ')}'")
+        if last_id is not None:
+            criteria.append(f"id gt '{last_id}'")
+        params = {'limit': page_size}
+        if criteria:
+            params['searchCriteria'] = ' and '.join(criteria)
+
+        def send(timeout: float):
+            return coiote_request('GET', LIST_PATH, params=params, timeout=timeout)
+
+        response = call_with_retries(send, Deadline(time.monotonic() + PAGE_ATTEMPTS * PAGE_TIMEOUT), breaker,
+                                     attempts=PAGE_ATTEMPTS, base_delay=1, max_timeout=PAGE_TIMEOUT,
+                                     idempotent=True)
+        response.raise_for_status()
+        page = response.json()
+        for device in page:
+            endpoint_name = device.get('properties', {}).get('endpointName')
+            if endpoint_name:
+                yield endpoint_name, device['id']
+        if len(page) < page_size:
+            return
+        last_id = page[-1]['id']
+
+
+def sync(path: str, full: bool = False, page_size: int = 1000,
+         overlap: timedelta = INCREMENTAL_OVERLAP) -> Tuple[int, int]:
+    """Returns the number of devices fetched from Coiote DM and in the index."""
+    started_at = datetime.now(timezone.utc)
+    index = None if full else open_index(path)
+    if index is None:
+        entries = {}
+        created_after = None
+    else:
+        entries = dict(index.items())
+        created_after = datetime.fromisoformat(index.metadata['syncedAt']) - overlap
+        index.close()
+
+    fetched = 0
+    for endpoint_name, device_id in list_devices(page_size, created_after):
+        entries[endpoint_name] = device_id
+        fetched += 1
+    write_index(path, entries.items(), {'syncedAt': started_at.isoformat()})
+    return fetched, len(entries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Builds the endpointName -> Coiote DM device id index.')
+    parser.add_argument('index', nargs='?', default='device_index.bin')
+    parser.add_argument('--full', action='store_true', help='download all devices instead of new ones only')
+    parser.add_argument('--page-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    fetched, indexed = sync(args.index, full=args.full, page_size=args.page_size)
+    print(f'Fetched {fetched} devices in {time.monotonic() - start:.1f} s, {indexed} devices in {args.index}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Token buckets of admission control (lwm2mOperation/admission.py), with the single container backend.
+
+Usage: python -m unittest discover tests (or pytest tests), from coiote-aws-iot-cloud-formation
+"""
+import os
+import sys
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'instrumentationLayer', 'python'))
+sys.path.insert(0, os.path.join(ROOT, 'lwm2mOperation'))
+from admission import AdmissionController, AdmissionRejectedError, LocalAdmissionBackend  # noqa: E402
+from resilience import Deadline  # noqa: E402
+
+
+def controller(rate=10.0, burst=2.0, operation_rates=None, reserve=0.0, max_wait=0.0):
+    return AdmissionController(LocalAdmissionBackend(), rate=rate, burst=burst, operation_rates=operation_rates or {},
+                               high_priority_operations=['execute'], reserve=reserve, max_wait=max_wait)
+
+
+def deadline():
+    return Deadline(time.monotonic() + 10)
+
+
+class AdmissionControllerTest(unittest.TestCase):
+
+    def test_low_priority_task_with_session_trigger_is_admitted_within_operation_rate(self):
+        admission = controller(rate=100.0, burst=100.0, operation_rates={'read': 1.0})
+        admission.acquire('read', deadline(), calls=2)
+
+    def test_low_priority_task_with_session_trigger_is_admitted_despite_reserve(self):
+        admission = controller(burst=2.0, reserve=0.4)
+        admission.acquire('read', deadline(), calls=2)
+
+    def test_reserve_is_kept_from_low_priority_operations(self):
+        admission = controller(burst=2.0, reserve=0.4)
+        admission.acquire('read', deadline(), calls=2)
+        with self.assertRaises(AdmissionRejectedError) as raised:
+            admission.acquire('read', deadline())
+        self.assertEqual(raised.exception.statusCode, 429)
+
+    def test_high_priority_operations_use_the_reserve(self):
+        admission = controller(burst=2.0, reserve=1.0)
+        admission.acquire('execute', deadline(), calls=2)
+
+    def test_exceeded_operation_rate_is_rejected(self):
+        admission = controller(rate=100.0, burst=100.0, operation_rates={'read': 1.0})
+        admission.acquire('read', deadline())
+        with self.assertRaises(AdmissionRejectedError):
+            admission.acquire('read', deadline())
+        admission.acquire('write', deadline())
+
+    def test_pause_rejects_with_service_unavailable(self):
+        admission = controller(max_wait=0.1)
+        admission.throttled(retry_after=5)
+        with self.assertRaises(AdmissionRejectedError) as raised:
+            admission.acquire('execute', deadline())
+        self.assertEqual(raised.exception.statusCode, 503)
+
+
+if __name__ == '__main__':
+    unittest.main()
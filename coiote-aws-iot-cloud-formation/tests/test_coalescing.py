@@ -0,0 +1,98 @@
+"""
+Merge rules of coalesced operations (lwm2mOperation/coalescing.py).
+
+Usage: python -m unittest discover tests (or pytest tests), from coiote-aws-iot-cloud-formation
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lwm2mOperation'))
+from coalescing import merge_operations, merge_reads, merge_writes  # noqa: E402
+
+
+def read(*keys, operation='read'):
+    return {'thingName': 'thing', 'operation': operation, 'keys': list(keys)}
+
+
+def write(keys, values):
+    return {'thingName': 'thing', 'operation': 'write', 'keys': keys, 'values': values}
+
+
+def execute(key):
+    return {'thingName': 'thing', 'operation': 'execute', 'keys': [key]}
+
+
+class MergeReadsTest(unittest.TestCase):
+
+    def test_union_of_paths(self):
+        merged = merge_reads([read('3.0.1'), read('3303.0.5700'), read('3.0.0')])
+        self.assertEqual(merged['keys'], ['3.0.0', '3.0.1', '3303.0.5700'])
+
+    def test_covered_paths_are_pruned(self):
+        merged = merge_reads([read('3.0.1'), read('3.0'), read('3.0.2')])
+        self.assertEqual(merged['keys'], ['3.0'])
+
+    def test_root_path_covers_everything(self):
+        for root in ('all', '', '.', '/'):
+            with self.subTest(root=root):
+                self.assertEqual(merge_reads([read('3.0.1'), read(root), read('5')])['keys'], ['all'])
+
+    def test_other_fields_are_taken_from_the_last_event(self):
+        first = dict(read('3.0.1'), clientToken='first')
+        last = dict(read('3.0.2'), clientToken='last')
+        self.assertEqual(merge_reads([first, last])['clientToken'], 'last')
+
+
+class MergeWritesTest(unittest.TestCase):
+
+    def test_last_writer_wins(self):
+        merged = merge_writes([write(['3.0.14', '1.0.1'], ['+01', 60]), write(['1.0.1'], [300])])
+        self.assertEqual(merged['keys'], ['3.0.14', '1.0.1'])
+        self.assertEqual(merged['values'], ['+01', 300])
+
+    def test_spellings_of_the_same_path_are_one_path(self):
+        merged = merge_writes([write(['/1/0/1'], [60]), write(['1.0.1'], [300])])
+        self.assertEqual(merged['keys'], ['1.0.1'])
+        self.assertEqual(merged['values'], [300])
+
+    def test_position_of_the_first_write_is_kept(self):
+        merged = merge_writes([write(['1.0.1', '1.0.2'], [60, 1]), write(['1.0.3', '1.0.1'], [5, 300])])
+        self.assertEqual(merged['keys'], ['1.0.1', '1.0.2', '1.0.3'])
+        self.assertEqual(merged['values'], [300, 1, 5])
+
+
+class MergeOperationsTest(unittest.TestCase):
+
+    def test_adjacent_runs_are_merged(self):
+        merged = merge_operations([read('3.0.1'), read('3.0.2'), write(['1.0.1'], [60]), write(['1.0.2'], [1])])
+        self.assertEqual([event['operation'] for event in merged], ['read', 'write'])
+        self.assertEqual(merged[0]['keys'], ['3.0.1', '3.0.2'])
+        self.assertEqual(merged[1]['keys'], ['1.0.1', '1.0.2'])
+
+    def test_order_across_different_operations_is_kept(self):
+        merged = merge_operations([read('3.0.1'), read('3.0.2'), write(['3.0.14'], ['+01']), read('3.0.14')])
+        self.assertEqual([(event['operation'], event['keys']) for event in merged], [
+            ('read', ['3.0.1', '3.0.2']),
+            ('write', ['3.0.14']),
+            ('read', ['3.0.14']),
+        ])
+
+    def test_read_and_read_composite_are_not_merged_together(self):
+        merged = merge_operations([read('3.0.1'), read('3.0.2', operation='readComposite')])
+        self.assertEqual([event['operation'] for event in merged], ['read', 'readComposite'])
+
+    def test_other_operations_are_not_merged(self):
+        events = [execute('3.0.4'), execute('3.0.4')]
+        self.assertEqual(merge_operations(events), events)
+
+    def test_single_events_are_kept_as_they_are(self):
+        events = [read('3.0.1'), write(['1.0.1'], [60]), execute('3.0.4')]
+        self.assertEqual(merge_operations(events), events)
+
+    def test_no_events(self):
+        self.assertEqual(merge_operations([]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
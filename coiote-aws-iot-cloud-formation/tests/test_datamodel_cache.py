@@ -0,0 +1,128 @@
+"""
+Reads with maxAge answered from the datamodel shadow (lwm2mOperation/datamodel_cache.py, read_through_datamodel
+of lwm2mOperation/lambda_function.py), against a fake iot-data client.
+
+Usage: python -m unittest discover tests (or pytest tests), from coiote-aws-iot-cloud-formation
+"""
+import io
+import json
+import os
+import sys
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'instrumentationLayer', 'python'))
+sys.path.insert(0, os.path.join(ROOT, 'lwm2mOperation'))
+import lambda_function  # noqa: E402
+from datamodel_cache import CACHED_RESULT_TOKEN, DatamodelCache  # noqa: E402
+
+
+class ResourceNotFoundException(Exception):
+    pass
+
+
+class FakeIotDataClient:
+    """Datamodel shadow of a device with a fresh Device object (3) and a Temperature (3303) reported an hour ago."""
+
+    class exceptions:
+        ResourceNotFoundException = ResourceNotFoundException
+
+    def __init__(self):
+        self.updates = []
+        now = time.time()
+        self.document = {
+            'state': {'reported': {'3': {'0': {'0': 'Acme', '1': 'X'}}, '3303': {'0': {'5700': 21.5}}}},
+            'metadata': {'reported': {'3': {'0': {'0': {'timestamp': now}, '1': {'timestamp': now}}},
+                                      '3303': {'0': {'5700': {'timestamp': now - 3600}}}}},
+        }
+
+    def get_thing_shadow(self, thingName, shadowName):
+        return {'payload': io.BytesIO(json.dumps(self.document).encode('utf-8'))}
+
+    def update_thing_shadow(self, thingName, shadowName, payload):
+        self.updates.append((thingName, shadowName, json.loads(payload)))
+
+
+def read(*keys, **fields):
+    return dict({'thingName': 'thing', 'operation': 'read', 'keys': list(keys), 'maxAge': 60}, **fields)
+
+
+class ReadThroughDatamodelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeIotDataClient()
+        self.cache = DatamodelCache(max_size=10, ttl=300, refresh_interval=1)
+        self.cache._client = self.client
+        self.original_cache = lambda_function.datamodel_cache
+        lambda_function.datamodel_cache = self.cache
+
+    def tearDown(self):
+        lambda_function.datamodel_cache = self.original_cache
+
+    def test_fresh_read_is_answered_from_the_shadow(self):
+        event, response = lambda_function.read_through_datamodel(read('3.0'))
+        self.assertIsNone(event)
+        self.assertEqual(json.loads(response['body']), {'result': {'3': {'0': {'0': 'Acme', '1': 'X'}}}})
+        # the caller gets the response, nothing to report
+        self.assertEqual(self.client.updates, [])
+
+    def test_fresh_shadow_triggered_read_is_reported(self):
+        lambda_function.read_through_datamodel(read('3.0.0', version=7, clientToken='token'))
+        self.assertEqual(self.client.updates, [('thing', 'operation', {
+            'state': {'reported': {'operation': 'read', 'result': {'3': {'0': {'0': 'Acme'}}}}},
+            'clientToken': CACHED_RESULT_TOKEN + 'token',
+        })])
+
+    def test_partial_hit_reports_cached_values_and_reads_only_stale_keys(self):
+        event, response = lambda_function.read_through_datamodel(read('3.0', '3303.0.5700'))
+        self.assertIsNone(response)
+        self.assertEqual(event['keys'], ['3303.0.5700'])
+        self.assertEqual(len(self.client.updates), 1)
+        self.assertEqual(self.client.updates[0][2]['state']['reported']['result'],
+                         {'3': {'0': {'0': 'Acme', '1': 'X'}}})
+
+    def test_stale_read_goes_to_the_device(self):
+        original = read('3303.0', version=7)
+        event, response = lambda_function.read_through_datamodel(original)
+        self.assertIs(event, original)
+        self.assertIsNone(response)
+        self.assertEqual(self.client.updates, [])
+
+    def test_unknown_path_is_not_fresh(self):
+        event, _ = lambda_function.read_through_datamodel(read('5.0.1'))
+        self.assertEqual(event['keys'], ['5.0.1'])
+
+    def test_failed_report_reads_everything(self):
+        def fail(**kwargs):
+            raise RuntimeError('throttled')
+        self.client.update_thing_shadow = fail
+        original = read('3.0', '3303.0.5700')
+        event, response = lambda_function.read_through_datamodel(original)
+        self.assertIs(event, original)
+        self.assertIsNone(response)
+
+
+class CachedDatamodelTest(unittest.TestCase):
+
+    def test_covered_paths_are_those_under_the_prefix(self):
+        client = FakeIotDataClient()
+        client.document['state']['reported']['3303']['10'] = {'5700': 1.0}
+        cache = DatamodelCache(max_size=10, ttl=300, refresh_interval=1)
+        cache._client = client
+        entry = cache.fetch('thing')
+        self.assertEqual(entry.covered(('3303', '1')), [])
+        self.assertEqual(entry.covered(('3303', '10')), [('3303', '10', '5700')])
+        self.assertEqual(entry.covered(('3',)), [('3', '0', '0'), ('3', '0', '1')])
+        self.assertEqual(len(entry.covered(())), 4)
+
+    def test_empty_shadow_has_no_leaves(self):
+        client = FakeIotDataClient()
+        client.document = {'state': {'reported': {}}, 'metadata': {}}
+        cache = DatamodelCache(max_size=10, ttl=300, refresh_interval=1)
+        cache._client = client
+        self.assertEqual(cache.fetch('thing').leaves, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+"""
+Flattening, diffing and chunking of datamodel documents (datamodelDelta/datamodel_diff.py).
+
+Usage: python -m unittest discover tests (or pytest tests), from coiote-aws-iot-cloud-formation
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'datamodelDelta'))
+from datamodel_diff import diff, dumps, flatten, split_into_chunks, unflatten  # noqa: E402
+
+DOCUMENT = {
+    '3': {'0': {'0': 'Acme', '1': 'Sensor', '7': [3300, 3800]}},
+    '3303': {
+        '0': {'5700': 21.5, '5701': 'Cel', '5750': ''},
+        '1': {'5700': -4.25, '5701': 'Cel', '5750': 'outdoor'},
+    },
+}
+
+
+class FlattenTest(unittest.TestCase):
+
+    def test_leaves_in_document_order(self):
+        self.assertEqual(list(flatten(DOCUMENT))[:4], [
+            ('3', '0', '0'), ('3', '0', '1'), ('3', '0', '7'), ('3303', '0', '5700'),
+        ])
+        self.assertEqual(flatten(DOCUMENT)[('3', '0', '7')], [3300, 3800])
+
+    def test_round_trip(self):
+        self.assertEqual(unflatten(flatten(DOCUMENT).items()), DOCUMENT)
+
+    def test_empty_document_has_no_leaves(self):
+        self.assertEqual(flatten({}), {})
+        self.assertEqual(unflatten(flatten({}).items()), {})
+
+    def test_document_which_is_not_an_object_has_no_leaves(self):
+        for document in (None, [], 'text', 5):
+            with self.subTest(document=document):
+                self.assertEqual(flatten(document), {})
+
+    def test_nested_empty_object_is_a_leaf(self):
+        document = {'3': {'0': {}}, '5': {'0': {'3': 1}}}
+        self.assertEqual(flatten(document), {('3', '0'): {}, ('5', '0', '3'): 1})
+        self.assertEqual(unflatten(flatten(document).items()), document)
+
+    def test_deletion_is_a_leaf(self):
+        document = {'3303': {'1': None, '0': {'5750': None}}}
+        self.assertEqual(flatten(document), {('3303', '1'): None, ('3303', '0', '5750'): None})
+        self.assertEqual(unflatten(flatten(document).items()), document)
+
+
+class DiffTest(unittest.TestCase):
+
+    def test_changed_and_new_leaves(self):
+        previous = flatten(DOCUMENT)
+        current = flatten({'3303': {'0': {'5700': 22.0, '5701': 'Cel'}, '2': {'5700': 0}}})
+        self.assertEqual(diff(previous, current), {('3303', '0', '5700'): 22.0, ('3303', '2', '5700'): 0})
+
+    def test_deletion_of_an_existing_leaf_is_a_change(self):
+        previous = flatten(DOCUMENT)
+        self.assertEqual(diff(previous, {('3303', '1'): None}), {('3303', '1'): None})
+
+    def test_no_changes(self):
+        self.assertEqual(diff(flatten(DOCUMENT), flatten(DOCUMENT)), {})
+        self.assertEqual(diff(flatten(DOCUMENT), flatten({})), {})
+
+
+class SplitIntoChunksTest(unittest.TestCase):
+
+    def assertChunksOf(self, leaves, chunks, max_bytes, overhead=0):
+        merged = {}
+        for chunk in chunks:
+            chunk_leaves = flatten(chunk)
+            if len(chunk_leaves) > 1:
+                self.assertLessEqual(len(dumps(chunk)) + overhead, max_bytes)
+            merged.update(chunk_leaves)
+        self.assertEqual(list(merged.items()), list(leaves.items()))
+
+    def test_everything_fits_in_one_chunk(self):
+        leaves = flatten(DOCUMENT)
+        self.assertEqual(split_into_chunks(leaves, 8192), [DOCUMENT])
+
+    def test_chunks_do_not_exceed_max_bytes(self):
+        leaves = flatten(DOCUMENT)
+        size = len(dumps(DOCUMENT))
+        for max_bytes in range(10, size + 20):
+            with self.subTest(max_bytes=max_bytes):
+                self.assertChunksOf(leaves, split_into_chunks(leaves, max_bytes), max_bytes)
+
+    def test_overhead_counts_against_max_bytes(self):
+        leaves = flatten(DOCUMENT)
+        size = len(dumps(DOCUMENT))
+        self.assertEqual(len(split_into_chunks(leaves, size + 100)), 1)
+        chunks = split_into_chunks(leaves, size + 100, overhead=100)
+        self.assertGreater(len(chunks), 1)
+        self.assertChunksOf(leaves, chunks, size + 100, overhead=100)
+
+    def test_leaf_bigger_than_max_bytes_gets_a_chunk_of_its_own(self):
+        leaves = {('3', '0', '0'): 'A', ('3', '0', '1'): 'x' * 100, ('3', '0', '2'): 'B'}
+        self.assertEqual(split_into_chunks(leaves, 50), [
+            {'3': {'0': {'0': 'A'}}}, {'3': {'0': {'1': 'x' * 100}}}, {'3': {'0': {'2': 'B'}}},
+        ])
+
+    def test_deletions_are_kept(self):
+        leaves = {('3303', '1'): None, ('3303', '0', '5700'): 1}
+        self.assertEqual(split_into_chunks(leaves, 8192), [{'3303': {'1': None, '0': {'5700': 1}}}])
+
+    def test_no_leaves_no_chunks(self):
+        self.assertEqual(split_into_chunks({}, 8192), [])
+        self.assertEqual(split_into_chunks(flatten({}), 8192), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
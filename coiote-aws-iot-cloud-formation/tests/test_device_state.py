@@ -0,0 +1,64 @@
+"""
+Skipping session triggers for devices known to be registered outside of queue mode (lwm2mOperation/device_state.py).
+
+Usage: python -m unittest discover tests (or pytest tests), from coiote-aws-iot-cloud-formation
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lwm2mOperation'))
+import device_state  # noqa: E402
+from device_state import session_trigger_needed, update_device_state  # noqa: E402
+from ttl_cache import TtlLruCache  # noqa: E402
+
+
+class SessionTriggerNeededTest(unittest.TestCase):
+
+    def setUp(self):
+        self.original_states = device_state.device_states
+        self.original_assume_queue_mode = device_state.ASSUME_QUEUE_MODE
+        device_state.device_states = TtlLruCache(max_size=10, ttl=60)
+        # as with deviceStateUpdates enabled
+        device_state.ASSUME_QUEUE_MODE = False
+
+    def tearDown(self):
+        device_state.device_states = self.original_states
+        device_state.ASSUME_QUEUE_MODE = self.original_assume_queue_mode
+
+    def test_registered_device_is_not_triggered(self):
+        update_device_state('thing', registered=True)
+        self.assertFalse(session_trigger_needed('thing'))
+
+    def test_unknown_device_is_triggered(self):
+        update_device_state('other', registered=True)
+        self.assertTrue(session_trigger_needed('thing'))
+
+    def test_deregistered_device_is_triggered(self):
+        update_device_state('thing', registered=True)
+        update_device_state('thing', registered=False)
+        self.assertTrue(session_trigger_needed('thing'))
+
+    def test_registered_device_in_queue_mode_is_triggered(self):
+        update_device_state('thing', registered=True, queueMode=True)
+        self.assertTrue(session_trigger_needed('thing'))
+
+    def test_unreported_fields_keep_their_values(self):
+        update_device_state('thing', queueMode=False)
+        update_device_state('thing', registered=True)
+        device_state.ASSUME_QUEUE_MODE = True
+        self.assertFalse(session_trigger_needed('thing'))
+
+    def test_registered_device_is_triggered_when_queue_mode_is_assumed(self):
+        # the default: deviceState events report registration only, so nothing is skipped
+        device_state.ASSUME_QUEUE_MODE = True
+        update_device_state('thing', registered=True)
+        self.assertTrue(session_trigger_needed('thing'))
+
+    def test_expired_registration_is_triggered(self):
+        device_state.device_states.put('thing', device_state.DeviceState(registered=True), ttl=0)
+        self.assertTrue(session_trigger_needed('thing'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+"""
+Pruning of LwM2M paths covered by other paths (lwm2mOperation/lwm2m_paths.py).
+
+Usage: python -m unittest discover tests (or pytest tests), from coiote-aws-iot-cloud-formation
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lwm2mOperation'))
+from lwm2m_paths import PathTree, prune_paths  # noqa: E402
+
+
+class PrunePathsTest(unittest.TestCase):
+
+    def test_covered_paths_are_pruned(self):
+        self.assertEqual(prune_paths(['3.0.1', '3303.0', '3.0', '3303.0.5700', '3.1']), ['3.0', '3.1', '3303.0'])
+
+    def test_segment_prefix_is_not_a_covering_path(self):
+        self.assertEqual(prune_paths(['3.1', '3.10.0', '33.0']), ['3.1', '3.10.0', '33.0'])
+
+    def test_spellings_of_the_same_path_are_one_path(self):
+        self.assertEqual(prune_paths(['/3/0/1', '3.0.1.', '3.0.1']), ['/3/0/1'])
+        self.assertEqual(prune_paths(['3.0.1', '/3/0/']), ['/3/0/'])
+
+    def test_trailing_dot_is_dropped(self):
+        self.assertEqual(prune_paths(['3.0.', '5.0.1.']), ['3.0', '5.0.1'])
+
+    def test_same_paths_as_path_tree(self):
+        paths = ['3.0.1', '/3303/10', '3303.10.5700', '3303.9', '/3/0/', '5.0.1', '5.0.10', '3303.1.5700.']
+        tree = PathTree()
+        for path in paths:
+            tree.add(path)
+        self.assertEqual(sorted(prune_paths(paths)), sorted(tree.paths()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+"""
+Decoding SenML JSON and CBOR results (datamodelDelta/senml.py), with hand-encoded CBOR vectors.
+
+Usage: python -m unittest discover tests (or pytest tests), from coiote-aws-iot-cloud-formation
+"""
+import base64
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'datamodelDelta'))
+from senml import (Record, SenmlError, decode, decode_result, is_cbor, iter_cbor_records,  # noqa: E402
+                   iter_json_records, iter_records)
+
+# [{-2: '/3303/0/', 0: '5700', 2: 21.5 (half precision)}]
+CBOR_HALF_FLOAT = b'\x81\xa3' + b'\x21\x68/3303/0/' + b'\x00\x645700' + b'\x02\xf9\x4d\x60'
+
+# indefinite array of indefinite and definite maps:
+# {-3: 1700000000}, {-2: '/3303/1/', 0: '5700', 2: -40, 6: 1(10)}, {0: '5701', 3: 'Cel', 1: 'Cel'}
+CBOR_BASE_TIME = (
+    b'\x9f'
+    b'\xbf\x22\x1a\x65\x53\xf1\x00\xff'
+    b'\xa4\x21\x68/3303/1/\x00\x645700\x02\x38\x27\x06\xc1\x0a'
+    b'\xa3\x00\x645701\x03\x63Cel\x01\x63Cel'
+    b'\xff'
+)
+
+# [{-2: '/1/', 0: '1', 4: true}, {0: '2', 8: h'0102'}, {0: '3', 3: (_ 'ab', 'c')},
+#  {0: '4', 2: 21.6 (single precision)}, {0: '5', 2: 21.6 (double precision)}, {0: '6', 2: 1000}]
+CBOR_VALUE_TYPES = (
+    b'\x86'
+    b'\xa3\x21\x63/1/\x00\x611\x04\xf5'
+    b'\xa2\x00\x612\x08\x42\x01\x02'
+    b'\xa2\x00\x613\x03\x7f\x62ab\x61c\xff'
+    b'\xa2\x00\x614\x02\xfa\x41\xac\xcc\xcd'
+    b'\xa2\x00\x615\x02\xfb\x40\x35\x99\x99\x99\x99\x99\x9a'
+    b'\xa2\x00\x616\x02\x19\x03\xe8'
+)
+
+
+class ResolutionTest(unittest.TestCase):
+
+    def test_base_name_applies_until_redefined(self):
+        payload = json.dumps([
+            {'bn': '/3303/0/', 'n': '5700', 'v': 21.5},
+            {'n': '5701', 'vs': 'Cel'},
+            {'bn': '/3303/1/', 'n': '5700', 'v': -4},
+        ])
+        self.assertEqual(list(iter_json_records(payload)), [
+            Record(('3303', '0', '5700'), None, 21.5),
+            Record(('3303', '0', '5701'), None, 'Cel'),
+            Record(('3303', '1', '5700'), None, -4),
+        ])
+
+    def test_name_without_base_name(self):
+        self.assertEqual(list(iter_json_records('[{"n": "/3/0/0", "vs": "Acme"}]')),
+                         [Record(('3', '0', '0'), None, 'Acme')])
+
+    def test_times_are_relative_to_base_time(self):
+        payload = json.dumps([
+            {'bt': 1700000000.0},
+            {'n': '/3303/0/5700', 'v': 21.5, 't': -5},
+            {'n': '/3303/0/5701', 'vs': 'Cel'},
+        ])
+        self.assertEqual([record.time for record in iter_json_records(payload)], [1699999995.0, 1700000000.0])
+
+    def test_base_value_offsets_numeric_values_only(self):
+        payload = json.dumps([
+            {'bn': '/3303/0/', 'bv': 20, 'n': '5700', 'v': 1.5},
+            {'n': '5701', 'vs': 'Cel'},
+        ])
+        self.assertEqual([record.value for record in iter_json_records(payload)], [21.5, 'Cel'])
+
+    def test_record_setting_only_base_fields_is_not_a_value(self):
+        self.assertEqual(list(iter_json_records('[{"bn": "/3/0/", "bt": 1}]')), [])
+
+    def test_opaque_and_object_link_values(self):
+        payload = '[{"bn": "/3/0/", "n": "1", "vd": "AQI"}, {"n": "2", "vlo": "3303:0"}, {"n": "3", "vb": false}]'
+        self.assertEqual([record.value for record in iter_json_records(payload)], [b'\x01\x02', '3303:0', False])
+
+    def test_latest_value_wins(self):
+        payload = json.dumps([
+            {'bn': '/3303/0/', 'bt': 100, 'n': '5700', 'v': 2, 't': 10},
+            {'n': '5700', 'v': 1, 't': 5},
+            {'n': '5701', 'vs': 'Cel'},
+        ])
+        self.assertEqual(decode(payload), {('3303', '0', '5700'): 2, ('3303', '0', '5701'): 'Cel'})
+
+
+class JsonTest(unittest.TestCase):
+
+    def test_whitespace_and_empty_array(self):
+        self.assertEqual(list(iter_json_records(' [ ] ')), [])
+        self.assertEqual(list(iter_json_records(b'\n[ {"n": "/1/0/1", "v": 60} ,\n{"n": "/1/0/7", "vs": "U"} ]')),
+                         [Record(('1', '0', '1'), None, 60), Record(('1', '0', '7'), None, 'U')])
+
+    def test_parsed_records(self):
+        self.assertEqual(list(iter_records([{'bn': '/3/0/', 'n': '0', 'vs': 'Acme'}])),
+                         [Record(('3', '0', '0'), None, 'Acme')])
+
+    def test_invalid_payloads(self):
+        for payload in ('{"n": "/3/0/0"}', '[1]', '[{"n": "/3/0/0", "v": 1} {"n": "/3/0/1", "v": 2}]'):
+            with self.subTest(payload=payload):
+                with self.assertRaises(SenmlError):
+                    list(iter_json_records(payload))
+
+
+class CborTest(unittest.TestCase):
+
+    def test_half_float_with_base_name(self):
+        self.assertTrue(is_cbor(CBOR_HALF_FLOAT))
+        self.assertEqual(list(iter_cbor_records(CBOR_HALF_FLOAT)), [Record(('3303', '0', '5700'), None, 21.5)])
+
+    def test_indefinite_lengths_base_time_tags_and_unknown_labels(self):
+        self.assertEqual(list(iter_cbor_records(CBOR_BASE_TIME)), [
+            Record(('3303', '1', '5700'), 1700000010, -40),
+            Record(('3303', '1', '5701'), 1700000000, 'Cel'),
+        ])
+
+    def test_value_types(self):
+        self.assertEqual([record.value for record in iter_cbor_records(CBOR_VALUE_TYPES)],
+                         [True, b'\x01\x02', 'abc', 21.600000381469727, 21.6, 1000])
+        self.assertEqual([record.path for record in iter_cbor_records(CBOR_VALUE_TYPES)],
+                         [('1', str(i)) for i in range(1, 7)])
+
+    def test_compact_floats_are_shortest_decimals(self):
+        values = [record.value for record in iter_cbor_records(CBOR_VALUE_TYPES, compact_floats=True)]
+        self.assertEqual(values[3:5], [21.6, 21.6])
+
+    def test_invalid_payloads(self):
+        for payload in (CBOR_HALF_FLOAT[:-1], CBOR_HALF_FLOAT[:5], b'\x81\x01', b'\xa0', b'\x81\xa1\x00\x1c'):
+            with self.subTest(payload=payload):
+                with self.assertRaises(SenmlError):
+                    list(iter_cbor_records(payload))
+
+    def test_json_is_not_cbor(self):
+        self.assertFalse(is_cbor(b'[{"n": "/3/0/0", "vs": "Acme"}]'))
+        self.assertFalse(is_cbor(b' []'))
+        self.assertFalse(is_cbor(b''))
+
+
+class DecodeResultTest(unittest.TestCase):
+
+    def test_base64_cbor(self):
+        result = base64.b64encode(CBOR_VALUE_TYPES).decode('ascii')
+        self.assertEqual(decode_result(result), {
+            ('1', '1'): True, ('1', '2'): 'AQI=', ('1', '3'): 'abc',
+            ('1', '4'): 21.600000381469727, ('1', '5'): 21.6, ('1', '6'): 1000,
+        })
+
+    def test_compact_json(self):
+        result = '[{"bn": "/3303/0/", "n": "5700", "v": 21.0}, {"n": "5601", "v": 1e300}]'
+        self.assertEqual(decode_result(result), {('3303', '0', '5700'): 21.0, ('3303', '0', '5601'): 1e300})
+        compact = decode_result(result, compact=True)
+        self.assertIsInstance(compact[('3303', '0', '5700')], int)
+        self.assertIsInstance(compact[('3303', '0', '5601')], float)
+
+
+if __name__ == '__main__':
+    unittest.main()